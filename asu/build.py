@@ -1,60 +1,462 @@
 import datetime
 import json
 import logging
-import re
+import shutil
 from os import getenv
 from pathlib import Path
-from typing import Union
-from time import perf_counter
+from socket import gethostname
+from typing import Optional, Union
+from time import perf_counter, time
 
 from rq import get_current_job
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
 from rq.utils import parse_timeout
-from podman import errors
+from podman import PodmanClient, errors
+from podman.domain.containers import Container
 
 from asu.build_request import BuildRequest
 from asu.config import settings
+from asu.container_pool import (
+    acquire_container,
+    create_container,
+    release_container,
+    request_prewarm,
+)
+from asu.package_cache import (
+    evict_packages,
+    get_download_dir,
+    get_feed_urls,
+    get_package_files,
+    populate_download_dir,
+    store_downloads,
+)
 from asu.package_changes import apply_package_changes
+from asu.signing import sign_image, write_file_atomic
+from asu.store import link_artifacts, remove_build, store_artifacts, touch_build
 from asu.util import (
+    STATUS_CHECK_INTERVAL,
+    advertise_image,
     add_timestamp,
+    build_phase,
     add_build_event,
     check_manifest,
+    copy_files,
     diff_packages,
     fingerprint_pubkey_usign,
     get_branch,
+    get_build_dir,
+    get_build_path,
     get_container_version_tag,
+    get_file_hash,
+    get_imagebuilder_image,
+    get_imagebuilder_info,
+    get_log_stream_key,
+    get_manifest,
+    get_manifest_failure,
     get_packages_hash,
     get_podman,
-    get_request_hash,
+    get_redis_client,
+    get_status_channel,
+    get_str_hash,
+    get_upstream_revision,
+    increment_metric,
     is_snapshot_build,
+    parse_imagebuilder_info,
     parse_manifest,
+    pull_image,
+    redis_lock,
     report_error,
+    resolve_build_dir,
     run_cmd,
+    set_imagebuilder_info,
+    set_imagebuilder_status,
+    set_manifest_failure,
 )
 
 log = logging.getLogger("rq.worker")
 
+SNAPSHOT_REPOSITORY: str = "localhost/asu-snapshot"
+
+
+def get_artifact_names(profile: dict) -> list[str]:
+    """Return the names of all files a build result references
+
+    Args:
+        profile (dict): Profile entry of the `profiles.json` of the build
+
+    Returns:
+        list: Names of the images and the manifest of the profile
+    """
+    names: list[str] = [image["name"] for image in profile.get("images", [])]
+    if image_prefix := profile.get("image_prefix"):
+        names.append(f"{image_prefix}.manifest")
+    return names
+
+
+def retrieve_artifacts(
+    container: Container, source: str, profile: str, bin_dir: Path
+) -> dict[str, str]:
+    """Copy `profiles.json` and the files it references for `profile`
+
+    Other files written by the ImageBuilder are left in the container.
+
+    Args:
+        container (Container): Container which ran the build
+        source (str): The `BIN_DIR` within the container
+        profile (str): The built profile
+        bin_dir (Path): The store directory of the request
+
+    Returns:
+        dict: sha256sum of every copied file
+    """
+    checksums: dict[str, str] = copy_files(
+        container, source, ["profiles.json"], bin_dir
+    )
+    if not checksums:
+        return checksums
+
+    profiles: dict = json.loads((bin_dir / "profiles.json").read_text())["profiles"]
+    if profile in profiles:
+        names: list[str] = get_artifact_names(profiles[profile])
+        checksums.update(copy_files(container, source, names, bin_dir))
+
+    return checksums
+
+
+def remove_snapshot_images(podman: PodmanClient, prefix: str, keep: str) -> None:
+    """Remove outdated snapshot images, images still in use are kept"""
+    for snapshot_image in podman.images.list(
+        filters={"reference": SNAPSHOT_REPOSITORY}
+    ):
+        for tag in snapshot_image.tags:
+            if tag.startswith(f"{SNAPSHOT_REPOSITORY}:{prefix}-") and tag != keep:
+                try:
+                    podman.images.remove(tag)
+                    log.info(f"Removed outdated {tag}")
+                except errors.APIError as exc:
+                    log.debug(f"Could not remove {tag}: {exc}")
+
+
+def get_snapshot_image(
+    podman: PodmanClient,
+    image: str,
+    environment: dict[str, str],
+    build_request: BuildRequest,
+) -> str:
+    """Return a local image containing the unpacked snapshot ImageBuilder
+
+    `setup.sh` downloads the ImageBuilder of the latest upstream revision. The
+    container is committed as image tagged by target and revision, so later
+    builds of the same revision share the unpacked ImageBuilder as read-only
+    image layer and skip the download.
+
+    Args:
+        podman (PodmanClient): Podman client
+        image (str): ImageBuilder container image running `setup.sh`
+        environment (dict): Environment used by `setup.sh`
+        build_request (BuildRequest): The build request
+
+    Returns:
+        str: The snapshot image or `image` if it couldn't be created
+    """
+    revision: str = get_upstream_revision(build_request.version, build_request.target)
+    if not revision:
+        return image
+
+    prefix: str = f"{build_request.version}-{build_request.target.replace('/', '-')}"
+    snapshot_image: str = f"{SNAPSHOT_REPOSITORY}:{prefix}-{revision}"
+    if podman.images.exists(snapshot_image):
+        return snapshot_image
+
+    with redis_lock(
+        f"snapshot-cache:{gethostname()}:{snapshot_image}", settings.job_timeout
+    ):
+        if podman.images.exists(snapshot_image):
+            return snapshot_image
+
+        log.info(f"Creating {snapshot_image}")
+        container = create_container(
+            podman, image, environment=environment, lifetime=settings.job_timeout
+        )
+        try:
+            returncode, _, stderr = run_cmd(container, ["sh", "setup.sh"])
+            if returncode:
+                log.warning(f"Could not set up ImageBuilder: {stderr}")
+                return image
+
+            # Upstream may have published another revision in the meantime.
+            _, stdout, _ = run_cmd(container, ["make", "info"])
+            if unpacked := parse_imagebuilder_info(stdout)["revision"]:
+                snapshot_image = f"{SNAPSHOT_REPOSITORY}:{prefix}-{unpacked}"
+
+            repository, tag = snapshot_image.rsplit(":", 1)
+            container.commit(repository=repository, tag=tag)
+        finally:
+            container.kill()
+
+    remove_snapshot_images(podman, prefix, snapshot_image)
+    return snapshot_image
+
+
+def get_coalesce_key(
+    build_request: BuildRequest,
+    image_digest: str,
+    version_code: str,
+    manifest: dict[str, str],
+) -> str:
+    """Return a key of everything affecting the content of built images
+
+    Requests differing only in fields without effect on the result, like the
+    client or the order of packages, share the same key.
+
+    Args:
+        build_request (BuildRequest): The build request
+        image_digest (str): Digest of the ImageBuilder container image
+        version_code (str): Revision of the ImageBuilder
+        manifest (dict): Resolved packages and their versions
+
+    Returns:
+        str: hash of the build inputs
+    """
+    return get_str_hash(
+        "".join(
+            [
+                image_digest,
+                version_code,
+                build_request.profile,
+                get_str_hash(" ".join(f"{n}={v}" for n, v in sorted(manifest.items()))),
+                str(build_request.rootfs_size_mb),
+                get_str_hash(build_request.defaults),
+                get_str_hash(json.dumps(build_request.repositories, sort_keys=True)),
+            ]
+        )
+    )
+
+
+def get_manifest_key(build_request: BuildRequest, image_digest: str) -> str:
+    """Return the Redis key of the cached manifest of a request
+
+    Manifests only depend on the ImageBuilder, the profile and the package
+    selection. Snapshot ImageBuilders change without a new container image,
+    so their upstream revision is part of the key.
+
+    Args:
+        build_request (BuildRequest): The validated build request
+        image_digest (str): Digest of the ImageBuilder container image
+
+    Returns:
+        str: Redis key of the manifest
+    """
+    revision: str = ""
+    if is_snapshot_build(build_request.version):
+        revision = get_upstream_revision(build_request.version, build_request.target)
+
+    return "manifest:" + get_str_hash(
+        "".join(
+            [
+                image_digest,
+                revision,
+                build_request.profile,
+                get_packages_hash(build_request.packages),
+                get_str_hash(
+                    json.dumps(build_request.packages_versions, sort_keys=True)
+                ),
+                str(build_request.diff_packages),
+                get_str_hash(json.dumps(build_request.repositories, sort_keys=True)),
+                str(build_request.repository_keys),
+            ]
+        )
+    )
+
+
+def get_manifest_failure_key(build_request: BuildRequest, image_digest: str) -> str:
+    """Return the Redis key of a cached impossible package selection
 
-def _build(build_request: BuildRequest, job=None):
+    Failures depend on the same inputs as the manifest, see `get_manifest_key`.
+    """
+    return "manifest-failure:" + get_manifest_key(
+        build_request, image_digest
+    ).removeprefix("manifest:")
+
+
+def claim_build(coalesce_key: str, request_hash: str, force: bool = False) -> str:
+    """Register a build of `coalesce_key` unless one exists already
+
+    The claim expires with the job timeout, so builds of crashed workers
+    don't block others.
+
+    Args:
+        coalesce_key (str): Key of the build inputs
+        request_hash (str): Hash of the request running the build
+        force (bool): Replace an existing claim, e.g. of a failed build
+
+    Returns:
+        str: Request hash of the build to use, `request_hash` if claimed
+    """
+    redis = get_redis_client()
+    key = f"build:coalesce:{coalesce_key}"
+    if redis.set(
+        key, request_hash, nx=not force, ex=parse_timeout(settings.job_timeout)
+    ):
+        return request_hash
+    return redis.get(key) or request_hash
+
+
+def wait_for_build(request_hash: str, timeout: float) -> Optional[dict]:
+    """Wait for the build job of another request and return its result
+
+    The worker announces finished and failed jobs on the status channel of
+    the build, the job is checked every `STATUS_CHECK_INTERVAL` seconds as
+    well.
+
+    Args:
+        request_hash (str): Hash of the other request
+        timeout (float): Seconds to wait at most
+
+    Returns:
+        dict: Result of the build or None if it failed, vanished or took
+            longer than `timeout`
+    """
+    deadline: float = time() + timeout
+    redis = get_redis_client(False)
+    with redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+        # Subscribe first to not miss changes made while reading the job
+        pubsub.subscribe(get_status_channel(request_hash))
+        while (remaining := deadline - time()) > 0:
+            try:
+                job = Job.fetch(request_hash, connection=redis)
+            except NoSuchJobError:
+                return None
+
+            status = job.get_status()
+            if status == JobStatus.FINISHED:
+                return job.return_value()
+            if status not in (
+                JobStatus.QUEUED,
+                JobStatus.STARTED,
+                JobStatus.DEFERRED,
+                JobStatus.SCHEDULED,
+            ):
+                return None
+            pubsub.get_message(timeout=min(remaining, STATUS_CHECK_INTERVAL))
+
+    return None
+
+
+def log_contains(log_file: Path, offset: int, markers: list[str]) -> bool:
+    """Check if the build log contains any of `markers` after `offset`
+
+    Streamed commands only return the end of their output, so warnings
+    printed early, like those of `check-size`, are searched in the log.
+
+    Args:
+        log_file (Path): The build log
+        offset (int): Position in the log the command started writing at
+        markers (list): Strings to look for
+
+    Returns:
+        bool: If any marker is found
+    """
+    if not log_file.is_file():
+        return False
+    with log_file.open("r", errors="replace") as log_content:
+        log_content.seek(offset)
+        return any(marker in line for line in log_content for marker in markers)
+
+
+def save_result(bin_dir: Path, result: dict) -> dict:
+    """Write the result of a build to the store
+
+    Only the store contains the manifest, the result returned to RQ and kept
+    in Redis refers to it via `bin_dir`. This counts as access of the store
+    directory for the garbage collection.
+
+    Args:
+        bin_dir (Path): Store directory of the build
+        result (dict): Complete result of the build
+
+    Returns:
+        dict: The result without manifest
+    """
+    write_file_atomic(bin_dir / "result.json", json.dumps(result).encode())
+    touch_build(bin_dir.name)
+    return {key: value for key, value in result.items() if key != "manifest"}
+
+
+def count_build(job: Job, build_request: BuildRequest, origin: str = "build") -> None:
+    """Record a successful build in the statistics and metrics
+
+    Prebuilds aren't requested by users, so they neither show up in the
+    public statistics nor make a profile popular, see `get_popular_profiles`.
+
+    Args:
+        job (Job): The build job
+        build_request (BuildRequest): The build request
+        origin (str): `build`, or `coalesced` if the artifacts of an
+            identical build were reused
+    """
+    if job.origin == "prebuild":
+        return
+
+    add_timestamp(
+        f"stats:builds:{build_request.version}:{build_request.target}:{build_request.profile}",
+        {
+            "stats": "builds",
+            "version": build_request.version,
+            "target": build_request.target,
+            "profile": build_request.profile,
+        },
+    )
+    increment_metric(
+        "builds_total",
+        {
+            "version": build_request.version,
+            "target": build_request.target,
+            "profile": build_request.profile,
+            "origin": origin,
+        },
+    )
+
+
+def _build(build_request: BuildRequest, job=None, manifest_only: bool = False):
     """Build image request and setup ImageBuilders automatically
 
     The `request` dict contains properties of the requested image.
 
     Args:
         request (dict): Contains all properties of requested image
+        manifest_only (bool): Stop after `make manifest` and return the manifest
     """
 
     build_start: float = perf_counter()
 
-    request_hash = get_request_hash(build_request)
-    bin_dir: Path = settings.public_path / "store" / request_hash
+    job = job or get_current_job()
+    # Jobs are keyed by the hash of the request as posted. Validation maps
+    # e.g. profile aliases afterwards, so `build_request` may hash differently.
+    request_hash: str = job.id
+    bin_dir: Path = get_build_dir(request_hash)
+    if manifest_only:
+        bin_dir = get_manifest_dir(request_hash)
+    elif bin_dir.is_dir():
+        # Files of a previous build are links into the blob store, writing
+        # them in place would change the images of other requests.
+        remove_build(bin_dir)
     bin_dir.mkdir(parents=True, exist_ok=True)
     log.debug(f"Bin dir: {bin_dir}")
 
-    job = job or get_current_job()
+    # Command output is kept in the store instead of the job meta in Redis.
+    log_file: Path = bin_dir / "build.log"
+    log_file.unlink(missing_ok=True)
+
+    # Output of long running commands is published while they run.
+    log_stream: str = "" if manifest_only else get_log_stream_key(request_hash)
+    if log_stream:
+        # Rebuilds of a request must not replay the log of the previous build.
+        get_redis_client().delete(log_stream)
     job.meta["detail"] = "init"
-    job.meta["imagebuilder_status"] = "init"
     job.meta["request"] = build_request
-    job.save_meta()
+    set_imagebuilder_status(job, "init")
 
     log.debug(f"Building {build_request}")
 
@@ -70,7 +472,7 @@ def _build(build_request: BuildRequest, job=None):
     mounts: list[dict[str, Union[str, bool]]] = []
     environment: dict[str, str] = {}
 
-    image = f"{settings.base_container}:{build_request.target.replace('/', '-')}-{container_version_tag}"
+    image = get_imagebuilder_image(build_request)
 
     if is_snapshot_build(build_request.version):
         environment.update(
@@ -91,18 +493,45 @@ def _build(build_request: BuildRequest, job=None):
             }
         )
 
-    job.meta["imagebuilder_status"] = "container_setup"
-    job.save_meta()
+    set_imagebuilder_status(job, "container_setup")
 
     log.info(f"Pulling {image}...")
     try:
-        podman.images.pull(image)
+        with build_phase(job, "pull", build_request):
+            image_digest: str = pull_image(podman, image)
     except errors.ImageNotFound:
         report_error(
             job,
             f"Image not found: {image}. If this version was just released, please try again in a few hours as it may take some time to become fully available.",
         )
-    log.info(f"Pulling {image}... done")
+    log.info(f"Pulling {image}... done ({image_digest})")
+
+    if settings.image_affinity and job.worker_name:
+        advertise_image(job.worker_name, build_request)
+
+    # Known impossible package selections fail before starting a container.
+    manifest_failure_key: str = get_manifest_failure_key(build_request, image_digest)
+    if failure := get_manifest_failure(manifest_failure_key):
+        report_error(job, failure["detail"], failure["stderr"])
+
+    manifest_key: str = ""
+    if manifest_only:
+        manifest_key = get_manifest_key(build_request, image_digest)
+        if cached_manifest := get_manifest(manifest_key):
+            log.info(f"Using cached manifest {manifest_key}")
+            set_imagebuilder_status(job, "done")
+            return cached_manifest
+
+    # The unpacked snapshot ImageBuilder is reused until upstream publishes a
+    # new revision.
+    unpacked: bool = False
+    if settings.snapshot_cache and is_snapshot_build(build_request.version):
+        with build_phase(job, "setup", build_request):
+            snapshot_image = get_snapshot_image(
+                podman, image, environment, build_request
+            )
+        unpacked = snapshot_image != image
+        image = snapshot_image
 
     bin_dir.mkdir(parents=True, exist_ok=True)
     log.debug("Created store path: %s", bin_dir)
@@ -151,7 +580,7 @@ def _build(build_request: BuildRequest, job=None):
             },
         )
 
-    if build_request.defaults:
+    if build_request.defaults and not manifest_only:
         log.debug("Found defaults")
 
         defaults_file = bin_dir / "files/etc/uci-defaults/99-asu-defaults"
@@ -168,58 +597,117 @@ def _build(build_request: BuildRequest, job=None):
 
     log.debug("Mounts: %s", mounts)
 
-    container = podman.containers.create(
-        image,
-        command=["sleep", str(parse_timeout(settings.job_timeout))],
-        mounts=mounts,
-        cap_drop=["all"],
-        no_new_privileges=True,
-        privileged=False,
-        networks={"pasta": {}},
-        auto_remove=True,
-        environment=environment,
+    # Request specific mounts can't be added to running containers, so only
+    # plain requests are served from the pool of warm containers. Reused
+    # containers don't run `setup.sh` again, so snapshots are only pooled if
+    # the image pins the unpacked revision, see `get_snapshot_image`.
+    pooled: bool = (
+        settings.container_pool_size > 0
+        and not mounts
+        and (unpacked or not is_snapshot_build(build_request.version))
     )
-    container.start()
 
-    if is_snapshot_build(build_request.version):
-        log.info("Running setup.sh for ImageBuilder")
-        returncode, job.meta["stdout"], job.meta["stderr"] = run_cmd(
-            container, ["sh", "setup.sh"]
+    if not pooled and not manifest_only:
+        # Let the ImageBuilder write images straight into the store instead of
+        # copying them out of the container afterwards.
+        mounts.append(
+            {
+                "type": "bind",
+                "source": str(bin_dir),
+                "target": f"/builder/{request_hash}",
+                "read_only": False,
+            },
         )
-        if returncode:
+
+    # Pooled containers keep their downloads, others share a package cache.
+    download_dir: Optional[Path] = None
+    if not pooled and not manifest_only and settings.package_cache_size_mb:
+        download_dir = get_download_dir(request_hash)
+        download_dir.mkdir(parents=True, exist_ok=True)
+        mounts.append(
+            {
+                "type": "bind",
+                "source": str(download_dir),
+                "target": "/builder/dl",
+                "read_only": False,
+            },
+        )
+
+    with build_phase(job, "container", build_request):
+        if pooled:
+            container, fresh = acquire_container(
+                podman, image, image_digest, environment
+            )
+        else:
+            container = create_container(
+                podman,
+                image,
+                mounts,
+                environment,
+                settings.job_timeout,
+                keep_id=not manifest_only,
+            )
+            fresh = True
+
+    def stop_container(reuse: bool = False) -> None:
+        if pooled:
+            release_container(podman, container, image, image_digest, reuse)
+        else:
             container.kill()
-            report_error(job, "Could not set up ImageBuilder")
+            if download_dir:
+                shutil.rmtree(download_dir, ignore_errors=True)
 
-    returncode, job.meta["stdout"], job.meta["stderr"] = run_cmd(
-        container, ["make", "info"]
-    )
+    if fresh and is_snapshot_build(build_request.version) and not unpacked:
+        log.info("Running setup.sh for ImageBuilder")
+        with build_phase(job, "setup", build_request):
+            returncode, _, stderr = run_cmd(
+                container, ["sh", "setup.sh"], log_file=log_file, log_stream=log_stream
+            )
+        if returncode:
+            stop_container()
+            report_error(job, "Could not set up ImageBuilder", stderr)
+
+    # Snapshot ImageBuilders are downloaded by `setup.sh`, so their `make info`
+    # changes without a new container image.
+    info: Optional[dict] = None
+    if not is_snapshot_build(build_request.version):
+        _, info = get_imagebuilder_info(digest=image_digest)
 
-    job.meta["imagebuilder_status"] = "validate_revision"
-    job.save_meta()
+    if info:
+        log.debug(f"Using cached ImageBuilder info of {image_digest}")
+    else:
+        with build_phase(job, "make_info", build_request):
+            returncode, stdout, stderr = run_cmd(
+                container, ["make", "info"], log_file=log_file
+            )
+        info = parse_imagebuilder_info(stdout)
+        if returncode or not info["revision"]:
+            stop_container()
+            report_error(job, "Could not read ImageBuilder info", stderr)
+
+        if not is_snapshot_build(build_request.version):
+            set_imagebuilder_info(image, image_digest, info)
 
-    version_code = re.search('Current Revision: "(r.+)"', job.meta["stdout"]).group(1)
+    set_imagebuilder_status(job, "validate_revision")
+
+    version_code = info["revision"]
 
     if requested := build_request.version_code:
         if version_code != requested:
+            stop_container(reuse=True)
             report_error(
                 job,
                 f"Received incorrect version {version_code} (requested {requested})",
             )
 
-    default_packages = set(
-        re.search(r"Default Packages: (.*)\n", job.meta["stdout"]).group(1).split()
-    )
+    default_packages = set(info["default_packages"])
     log.debug(f"Default packages: {default_packages}")
 
-    profile_packages = set(
-        re.search(
-            r"{}:\n    .+\n    Packages: (.*?)\n".format(build_request.profile),
-            job.meta["stdout"],
-            re.MULTILINE,
-        )
-        .group(1)
-        .split()
-    )
+    if build_request.profile not in info["profiles"]:
+        stop_container(reuse=True)
+        report_error(job, "Profile not found in ImageBuilder")
+
+    profile_packages = set(info["profiles"][build_request.profile]["packages"])
 
     apply_package_changes(build_request)
 
@@ -231,8 +719,7 @@ def _build(build_request: BuildRequest, job=None):
         )
         log.debug(f"Diffed packages: {build_cmd_packages}")
 
-    job.meta["imagebuilder_status"] = "validate_manifest"
-    job.save_meta()
+    set_imagebuilder_status(job, "validate_manifest")
 
     if settings.squid_cache and not is_snapshot_build(build_request.version):
         log.info("Disabling HTTPS for repositories")
@@ -241,33 +728,101 @@ def _build(build_request: BuildRequest, job=None):
             ["sed", "-i", "s|https|http|g", "repositories.conf", "repositories"],
         )
 
-    returncode, job.meta["stdout"], job.meta["stderr"] = run_cmd(
-        container,
-        [
-            "make",
-            "manifest",
-            f"PROFILE={build_request.profile}",
-            f"PACKAGES={' '.join(build_cmd_packages)}",
-            "STRIP_ABI=1",
-        ],
-    )
-
-    job.save_meta()
+    with build_phase(job, "make_manifest", build_request):
+        returncode, stdout, stderr = run_cmd(
+            container,
+            [
+                "make",
+                "manifest",
+                f"PROFILE={build_request.profile}",
+                f"PACKAGES={' '.join(build_cmd_packages)}",
+                "STRIP_ABI=1",
+            ],
+            log_file=log_file,
+        )
 
     if returncode:
-        container.kill()
-        report_error(job, "Impossible package selection")
+        stop_container(reuse=True)
+        set_manifest_failure(
+            manifest_failure_key, "Impossible package selection", stderr
+        )
+        report_error(job, "Impossible package selection", stderr)
 
-    manifest: dict[str, str] = parse_manifest(job.meta["stdout"])
+    manifest: dict[str, str] = parse_manifest(stdout)
     log.debug(f"Manifest: {manifest}")
 
     # Check if all requested packages are in the manifest
     if err := check_manifest(manifest, build_request.packages_versions):
+        stop_container(reuse=True)
         report_error(job, err)
 
     packages_hash: str = get_packages_hash(manifest.keys())
     log.debug(f"Packages Hash: {packages_hash}")
 
+    if manifest_only:
+        stop_container(reuse=True)
+        manifest_result: dict = {
+            "manifest": manifest,
+            "packages_hash": packages_hash,
+            "build_cmd_packages": build_cmd_packages,
+            "version_code": version_code,
+            "imagebuilder_digest": image_digest,
+            "detail": "done",
+        }
+        get_redis_client().set(
+            manifest_key,
+            json.dumps(manifest_result),
+            ex=parse_timeout(settings.manifest_ttl),
+        )
+        set_imagebuilder_status(job, "done")
+        return manifest_result
+
+    # Requests resolving to the same images share a single build.
+    coalesce_key: str = ""
+    if settings.build_coalescing:
+        coalesce_key = get_coalesce_key(
+            build_request, image_digest, version_code, manifest
+        )
+        owner: str = claim_build(coalesce_key, request_hash)
+        if owner != request_hash:
+            log.info(f"Waiting for identical build {owner}")
+            set_imagebuilder_status(job, "waiting_for_build")
+
+            # The container is kept to build without starting over if the
+            # other build fails, so leave half of the job timeout for that.
+            timeout: float = job.timeout or parse_timeout(settings.job_timeout)
+            with build_phase(job, "coalesce", build_request):
+                result: Optional[dict] = wait_for_build(
+                    owner, (timeout - (perf_counter() - build_start)) / 2
+                )
+            if result and link_artifacts(
+                bin_dir, resolve_build_dir(owner), result.get("checksums", {})
+            ):
+                stop_container(reuse=True)
+                store_artifacts(bin_dir, request_hash, result.get("checksums", {}))
+                log.info(f"Reusing artifacts of identical build {owner}")
+                result["bin_dir"] = get_build_path(request_hash)
+                result["build_cmd_packages"] = build_cmd_packages
+                result["manifest"] = manifest
+                count_build(job, build_request, origin="coalesced")
+                set_imagebuilder_status(job, "done")
+                return save_result(bin_dir, result)
+
+            log.info(f"Identical build {owner} is unavailable, building instead")
+            claim_build(coalesce_key, request_hash, force=True)
+
+    package_files: dict[str, str] = {}
+    if download_dir:
+        _, repositories_conf, _ = run_cmd(container, ["cat", "repositories.conf"])
+        package_files = get_package_files(
+            manifest,
+            get_feed_urls(repositories_conf),
+            settings.image_pull_ttl
+            if is_snapshot_build(build_request.version)
+            else settings.imagebuilder_info_ttl,
+        )
+        populate_download_dir(download_dir, package_files)
+
     job.meta["build_cmd"] = [
         "make",
         "image",
@@ -287,24 +842,42 @@ def _build(build_request: BuildRequest, job=None):
 
     log.debug("Build command: %s", job.meta["build_cmd"])
 
-    job.meta["imagebuilder_status"] = "building_image"
-    job.save_meta()
-
-    returncode, job.meta["stdout"], job.meta["stderr"] = run_cmd(
-        container,
-        job.meta["build_cmd"],
-        copy=["/builder/" + request_hash, bin_dir.parent],
-    )
-
-    container.kill()
+    set_imagebuilder_status(job, "building_image")
 
-    job.save_meta()
+    log_offset: int = log_file.stat().st_size if log_file.is_file() else 0
+    with build_phase(job, "make_image", build_request):
+        returncode, _, stderr = run_cmd(
+            container,
+            job.meta["build_cmd"],
+            log_file=log_file,
+            log_stream=log_stream,
+        )
 
-    if any(err in job.meta["stderr"] for err in ["is too big", "out of space?"]):
-        report_error(job, "Selected packages exceed device storage")
+    checksums: dict[str, str] = {}
+    if pooled:
+        if returncode == 0:
+            with build_phase(job, "copy", build_request):
+                checksums = retrieve_artifacts(
+                    container,
+                    f"/builder/{request_hash}",
+                    build_request.profile,
+                    bin_dir,
+                )
+        run_cmd(container, ["rm", "-rf", "/builder/" + request_hash])
+    if download_dir:
+        store_downloads(download_dir, package_files)
+        evict_packages()
+    stop_container(reuse=returncode == 0)
+    if pooled:
+        # The worker starts warm containers for later builds after the job.
+        request_prewarm(image, image_digest, environment)
+
+    # `check-size` deletes oversized images with a warning but succeeds.
+    if log_contains(log_file, log_offset, ["is too big", "out of space?"]):
+        report_error(job, "Selected packages exceed device storage", stderr)
 
     if returncode:
-        report_error(job, "Error while building firmware. See stdout/stderr")
+        report_error(job, "Error while building firmware. See the build log", stderr)
 
     json_file = bin_dir / "profiles.json"
 
@@ -317,6 +890,14 @@ def _build(build_request: BuildRequest, job=None):
     if build_request.profile not in json_content["profiles"]:
         report_error(job, "Profile not found in JSON file")
 
+    if not pooled:
+        # Mounted artifacts were never streamed, hash them once instead.
+        with build_phase(job, "copy", build_request):
+            profile = json_content["profiles"][build_request.profile]
+            for name in get_artifact_names(profile):
+                if (bin_dir / name).is_file():
+                    checksums[name] = get_file_hash(bin_dir / name)
+
     # get list of installable images to sign (i.e. don't sign kernel)
     images = list(
         map(
@@ -331,70 +912,32 @@ def _build(build_request: BuildRequest, job=None):
 
     log.info(f"Signing images: {images}")
 
-    # job.meta["imagebuilder_status"] = "signing_images"
-    job.save_meta()
-
     build_key = getenv("BUILD_KEY") or str(Path.cwd() / "key-build")
 
     if Path(build_key).is_file():
         log.info(f"Signing images with key {build_key}")
-        container = podman.containers.create(
-            image,
-            mounts=[
-                {
-                    "type": "bind",
-                    "source": build_key,
-                    "target": "/builder/key-build",
-                    "read_only": True,
-                },
-                {
-                    "type": "bind",
-                    "source": build_key + ".ucert",
-                    "target": "/builder/key-build.ucert",
-                    "read_only": True,
-                },
-                {
-                    "type": "bind",
-                    "source": str(bin_dir),
-                    "target": request_hash,
-                    "read_only": False,
-                },
-            ],
-            user="root",  # running as root to have write access to the mounted volume
-            working_dir=request_hash,
-            environment={
-                "IMAGES_TO_SIGN": " ".join(images),
-                "PATH": "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin:/builder/staging_dir/host/bin",
-            },
-            auto_remove=True,
-        )
-        returncode, job.meta["stdout"], job.meta["stderr"] = run_cmd(
-            container,
-            [
-                "bash",
-                "-c",
-                (
-                    "env;"
-                    "for IMAGE in $IMAGES_TO_SIGN; do "
-                    "touch ${IMAGE}.test;"
-                    'fwtool -t -s /dev/null "$IMAGE" && echo "sign entfern";'
-                    'cp "/builder/key-build.ucert" "$IMAGE.ucert" && echo "moved";'
-                    'usign -S -m "$IMAGE" -s "/builder/key-build" -x "$IMAGE.sig"  && echo "usign";'
-                    'ucert -A -c "$IMAGE.ucert" -x "$IMAGE.sig" && echo "ucert";'
-                    'fwtool -S "$IMAGE.ucert" "$IMAGE" && echo "fwtool";'
-                    "done"
-                ),
-            ],
-        )
-        container.stop()
-        job.save_meta()
+        secret_key = Path(build_key).read_text()
+        certificate = Path(build_key + ".ucert").read_bytes()
+        with build_phase(job, "signing", build_request):
+            for name in images:
+                if (bin_dir / name).is_file():
+                    checksums[name] = sign_image(
+                        bin_dir / name, secret_key, certificate
+                    )
     else:
         log.warning("No build key found, skipping signing")
 
+    store_artifacts(bin_dir, request_hash, checksums)
+
     json_content.update({"manifest": manifest})
     json_content.update(json_content["profiles"][build_request.profile])
+    json_content["checksums"] = checksums
+    for image_data in json_content["images"]:
+        if image_data["name"] in checksums:
+            image_data["sha256"] = checksums[image_data["name"]]
     json_content["id"] = build_request.profile
-    json_content["bin_dir"] = request_hash
+    json_content["bin_dir"] = get_build_path(request_hash)
+    json_content["imagebuilder_digest"] = image_digest
     json_content["build_cmd_packages"] = build_cmd_packages
     json_content.pop("profiles")
     json_content["build_at"] = datetime.datetime.fromtimestamp(
@@ -404,15 +947,7 @@ def _build(build_request: BuildRequest, job=None):
 
     log.debug("JSON content %s", json_content)
 
-    add_timestamp(
-        f"stats:builds:{build_request.version}:{build_request.target}:{build_request.profile}",
-        {
-            "stats": "builds",
-            "version": build_request.version,
-            "target": build_request.target,
-            "profile": build_request.profile,
-        },
-    )
+    count_build(job, build_request)
 
     # Calculate build duration and log it
     build_duration: float = round(perf_counter() - build_start)
@@ -427,10 +962,33 @@ def _build(build_request: BuildRequest, job=None):
         build_duration,
     )
 
-    job.meta["imagebuilder_status"] = "done"
-    job.save_meta()
+    if coalesce_key:
+        get_redis_client().set(
+            f"build:coalesce:{coalesce_key}",
+            request_hash,
+            ex=parse_timeout(
+                settings.build_defaults_ttl
+                if build_request.defaults
+                else settings.build_ttl
+            ),
+        )
+
+    set_imagebuilder_status(job, "done")
+
+    return save_result(bin_dir, json_content)
 
-    return json_content
+
+def get_manifest_dir(request_hash: str) -> Path:
+    """Return the directory of files mounted into a manifest-only build"""
+    return settings.public_path / "manifests" / request_hash
+
+
+def build_manifest(build_request: BuildRequest, job=None):
+    job = job or get_current_job()
+    try:
+        return _build(build_request, job, manifest_only=True)
+    finally:
+        shutil.rmtree(get_manifest_dir(job.id), ignore_errors=True)
 
 
 def build(build_request: BuildRequest, job=None):
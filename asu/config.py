@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -75,6 +75,8 @@ class Settings(BaseSettings):
     base_container: str = "ghcr.io/openwrt/imagebuilder"
     container_socket_path: str = ""
     container_identity: str = ""
+    container_uid: int = 1000
+    container_gid: int = 1000
     branches: dict = {
         "SNAPSHOT": {
             "path": "snapshots",
@@ -95,8 +97,39 @@ class Settings(BaseSettings):
     build_ttl: str = "3h"
     build_defaults_ttl: str = "30m"
     build_failure_ttl: str = "10m"
+    manifest_ttl: str = "1d"
+    manifest_failure_ttl: str = "1h"
+    log_stream_length: int = 1000
+    max_status_wait: int = 60
     max_pending_jobs: int = 200
+    max_batch_requests: int = 500
+    queues: dict[str, int] = {"interactive": 8, "default": 4, "batch": 2, "prebuild": 0}
+    # Workers must listen to every queue used here, see `README.md`.
+    queue_rules: list[dict] = [
+        {"batch": True, "queue": "batch"},
+        {"client": "luci/", "queue": "interactive"},
+        {"client": "owut/", "queue": "interactive"},
+        {"client": "auc/", "queue": "interactive"},
+    ]
     job_timeout: str = "10m"
+    container_pool_size: int = 0
+    container_pool_idle_ttl: str = "30m"
+    container_pool_max_uses: int = 25
+    imagebuilder_info_ttl: str = "7d"
+    image_pull_ttl: str = "10m"
+    build_coalescing: bool = True
+    prebuild_profiles: int = 0
+    snapshot_cache: bool = False
+    # Must be a host path, it is bind-mounted into build containers. Defaults to
+    # `public_path / "package-cache"`.
+    package_cache_path: Optional[Path] = None
+    package_cache_size_mb: int = 0
+    store_size_mb: int = 0
+    store_offload: str = ""
+    store_offload_prefix: str = "/internal/store"
+    image_affinity: bool = False
+    image_affinity_wait: str = "30s"
+    image_affinity_ttl: str = "1d"
 
 
 settings = Settings()
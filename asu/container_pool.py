@@ -0,0 +1,387 @@
+import json
+import logging
+from socket import gethostname
+from time import time
+from typing import Optional, Union
+
+from podman import PodmanClient, errors
+from podman.domain.containers import Container
+from rq.utils import parse_timeout
+
+from asu.config import settings
+from asu.util import get_redis_client, image_has_digest
+
+log = logging.getLogger("rq.worker")
+
+
+def _pool_prefix() -> str:
+    """Return the Redis key prefix of the pool of this host
+
+    Containers only exist on the Podman instance of the worker host, so every
+    host keeps its own pool.
+    """
+    return f"pool:{gethostname()}"
+
+
+def _pool_name(image: str, digest: str) -> str:
+    """Return the name of the pool of containers of an image digest
+
+    Tags like those of the ImageBuilder images move to new digests, so
+    containers of an outdated digest must not be handed out for the tag.
+    """
+    return f"{image}@{digest}"
+
+
+def _pool_key(pool: str) -> str:
+    return f"{_pool_prefix()}:idle:{pool}"
+
+
+def _pooled_lifetime() -> str:
+    """Return the lifetime of pooled containers
+
+    Pooled containers serve at most `container_pool_max_uses` builds, each
+    within the job timeout and after idling for less than
+    `container_pool_idle_ttl`, see `evict_idle_containers`. They stop on
+    their own afterwards, so containers no Redis key refers to anymore, e.g.
+    after the hostname of the worker changed, don't run forever.
+    """
+    per_use: int = (
+        parse_timeout(settings.container_pool_idle_ttl)
+        + parse_timeout(settings.job_timeout)
+        + 60
+    )
+    return str(settings.container_pool_max_uses * per_use)
+
+
+def create_container(
+    podman: PodmanClient,
+    image: str,
+    mounts: Optional[list[dict[str, Union[str, bool]]]] = None,
+    environment: Optional[dict[str, str]] = None,
+    lifetime: str = "",
+    keep_id: bool = False,
+) -> Container:
+    """Create and start an ImageBuilder container
+
+    The container only runs `sleep`, all work is done via `exec`.
+
+    With `keep_id` the user running podman is mapped to the container user, so
+    files written to bind mounts belong to the worker instead of a subordinate
+    uid and the mounted directories don't need to be world-writable.
+
+    Args:
+        podman (PodmanClient): Podman client
+        image (str): ImageBuilder container image
+        mounts (list): Mounts of the container
+        environment (dict): Environment of the container
+        lifetime (str): Time until the container stops, forever if empty
+        keep_id (bool): Map the podman user to the container user
+
+    Returns:
+        Container: The started container
+    """
+    kwargs: dict = {}
+    if keep_id:
+        kwargs["userns_mode"] = {
+            "nsmode": "keep-id",
+            "value": f"uid={settings.container_uid},gid={settings.container_gid}",
+        }
+
+    container = podman.containers.create(
+        image,
+        command=["sleep", str(parse_timeout(lifetime)) if lifetime else "infinity"],
+        mounts=mounts or [],
+        cap_drop=["all"],
+        no_new_privileges=True,
+        privileged=False,
+        networks={"pasta": {}},
+        auto_remove=True,
+        environment=environment or {},
+        **kwargs,
+    )
+    container.start()
+    return container
+
+
+def _discard_container(podman: PodmanClient, container_id: str) -> None:
+    redis = get_redis_client()
+    redis.hdel(f"{_pool_prefix()}:uses", container_id)
+    redis.hdel(f"{_pool_prefix()}:images", container_id)
+    try:
+        podman.containers.get(container_id).kill()
+    except errors.NotFound:
+        pass
+    except errors.APIError as exc:
+        log.warning(f"Could not kill pooled container {container_id}: {exc}")
+
+
+def evict_idle_containers(podman: PodmanClient) -> int:
+    """Kill pooled containers which are idle or were leaked by a crashed job
+
+    Containers idle for longer than `container_pool_idle_ttl` are removed from
+    the pool. Containers handed out longer than `job_timeout` ago belong to a
+    job that never released them and are removed as well.
+
+    Args:
+        podman (PodmanClient): Podman client
+
+    Returns:
+        int: Number of evicted containers
+    """
+    redis = get_redis_client()
+    prefix = _pool_prefix()
+    now = time()
+    evicted = 0
+
+    idle_before = now - parse_timeout(settings.container_pool_idle_ttl)
+    for container_id in redis.zrangebyscore(f"{prefix}:idle", "-inf", idle_before):
+        redis.zrem(f"{prefix}:idle", container_id)
+        pool = redis.hget(f"{prefix}:images", container_id)
+        # Only the caller removing the entry from the list owns the container,
+        # it may have been handed out in the meantime.
+        if pool and redis.lrem(_pool_key(pool), 0, container_id):
+            log.info(f"Evicting idle container {container_id} ({pool})")
+            _discard_container(podman, container_id)
+            evicted += 1
+
+    busy_before = now - parse_timeout(settings.job_timeout) - 60
+    for container_id in redis.zrangebyscore(f"{prefix}:busy", "-inf", busy_before):
+        if redis.zrem(f"{prefix}:busy", container_id):
+            log.info(f"Evicting leaked container {container_id}")
+            _discard_container(podman, container_id)
+            evicted += 1
+
+    return evicted
+
+
+def acquire_container(
+    podman: PodmanClient,
+    image: str,
+    digest: str,
+    environment: Optional[dict[str, str]] = None,
+) -> tuple[Container, bool]:
+    """Return a running container of `image`, from the pool if possible
+
+    Pooled containers have no request specific mounts, so only requests
+    without extra keys, repositories or defaults can use them.
+
+    Args:
+        podman (PodmanClient): Podman client
+        image (str): ImageBuilder container image
+        digest (str): Digest `image` currently resolves to, see `pull_image`
+        environment (dict): Environment used when a new container is created
+
+    Returns:
+        (Container, bool): The container and if it was freshly created and
+            still requires initialization
+    """
+    redis = get_redis_client()
+    prefix = _pool_prefix()
+    pool = _pool_name(image, digest)
+
+    evict_idle_containers(podman)
+
+    while container_id := redis.lpop(_pool_key(pool)):
+        redis.zrem(f"{prefix}:idle", container_id)
+        try:
+            container = podman.containers.get(container_id)
+        except errors.NotFound:
+            container = None
+
+        if container is None or container.status != "running":
+            log.debug(f"Dropping stale pooled container {container_id}")
+            _discard_container(podman, container_id)
+            continue
+
+        redis.zadd(f"{prefix}:busy", {container.id: time()})
+        log.info(f"Reusing pooled container {container.short_id} for {pool}")
+        return container, False
+
+    container = create_container(
+        podman, image, environment=environment, lifetime=_pooled_lifetime()
+    )
+    redis.zadd(f"{prefix}:busy", {container.id: time()})
+    redis.hset(f"{prefix}:images", container.id, pool)
+    log.info(f"Created pooled container {container.short_id} for {pool}")
+    return container, True
+
+
+def release_container(
+    podman: PodmanClient,
+    container: Container,
+    image: str,
+    digest: str,
+    reuse: bool = True,
+) -> None:
+    """Return a container to the pool or discard it
+
+    Containers are discarded if `reuse` is false, if they served
+    `container_pool_max_uses` builds already or if the pool of `image` is
+    full. Replacements are started by `prewarm_containers` or on demand by
+    `acquire_container`.
+
+    Args:
+        podman (PodmanClient): Podman client
+        container (Container): Container acquired via `acquire_container`
+        image (str): ImageBuilder container image
+        digest (str): Digest the container was acquired for
+        reuse (bool): If the container is in a state to run more builds
+    """
+    redis = get_redis_client()
+    prefix = _pool_prefix()
+    pool = _pool_name(image, digest)
+
+    redis.zrem(f"{prefix}:busy", container.id)
+    uses = redis.hincrby(f"{prefix}:uses", container.id, 1)
+
+    if (
+        not reuse
+        or uses >= settings.container_pool_max_uses
+        or redis.llen(_pool_key(pool)) >= settings.container_pool_size
+    ):
+        log.debug(f"Discarding container {container.short_id} after {uses} uses")
+        _discard_container(podman, container.id)
+        return
+
+    redis.hset(f"{prefix}:images", container.id, pool)
+    redis.zadd(f"{prefix}:idle", {container.id: time()})
+    redis.rpush(_pool_key(pool), container.id)
+    log.debug(f"Returned container {container.short_id} to pool of {pool}")
+
+
+def request_prewarm(
+    image: str, digest: str, environment: Optional[dict[str, str]] = None
+) -> None:
+    """Ask the workers of this host to fill the pool of an image digest
+
+    Builds only record the pool, the worker fills it after the job ended, see
+    `prewarm_requested`. The pool is remembered, so `prewarm_pools` fills it
+    again when the worker restarts.
+
+    Args:
+        image (str): ImageBuilder container image
+        digest (str): Digest `image` currently resolves to, see `pull_image`
+        environment (dict): Environment of the containers
+    """
+    redis = get_redis_client()
+    prefix = _pool_prefix()
+    pool = _pool_name(image, digest)
+
+    redis.zadd(f"{prefix}:pools", {pool: time()})
+    redis.hset(f"{prefix}:environments", pool, json.dumps(environment or {}))
+    redis.sadd(f"{prefix}:prewarm", pool)
+
+
+def prewarm_containers(
+    podman: PodmanClient,
+    image: str,
+    digest: str,
+    environment: Optional[dict[str, str]] = None,
+) -> int:
+    """Start idle containers until the pool of an image digest is full
+
+    Builds following the first one of an image don't wait for a container to
+    start then. Workers of the same host filling the same pool concurrently
+    skip it.
+
+    Args:
+        podman (PodmanClient): Podman client
+        image (str): ImageBuilder container image
+        digest (str): Digest `image` currently resolves to, see `pull_image`
+        environment (dict): Environment of the containers
+
+    Returns:
+        int: Number of started containers
+    """
+    redis = get_redis_client()
+    prefix = _pool_prefix()
+    pool = _pool_name(image, digest)
+
+    lock: str = f"{prefix}:prewarm:{pool}"
+    if not redis.set(lock, "1", nx=True, ex=parse_timeout(settings.job_timeout)):
+        return 0
+
+    started: int = 0
+    try:
+        while redis.llen(_pool_key(pool)) < settings.container_pool_size:
+            try:
+                container = create_container(
+                    podman,
+                    image,
+                    environment=environment,
+                    lifetime=_pooled_lifetime(),
+                )
+            except errors.APIError as exc:
+                log.warning(f"Could not prewarm container for {pool}: {exc}")
+                break
+            redis.hset(f"{prefix}:images", container.id, pool)
+            redis.zadd(f"{prefix}:idle", {container.id: time()})
+            redis.rpush(_pool_key(pool), container.id)
+            started += 1
+    finally:
+        redis.delete(lock)
+
+    if started:
+        log.info(f"Prewarmed {started} containers for {pool}")
+    return started
+
+
+def _prewarm_pool(podman: PodmanClient, pool: str) -> int:
+    """Fill a remembered pool unless its image moved to another digest"""
+    redis = get_redis_client()
+    prefix = _pool_prefix()
+    image, digest = pool.rsplit("@", 1)
+    try:
+        current: bool = image_has_digest(podman.images.get(image), digest)
+    except errors.ImageNotFound:
+        current = False
+    if not current:
+        redis.zrem(f"{prefix}:pools", pool)
+        redis.hdel(f"{prefix}:environments", pool)
+        return 0
+
+    environment: dict[str, str] = json.loads(
+        redis.hget(f"{prefix}:environments", pool) or "{}"
+    )
+    return prewarm_containers(podman, image, digest, environment)
+
+
+def prewarm_requested(podman: PodmanClient) -> int:
+    """Fill the pools builds asked for via `request_prewarm`
+
+    Run by the worker between jobs, so builds don't wait for it.
+
+    Args:
+        podman (PodmanClient): Podman client
+
+    Returns:
+        int: Number of started containers
+    """
+    redis = get_redis_client()
+    started: int = 0
+    while pool := redis.spop(f"{_pool_prefix()}:prewarm"):
+        started += _prewarm_pool(podman, pool)
+    return started
+
+
+def prewarm_pools(podman: PodmanClient) -> int:
+    """Fill the pools of this host used within `container_pool_idle_ttl`
+
+    Run when a worker starts, so its first builds find warm containers.
+    Pools of a digest the local image no longer has are forgotten.
+
+    Args:
+        podman (PodmanClient): Podman client
+
+    Returns:
+        int: Number of started containers
+    """
+    redis = get_redis_client()
+    prefix = _pool_prefix()
+    used_after: float = time() - parse_timeout(settings.container_pool_idle_ttl)
+
+    redis.zremrangebyscore(f"{prefix}:pools", "-inf", f"({used_after}")
+    started: int = 0
+    for pool in redis.zrange(f"{prefix}:pools", 0, -1):
+        started += _prewarm_pool(podman, pool)
+    return started
@@ -3,15 +3,17 @@ from collections import defaultdict
 from datetime import datetime
 from pathlib import Path
 from typing import Union
+from urllib.parse import quote
 
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse
+from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
 from asu import __version__
 from asu.config import settings
-from asu.routers import api, stats
+from asu.routers import api, metrics, stats
+from asu.store import get_artifact_checksum, touch_build
 from asu.util import (
     client_get,
     get_branch,
@@ -21,6 +23,7 @@ from asu.util import (
     parse_packages_file,
     reload_targets,
     reload_versions,
+    resolve_build_dir,
 )
 
 logging.basicConfig(encoding="utf-8", level=settings.log_level)
@@ -30,6 +33,7 @@ base_path = Path(__file__).resolve().parent
 app = FastAPI()
 app.include_router(api.router, prefix="/api/v1")
 app.include_router(stats.router, prefix="/api/v1")
+app.include_router(metrics.router)
 
 (settings.public_path / "store").mkdir(parents=True, exist_ok=True)
 
@@ -47,16 +51,64 @@ app.profiles = defaultdict(lambda: defaultdict(dict))
 
 
 @app.api_route("/store/{path:path}", methods=["GET", "HEAD"])
-def store(path: str):
-    path = (settings.public_path / "store" / path).resolve()
+def store(request: Request, path: str):
+    # Artifacts may link into the blob store, keep the requested name.
+    filename = Path(path).name
+    parts = Path(path).parts
+    is_blob = parts[:1] == ("blobs",)
+    requested = settings.public_path / "store" / path
+    request_hash = ""
+    if len(parts) == 4 and not is_blob:
+        request_hash = parts[2]
+    elif len(parts) == 2 and not is_blob:
+        # Builds used to be stored directly below the store, see `get_build_path`.
+        request_hash = parts[0]
+        requested = resolve_build_dir(request_hash) / filename
+
+    path = requested.resolve()
     if not path.is_file() or settings.public_path / "store" not in path.parents:
         raise HTTPException(status_code=404, detail="Not found")
 
+    # Downloads keep builds from being garbage collected.
+    if request_hash:
+        touch_build(request_hash)
+
+    headers = {"X-Content-Type-Options": "nosniff"}
+    if is_blob:
+        # Blobs are addressed by their content and never change.
+        headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    else:
+        # Build paths are addressed by the request hash, not by the content.
+        # Snapshots are rebuilt below the same path once expired, so caches
+        # must revalidate the ETag instead of treating them as immutable.
+        headers["Cache-Control"] = "no-cache"
+
+    if sha256 := get_artifact_checksum(requested):
+        headers["ETag"] = f'"{sha256}"'
+        if_none_match = request.headers.get("If-None-Match", "")
+        if headers["ETag"] in [
+            tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+        ]:
+            return Response(status_code=304, headers=headers)
+
+    # Let the web server send the file, ranges included.
+    if settings.store_offload in ("x-accel-redirect", "x-sendfile"):
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+        if settings.store_offload == "x-sendfile":
+            headers["X-Sendfile"] = str(path)
+        else:
+            relative_path = path.relative_to(settings.public_path / "store")
+            headers["X-Accel-Redirect"] = (
+                f"{settings.store_offload_prefix}/{quote(str(relative_path))}"
+            )
+        return Response(media_type="application/octet-stream", headers=headers)
+
+    # Supports range requests to resume downloads.
     return FileResponse(
         path,
         media_type="application/octet-stream",
-        filename=path.name,  # adds Content-Disposition: attachment; filename="..."
-        headers={"X-Content-Type-Options": "nosniff"},
+        filename=filename,  # adds Content-Disposition: attachment; filename="..."
+        headers=headers,
     )
 
 
@@ -0,0 +1,236 @@
+import logging
+import shutil
+from email.parser import Parser
+from os import link
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from time import time
+
+from rq.utils import parse_timeout
+
+from asu.config import settings
+from asu.util import client_get, get_file_hash, get_redis_client
+
+log = logging.getLogger("rq.worker")
+
+
+def _cache_prefix() -> str:
+    """Return the Redis key prefix of the package cache
+
+    The index and size are kept per cache directory, so workers sharing the
+    directory, like the default below `public_path`, share the size limit and
+    the eviction of packages.
+    """
+    return f"package-cache:{get_cache_path()}"
+
+
+def get_cache_path() -> Path:
+    """Return the location of the package cache
+
+    Defaults to `public_path`, which is a host path bind-mounted into workers
+    and therefore also valid as mount source for build containers.
+    """
+    return settings.package_cache_path or settings.public_path / "package-cache"
+
+
+def get_blob_path(sha256: str) -> Path:
+    """Return the location of a cached package
+
+    Args:
+        sha256 (str): sha256sum of the package
+
+    Returns:
+        Path: Location of the package within the cache
+    """
+    return get_cache_path() / "blobs" / sha256[:2] / sha256
+
+
+def get_download_dir(request_hash: str) -> Path:
+    """Return the download directory mounted into the build of a request"""
+    return get_cache_path() / "builds" / request_hash
+
+
+def get_feed_urls(repositories_conf: str) -> list[str]:
+    """Return the remote feeds of an ImageBuilder `repositories.conf`
+
+    Args:
+        repositories_conf (str): Content of the `repositories.conf`
+
+    Returns:
+        list: URLs of all `src/gz` feeds
+    """
+    return [
+        line.split()[2]
+        for line in repositories_conf.splitlines()
+        if line.startswith("src/gz ") and len(line.split()) == 3
+    ]
+
+
+def get_feed_index(url: str, ttl: str) -> dict[str, str]:
+    """Return the packages of an opkg feed with their file name and checksum
+
+    The index is cached in Redis for `ttl`. Feeds without `Packages` index,
+    like apk based feeds, are treated as empty.
+
+    Args:
+        url (str): URL of the feed
+        ttl (str): Time to cache the index
+
+    Returns:
+        dict: `<package>=<version>` as key and `<filename> <sha256sum>` as value
+    """
+    redis = get_redis_client()
+    key: str = f"package-index:{url}"
+    if index := redis.hgetall(key):
+        index.pop("", None)
+        return index
+
+    index = {}
+    response = client_get(f"{url}/Packages")
+    if response.status_code == 200:
+        parser: Parser = Parser()
+        for chunk in response.text.strip().split("\n\n"):
+            package = parser.parsestr(chunk, headersonly=True)
+            if not package["Filename"] or not package["SHA256sum"]:
+                continue
+
+            package_name: str = package["Package"]
+            if package_abi := package.get("ABIVersion"):
+                package_name = package_name.removesuffix(package_abi)
+
+            index[f"{package_name}={package['Version']}"] = (
+                f"{Path(package['Filename']).name} {package['SHA256sum']}"
+            )
+    else:
+        log.debug(f"No opkg index for {url}")
+
+    # An empty field marks feeds without index, so they aren't requested again.
+    redis.hset(key, mapping={**index, "": ""})
+    redis.expire(key, parse_timeout(ttl))
+    return index
+
+
+def get_package_files(
+    manifest: dict[str, str], feeds: list[str], ttl: str
+) -> dict[str, str]:
+    """Return the files of the packages of a manifest
+
+    Args:
+        manifest (dict): Packages and versions of a build
+        feeds (list): URLs of the feeds used by the build
+        ttl (str): Time to cache feed indexes
+
+    Returns:
+        dict: File names and their sha256sum
+    """
+    index: dict[str, str] = {}
+    for url in reversed(feeds):
+        index.update(get_feed_index(url, ttl))
+
+    files: dict[str, str] = {}
+    for package, version in manifest.items():
+        if entry := index.get(f"{package}={version}"):
+            filename, sha256 = entry.split()
+            files[filename] = sha256
+    return files
+
+
+def populate_download_dir(download_dir: Path, files: dict[str, str]) -> list[str]:
+    """Link cached packages into the download directory of a build
+
+    Args:
+        download_dir (Path): Download directory mounted into the container
+        files (dict): File names and sha256sums of the required packages
+
+    Returns:
+        list: Names of the linked files
+    """
+    redis = get_redis_client()
+    prefix = _cache_prefix()
+    linked: list[str] = []
+    for filename, sha256 in files.items():
+        blob = get_blob_path(sha256)
+        if not blob.is_file():
+            continue
+        (download_dir / filename).unlink(missing_ok=True)
+        try:
+            link(blob, download_dir / filename)
+        except FileNotFoundError:
+            # Evicted by another build in the meantime, let opkg download it.
+            continue
+        redis.zadd(f"{prefix}:lru", {sha256: time()})
+        linked.append(filename)
+
+    log.info(f"Linked {len(linked)} of {len(files)} packages from cache")
+    return linked
+
+
+def store_downloads(download_dir: Path, files: dict[str, str]) -> int:
+    """Add packages downloaded by a build to the cache
+
+    Only packages matching the checksum of the feed index are stored.
+
+    Args:
+        download_dir (Path): Download directory mounted into the container
+        files (dict): File names and sha256sums of the required packages
+
+    Returns:
+        int: Number of added packages
+    """
+    redis = get_redis_client()
+    prefix = _cache_prefix()
+    stored: int = 0
+    for filename, sha256 in files.items():
+        path = download_dir / filename
+        blob = get_blob_path(sha256)
+        if blob.is_file() or not path.is_file():
+            continue
+
+        if get_file_hash(path) != sha256:
+            log.warning(f"Checksum mismatch of downloaded {filename}")
+            continue
+
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        # Downloads are owned by the container user, copy them to own them.
+        with (
+            path.open("rb") as download,
+            NamedTemporaryFile(dir=blob.parent, delete=False) as tmp_file,
+        ):
+            shutil.copyfileobj(download, tmp_file)
+        Path(tmp_file.name).chmod(0o644)
+        Path(tmp_file.name).replace(blob)
+
+        size: int = blob.stat().st_size
+        redis.zadd(f"{prefix}:lru", {sha256: time()})
+        # Builds storing the same package concurrently only count it once.
+        if redis.hsetnx(f"{prefix}:sizes", sha256, size):
+            redis.incrby(f"{prefix}:size", size)
+            stored += 1
+
+    return stored
+
+
+def evict_packages() -> int:
+    """Remove least recently used packages until the cache fits its limit
+
+    Returns:
+        int: Number of removed packages
+    """
+    redis = get_redis_client()
+    prefix = _cache_prefix()
+    limit: int = settings.package_cache_size_mb * 1024 * 1024
+    evicted: int = 0
+    while int(redis.get(f"{prefix}:size") or 0) > limit:
+        oldest = redis.zpopmin(f"{prefix}:lru")
+        if not oldest:
+            break
+        sha256: str = oldest[0][0]
+        size: int = int(redis.hget(f"{prefix}:sizes", sha256) or 0)
+        redis.hdel(f"{prefix}:sizes", sha256)
+        redis.decrby(f"{prefix}:size", size)
+        get_blob_path(sha256).unlink(missing_ok=True)
+        evicted += 1
+
+    if evicted:
+        log.info(f"Evicted {evicted} packages from cache")
+    return evicted
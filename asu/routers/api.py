@@ -1,23 +1,61 @@
+import gzip
+import json
 import logging
-from typing import Union
+import re
+from pathlib import Path
+from typing import AsyncIterator, Optional, Union
 
 from fastapi import APIRouter, Header, Request
-from fastapi.responses import RedirectResponse, Response
-from rq.job import Job
-
-from asu.build import build
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import (
+    JSONResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
+from rq import Queue
+from rq.job import Job, JobStatus
+from rq.results import Result
+from rq.queue import EnqueueData
+from rq.utils import parse_timeout
+
+from asu.build import (
+    build,
+    build_manifest,
+    get_manifest_failure_key,
+    get_manifest_key,
+)
 from asu.build_request import BuildRequest
 from asu.config import settings
+from asu.store import restore_build, touch_build
 from asu.util import (
     add_timestamp,
     add_build_event,
     client_get,
+    get_affinity_queue_name,
     get_branch,
+    get_build_result,
+    get_imagebuilder_image,
+    get_imagebuilder_info,
+    get_job,
+    get_job_details,
+    get_jobs,
+    get_log_path,
+    get_manifest,
+    get_manifest_failure,
     get_queue,
+    get_queue_length,
+    get_queue_lengths,
+    get_queue_name,
     get_request_hash,
+    is_snapshot_build,
+    promote_job,
+    read_log_stream,
     reload_profiles,
     reload_targets,
     reload_versions,
+    wait_for_status,
 )
 
 router = APIRouter()
@@ -138,19 +176,45 @@ def validate_request(
     build_request.profile = app.profiles[build_request.version][build_request.target][
         build_request.profile
     ]
+
+    image_digest, info = get_imagebuilder_info(get_imagebuilder_image(build_request))
+    if requested := build_request.version_code:
+        if info and info["revision"] != requested:
+            return validation_failure(
+                f"Received incorrect version {info['revision']} (requested {requested})"
+            )
+
+    # Only the digest of release ImageBuilders is known before a build.
+    if image_digest and not is_snapshot_build(build_request.version):
+        if failure := get_manifest_failure(
+            get_manifest_failure_key(build_request, image_digest)
+        ):
+            content, status = validation_failure(f"Error: {failure['detail']}")
+            content.update(packages=failure["packages"], stderr=failure["stderr"])
+            return content, status
+
     return ({}, None)
 
 
-def return_job_v1(job: Job) -> tuple[dict, int, dict]:
-    response: dict = job.get_meta()
-    imagebuilder_status: str = "done"
-    queue_position: int = 0
+def return_job_v1(
+    job: Job, details: Optional[tuple[Optional[Result], int]] = None
+) -> tuple[dict, int, dict]:
+    """Return the response of a build job
 
-    if job.meta:
-        response.update(job.meta)
+    The status and meta of the job are used as fetched.
 
-    if job.is_failed:
-        error_message: str = job.latest_result().exc_string
+    Args:
+        job (Job): The build job
+        details (tuple): Latest result and queue position of the job, see
+            `get_job_details`, read from Redis if not given
+    """
+    result, queue_position = details or get_job_details([job])[0]
+    response: dict = dict(job.meta)
+    imagebuilder_status: str = "done"
+    status: JobStatus = job.get_status(refresh=False)
+
+    if status == JobStatus.FAILED:
+        error_message: str = result.exc_string if result else ""
         if "stderr" in response:
             error_message = response["stderr"] + "\n" + error_message
         detail: str = response.get("detail", "failed")
@@ -159,17 +223,17 @@ def return_job_v1(job: Job) -> tuple[dict, int, dict]:
         response.update(status=500, detail=detail, stderr=error_message)
         imagebuilder_status = "failed"
 
-    elif job.is_queued:
-        queue_position = job.get_position() or 0
+    elif status == JobStatus.QUEUED:
         response.update(status=202, detail="queued", queue_position=queue_position)
         imagebuilder_status = "queued"
 
-    elif job.is_started:
+    elif status == JobStatus.STARTED:
         response.update(status=202, detail="started")
         imagebuilder_status = response.get("imagebuilder_status", "init")
 
-    elif job.is_finished:
-        response.update(status=200, **job.return_value())
+    elif status == JobStatus.FINISHED:
+        return_value: Optional[dict] = result.return_value if result else None
+        response.update(status=200, **get_build_result(return_value or {}))
         imagebuilder_status = "done"
 
     headers = {
@@ -183,25 +247,164 @@ def return_job_v1(job: Job) -> tuple[dict, int, dict]:
     return response, response["status"], headers
 
 
+def get_client(build_request: BuildRequest, user_agent: Optional[str]) -> str:
+    """Return the client of a request, e.g. `luci/git-24.10`"""
+    if build_request.client:
+        return build_request.client
+    elif user_agent and user_agent.startswith("auc"):
+        return user_agent.replace(" (", "/").replace(")", "")
+    else:
+        return "unknown/0"
+
+
+def get_result_ttl(build_request: BuildRequest) -> str:
+    """Return how long the result of a request is kept"""
+    if build_request.defaults:
+        return settings.build_defaults_ttl
+    return settings.build_ttl
+
+
+def batch_too_large(response: Response, count: int) -> Optional[dict]:
+    if count <= settings.max_batch_requests:
+        return None
+
+    response.status_code = 413
+    return {
+        "status": 413,
+        "title": "Batch too large",
+        "detail": f"batch contains {count} requests, the maximum is {settings.max_batch_requests}",
+    }
+
+
+def get_build_status(request_hash: str) -> tuple[dict, int, dict]:
+    job: Job = get_job(request_hash)
+    if not job:
+        return (
+            {
+                "status": 404,
+                "title": "Not Found",
+                "detail": "could not find provided request hash",
+            },
+            404,
+            {},
+        )
+
+    return return_job_v1(job)
+
+
 @router.head("/build/{request_hash}")
 @router.get("/build/{request_hash}")
-def api_v1_build_get(request: Request, request_hash: str, response: Response) -> dict:
-    job: Job = get_queue().fetch_job(request_hash)
-    if not job:
-        response.status_code = 404
-        return {
-            "status": 404,
-            "title": "Not Found",
-            "detail": "could not find provided request hash",
-        }
+async def api_v1_build_get(
+    request: Request, request_hash: str, response: Response, wait: float = 0
+) -> dict:
+    """Return the status of a build
 
-    content, status, headers = return_job_v1(job)
+    Args:
+        wait: Seconds to wait for a status change of a queued or running
+            build before responding, at most `max_status_wait`
+    """
+    if wait > 0:
+        await wait_for_status(request_hash, min(wait, settings.max_status_wait))
+
+    content, status, headers = await run_in_threadpool(get_build_status, request_hash)
     response.headers.update(headers)
     response.status_code = status
 
     return content
 
 
+@router.get("/build/{request_hash}/events")
+async def api_v1_build_events_get(request_hash: str) -> StreamingResponse:
+    """Push the status of a build as Server-Sent Events until it's done
+
+    A `status` event with the content of `/api/v1/build/{request_hash}` is
+    sent on every status change, or after `max_status_wait` without change.
+    """
+
+    async def events() -> AsyncIterator[str]:
+        while True:
+            content, status, _ = await run_in_threadpool(get_build_status, request_hash)
+            yield f"event: status\ndata: {json.dumps(jsonable_encoder(content))}\n\n"
+            if status != 202:
+                return
+            await wait_for_status(request_hash, settings.max_status_wait)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def stream_build_log(request_hash: str, last_event_id: str) -> AsyncIterator[str]:
+    """Format the live build log as Server-Sent Events
+
+    Every line is sent as `stdout` or `stderr` event, an `end` event with the
+    final build status closes the stream. Carriage returns of progress bars
+    would end the `data` field, so every part is sent as own `data` line.
+    """
+    async for entry_id, fields in read_log_stream(request_hash, last_event_id):
+        if entry_id:
+            data: str = "".join(
+                f"data: {part}\n" for part in re.split(r"\r\n|\r|\n", fields["line"])
+            )
+            yield f"id: {entry_id}\nevent: {fields['stream']}\n{data}\n"
+        else:
+            yield ": keep-alive\n\n"
+
+    job: Optional[Job] = await run_in_threadpool(get_job, request_hash)
+    status: str = await run_in_threadpool(job.get_status) if job else "unknown"
+    yield f"event: end\ndata: {status}\n\n"
+
+
+@router.get("/build/{request_hash}/log")
+def api_v1_build_log_get(
+    request_hash: str,
+    tail: int = 0,
+    accept: str = Header(""),
+    accept_encoding: str = Header(""),
+    last_event_id: str = Header("0"),
+):
+    """Return the log of the commands run by a build
+
+    Clients accepting `text/event-stream` receive the output of running
+    builds line by line as Server-Sent Events. Otherwise the log of the
+    store is returned, compressed if the client accepts `gzip`.
+
+    Args:
+        tail: Only return the last lines of the log
+    """
+    if "text/event-stream" in accept:
+        return StreamingResponse(
+            stream_build_log(request_hash, last_event_id),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    log_path: Path = get_log_path(request_hash)
+    if not request_hash.isalnum() or not log_path.is_file():
+        return JSONResponse(
+            {
+                "status": 404,
+                "title": "Not Found",
+                "detail": "could not find a build log of provided request hash",
+            },
+            status_code=404,
+        )
+
+    content: bytes = log_path.read_bytes()
+    if tail > 0:
+        content = b"".join(content.splitlines(keepends=True)[-tail:])
+
+    # The representation depends on both headers, keep caches from mixing them.
+    headers: dict[str, str] = {"Vary": "Accept, Accept-Encoding"}
+    if "gzip" in accept_encoding:
+        content = gzip.compress(content)
+        headers["Content-Encoding"] = "gzip"
+
+    return Response(content, media_type="text/plain", headers=headers)
+
+
 @router.post("/build")
 def api_v1_build_post(
     build_request: BuildRequest,
@@ -215,25 +418,19 @@ def api_v1_build_post(
     add_build_event("requests")
 
     request_hash: str = get_request_hash(build_request)
-    job: Job = get_queue().fetch_job(request_hash)
+    job: Job = get_job(request_hash) or restore_build(
+        request_hash, build_request, get_result_ttl(build_request)
+    )
     status: int = 200
-    result_ttl: str = settings.build_ttl
-    if build_request.defaults:
-        result_ttl = settings.build_defaults_ttl
-    failure_ttl: str = settings.build_failure_ttl
-
-    if build_request.client:
-        client = build_request.client
-    elif user_agent.startswith("auc"):
-        client = user_agent.replace(" (", "/").replace(")", "")
-    else:
-        client = "unknown/0"
 
+    client: str = get_client(build_request, user_agent)
     add_timestamp(
         f"stats:clients:{client}",
         {"stats": "clients", "client": client},
     )
 
+    queue_name: str = get_queue_name(build_request, client)
+
     if job is None:
         add_build_event("cache-misses")
 
@@ -242,7 +439,7 @@ def api_v1_build_post(
             response.status_code = status
             return content
 
-        job_queue_length = len(get_queue())
+        job_queue_length: int = get_queue_length(queue_name)
         if job_queue_length > settings.max_pending_jobs:
             response.status_code = 529
             return {
@@ -251,17 +448,81 @@ def api_v1_build_post(
                 "detail": f"server overload, queue contains too many build requests: {job_queue_length}",
             }
 
-        job = get_queue().enqueue(
+        queue: Queue = get_queue(get_affinity_queue_name(queue_name, build_request))
+        job = queue.enqueue(
             build,
             build_request,
             job_id=request_hash,
-            result_ttl=result_ttl,
-            failure_ttl=failure_ttl,
+            result_ttl=get_result_ttl(build_request),
+            failure_ttl=settings.build_failure_ttl,
             job_timeout=settings.job_timeout,
         )
     else:
         if job.is_finished:
             add_build_event("cache-hits")
+            touch_build(request_hash)
+        elif job.is_queued and job.origin == "prebuild":
+            promote_job(job, get_affinity_queue_name(queue_name, build_request))
+
+    content, status, headers = return_job_v1(job)
+    response.headers.update(headers)
+    response.status_code = status
+
+    return content
+
+
+@router.post("/manifest")
+def api_v1_manifest_post(
+    build_request: BuildRequest,
+    response: Response,
+    request: Request,
+    user_agent: str = Header(None),
+):
+    """Resolve the manifest of a request without building any images
+
+    The ImageBuilder only runs `make manifest`. Manifests are cached per
+    ImageBuilder, profile and package selection, so cached manifests of
+    releases are returned right away. Otherwise the returned `request_hash`
+    can be polled via `/api/v1/build/{request_hash}`.
+    """
+    build_request.profile = build_request.profile.replace(",", "_")
+
+    request_hash: str = f"manifest-{get_request_hash(build_request)}"
+    job: Job = get_job(request_hash)
+
+    if job is None:
+        content, status = validate_request(request.app, build_request)
+        if content:
+            response.status_code = status
+            return content
+
+        # Only the digest of release ImageBuilders is known before a build.
+        image_digest, _ = get_imagebuilder_info(get_imagebuilder_image(build_request))
+        if image_digest and not is_snapshot_build(build_request.version):
+            if manifest := get_manifest(get_manifest_key(build_request, image_digest)):
+                return {**manifest, "status": 200, "request_hash": request_hash}
+
+        queue_name: str = get_queue_name(
+            build_request, get_client(build_request, user_agent)
+        )
+        job_queue_length: int = get_queue_length(queue_name)
+        if job_queue_length > settings.max_pending_jobs:
+            response.status_code = 529
+            return {
+                "status": 529,  # "Site is overloaded"
+                "title": "Server overloaded",
+                "detail": f"server overload, queue contains too many build requests: {job_queue_length}",
+            }
+
+        queue: Queue = get_queue(get_affinity_queue_name(queue_name, build_request))
+        job = queue.enqueue(
+            build_manifest,
+            build_request,
+            job_id=request_hash,
+            result_ttl=settings.manifest_ttl,
+            failure_ttl=settings.build_failure_ttl,
+            job_timeout=settings.job_timeout,
+        )
 
     content, status, headers = return_job_v1(job)
     response.headers.update(headers)
@@ -275,8 +536,153 @@ def api_v1_builder_stats():
     """Return status of builders
 
     Returns:
-        queue_length: Number of jobs currently in build queue
+        queue_length: Number of jobs currently in all build queues
+        queues: Number of jobs of every build queue
     """
+    queues: dict[str, int] = get_queue_lengths()
     return {
-        "queue_length": len(get_queue()),
+        "queue_length": sum(queues.values()),
+        "queues": queues,
     }
+
+
+@router.post("/build/batch")
+def api_v1_build_batch_post(
+    build_requests: list[BuildRequest],
+    response: Response,
+    request: Request,
+    user_agent: str = Header(None),
+) -> Union[list[dict], dict]:
+    """Request many builds at once, e.g. to upgrade a fleet of devices
+
+    Identical requests are built only once. Requests which are neither cached
+    nor queued are validated and enqueued within a single Redis pipeline.
+
+    Returns:
+        list: Status of every request, in the order of the requests
+    """
+    if error := batch_too_large(response, len(build_requests)):
+        return error
+
+    request_hashes: list[str] = []
+    for build_request in build_requests:
+        build_request.profile = build_request.profile.replace(",", "_")
+        request_hashes.append(get_request_hash(build_request))
+
+    # Existing jobs of all requests are fetched in a single round trip.
+    unique_hashes: list[str] = list(dict.fromkeys(request_hashes))
+    existing_jobs: dict[str, Optional[Job]] = dict(
+        zip(unique_hashes, get_jobs(unique_hashes))
+    )
+
+    builds: dict[str, Union[Job, dict]] = {}
+    job_datas: dict[str, list[EnqueueData]] = {}
+    queue_lengths: dict[str, int] = {}
+
+    for build_request, request_hash in zip(build_requests, request_hashes):
+        add_build_event("requests")
+        if request_hash in builds:
+            continue
+
+        client: str = get_client(build_request, user_agent)
+        add_timestamp(
+            f"stats:clients:{client}",
+            {"stats": "clients", "client": client},
+        )
+        queue_name: str = get_queue_name(build_request, client, batch=True)
+
+        if job := existing_jobs[request_hash] or restore_build(
+            request_hash, build_request, get_result_ttl(build_request)
+        ):
+            status: JobStatus = job.get_status(refresh=False)
+            if status == JobStatus.FINISHED:
+                add_build_event("cache-hits")
+                touch_build(request_hash)
+            elif status == JobStatus.QUEUED and job.origin == "prebuild":
+                promote_job(job, get_affinity_queue_name(queue_name, build_request))
+            builds[request_hash] = job
+            continue
+
+        add_build_event("cache-misses")
+
+        content, status = validate_request(request.app, build_request)
+        if content:
+            builds[request_hash] = content
+            continue
+
+        if queue_name not in queue_lengths:
+            queue_lengths[queue_name] = get_queue_length(queue_name)
+        if queue_lengths[queue_name] > settings.max_pending_jobs:
+            builds[request_hash] = {
+                "status": 529,  # "Site is overloaded"
+                "title": "Server overloaded",
+                "detail": f"server overload, queue contains too many build requests: {queue_lengths[queue_name]}",
+            }
+            continue
+        queue_lengths[queue_name] += 1
+
+        builds[request_hash] = {}
+        job_datas.setdefault(
+            get_affinity_queue_name(queue_name, build_request), []
+        ).append(
+            Queue.prepare_data(
+                build,
+                (build_request,),
+                job_id=request_hash,
+                result_ttl=parse_timeout(get_result_ttl(build_request)),
+                failure_ttl=parse_timeout(settings.build_failure_ttl),
+                timeout=parse_timeout(settings.job_timeout),
+            )
+        )
+
+    if job_datas:
+        pipeline = get_queue().connection.pipeline()
+        for queue_name, queue_job_datas in job_datas.items():
+            for job in get_queue(queue_name).enqueue_many(
+                queue_job_datas, pipeline=pipeline
+            ):
+                builds[job.id] = job
+        pipeline.execute()
+
+    jobs: list[Job] = [job for job in builds.values() if isinstance(job, Job)]
+    details = dict(zip([job.id for job in jobs], get_job_details(jobs)))
+
+    contents: dict[str, dict] = {}
+    for request_hash, job in builds.items():
+        if isinstance(job, Job):
+            contents[request_hash] = return_job_v1(job, details[job.id])[0]
+        else:
+            contents[request_hash] = {**job, "request_hash": request_hash}
+
+    return [contents[request_hash] for request_hash in request_hashes]
+
+
+@router.post("/build/status")
+def api_v1_build_status_post(
+    request_hashes: list[str], response: Response
+) -> Union[list[dict], dict]:
+    """Return the status of many builds, e.g. of a batch
+
+    Returns:
+        list: Status of every build, in the order of the request hashes
+    """
+    if error := batch_too_large(response, len(request_hashes)):
+        return error
+
+    jobs: list[Optional[Job]] = get_jobs(request_hashes)
+    details = iter(get_job_details([job for job in jobs if job]))
+
+    contents: list[dict] = []
+    for request_hash, job in zip(request_hashes, jobs):
+        if job:
+            contents.append(return_job_v1(job, next(details))[0])
+        else:
+            contents.append(
+                {
+                    "status": 404,
+                    "title": "Not Found",
+                    "detail": "could not find provided request hash",
+                    "request_hash": request_hash,
+                }
+            )
+    return contents
@@ -0,0 +1,106 @@
+from re import search
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from rq import Worker
+
+from asu.store import get_store_usage
+from asu.util import get_queue_lengths, get_redis_client
+
+router = APIRouter()
+
+METRICS: dict[str, tuple[str, str]] = {
+    "builds_total": (
+        "counter",
+        "Successful builds by version, target, profile and origin",
+    ),
+    "build_events_total": ("counter", "Build requests, cache hits and outcomes"),
+    "cache_hits": ("counter", "Build requests served from the cache"),
+    "cache_misses": ("counter", "Build requests sent to a worker"),
+    "build_phase_duration_seconds": ("histogram", "Duration of build phases"),
+    "upstream_request_duration_seconds": (
+        "histogram",
+        "Latency of requests to the upstream server",
+    ),
+    "queue_length": ("gauge", "Number of queued build jobs"),
+    "worker_busy": ("gauge", "Whether a worker is running a job"),
+    "store_blobs": ("gauge", "Number of unique artifacts in the store"),
+    "store_size_bytes": ("gauge", "Size of unique artifacts in the store"),
+    "store_gc_removed_total": ("counter", "Builds removed from the store"),
+    "store_gc_reclaimed_bytes_total": (
+        "counter",
+        "Bytes reclaimed by removing builds from the store",
+    ),
+}
+
+
+def get_family(field: str) -> str:
+    """Return the metric family of a sample, e.g. `x` for `x_bucket{le="1"}`"""
+    name = field.split("{", 1)[0]
+    for suffix in "_bucket", "_sum", "_count":
+        if name.endswith(suffix) and name.removesuffix(suffix) in METRICS:
+            return name.removesuffix(suffix)
+    return name
+
+
+def get_sort_key(field: str) -> tuple[str, float]:
+    """Order samples by name and labels, buckets by their numeric `le`"""
+    if bound := search(r'[{,]le="([^"]*)"', field):
+        return field[: bound.start() + 1] + field[bound.end() :], float(bound.group(1))
+    return field, 0
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else str(value)
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def metrics() -> str:
+    """Prometheus text exposition of the aggregated server metrics
+
+    Counters and histograms are read from two Redis hashes updated on every
+    event, gauges are read from the queue, the workers and the store index.
+    """
+    redis = get_redis_client()
+    samples: dict[str, float] = {}
+
+    samples.update(redis.hgetall("metrics:counters"))
+    samples.update(redis.hgetall("metrics:histograms"))
+
+    # Names used by misc/grafana.json
+    for event, name in ("cache-hits", "cache_hits"), ("cache-misses", "cache_misses"):
+        samples[name] = samples.get(f'build_events_total{{event="{event}"}}', 0)
+
+    for name, length in get_queue_lengths().items():
+        samples[f'queue_length{{queue="{name}"}}'] = length
+
+    # Read the state of all workers in one round trip instead of one per worker.
+    worker_keys: list[str] = Worker.all_keys(connection=get_redis_client(False))
+    pipeline = redis.pipeline()
+    for key in worker_keys:
+        pipeline.hget(key, "state")
+    for key, state in zip(worker_keys, pipeline.execute()):
+        if state is None:
+            # Registered workers whose key expired are dead.
+            continue
+        name: str = key.removeprefix(Worker.redis_worker_namespace_prefix)
+        samples[f'worker_busy{{worker="{name}"}}'] = int(state == "busy")
+
+    usage = get_store_usage()
+    samples["store_blobs"] = usage["blobs"]
+    samples["store_size_bytes"] = usage["size"]
+
+    families: dict[str, list[str]] = {}
+    for field, value in sorted(samples.items(), key=lambda item: get_sort_key(item[0])):
+        families.setdefault(get_family(field), []).append(
+            f"{field} {format_value(float(value))}"
+        )
+
+    lines: list[str] = []
+    for family, family_samples in families.items():
+        metric_type, metric_help = METRICS.get(family, ("untyped", family))
+        lines.append(f"# HELP {family} {metric_help}")
+        lines.append(f"# TYPE {family} {metric_type}")
+        lines.extend(family_samples)
+
+    return "\n".join(lines) + "\n"
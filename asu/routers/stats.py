@@ -120,3 +120,44 @@ def get_builds_by_version(branch: str = None) -> dict():
             for version in sorted(bucket)
         ],
     }
+
+
+@router.get("/build-phases")
+def get_build_phases(target: str = None) -> dict:
+    """Average duration in seconds of every build phase by target over the
+    last 30 days. If 'target' is given, only that target is returned."""
+
+    start, stop, _, _ = start_stop(N_DAYS, DAY_MS)
+
+    filters = ["stats=phase"]
+    if target:
+        filters.append(f"target={target}")
+
+    range_options = dict(
+        filters=filters,
+        with_labels=True,
+        from_time=start,
+        to_time=stop,
+        align=start,
+        bucket_size_msec=stop - start,
+    )
+
+    totals = {}
+    for aggregation_type in "sum", "count":
+        result = get_redis_ts().mrange(
+            aggregation_type=aggregation_type, **range_options
+        )
+        for row in result:
+            for labels, data in row.values():
+                key = (labels["target"], labels["phase"])
+                totals.setdefault(key, {"sum": 0.0, "count": 0.0})
+                totals[key][aggregation_type] += sum(value for _, value in data)
+
+    phases = {}
+    for (phase_target, phase), total in sorted(totals.items()):
+        if total["count"]:
+            phases.setdefault(phase_target, {})[phase] = round(
+                total["sum"] / total["count"], 3
+            )
+
+    return phases
@@ -0,0 +1,250 @@
+import base64
+import hashlib
+import logging
+import struct
+import zlib
+from collections.abc import Iterator
+from os import replace
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+
+import nacl.bindings
+import nacl.signing
+
+log = logging.getLogger("rq.worker")
+
+# See package/system/fwtool/src/fwimage.h of OpenWrt
+FWIMAGE_MAGIC: int = 0x46577830
+FWIMAGE_SIGNATURE: int = 0
+FWIMAGE_TRAILER: struct.Struct = struct.Struct("!IIB3xI")
+FWIMAGE_SIGNATURE_MAXLEN: int = 1024
+
+# See ucert.c, a certificate is a blob containing a signature and a payload
+CERT_ATTR_SIGNATURE: int = 0
+
+# Images are read in chunks of this size instead of loading them at once
+CHUNK_SIZE: int = 1024 * 1024
+
+
+def write_file_atomic(path: Path, content: bytes) -> str:
+    """Replace `path` with `content` and return its sha256sum
+
+    The file is replaced instead of modified, which also works for files
+    written by the container user into the store.
+
+    Args:
+        path (Path): file to write
+        content (bytes): new content of the file
+
+    Returns:
+        str: hash of content
+    """
+    with NamedTemporaryFile(dir=path.parent, prefix=".", delete=False) as tmp_file:
+        tmp_file.write(content)
+    Path(tmp_file.name).chmod(0o644)
+    replace(tmp_file.name, path)
+    return hashlib.sha256(content).hexdigest()
+
+
+def _parse_secret_key(secret_key: str) -> tuple[bytes, bytes]:
+    """Return the fingerprint and the Ed25519 secret key of a usign key"""
+    (
+        _pkalg,
+        _kdfalg,
+        kdfrounds,
+        _salt,
+        _checksum,
+        fingerprint,
+        seckey,
+    ) = struct.unpack("!2s2sI16s8s8s64s", base64.b64decode(secret_key.splitlines()[-1]))
+
+    if kdfrounds:
+        raise ValueError("Password protected usign keys are not supported")
+
+    return fingerprint, seckey
+
+
+def _format_signature(fingerprint: bytes, signature: bytes) -> str:
+    return "untrusted comment: signed by key {}\n{}\n".format(
+        fingerprint.hex(),
+        base64.b64encode(b"Ed" + fingerprint + signature).decode(),
+    )
+
+
+def usign_sign(message: bytes, secret_key: str) -> str:
+    """Create a usign/signify signature, same as `usign -S`
+
+    Args:
+        message (bytes): message to sign
+        secret_key (str): content of an unencrypted usign secret key file
+
+    Returns:
+        str: content of the signature file
+    """
+    fingerprint, seckey = _parse_secret_key(secret_key)
+    signature = nacl.signing.SigningKey(seckey[:32]).sign(message).signature
+    return _format_signature(fingerprint, signature)
+
+
+def _read_chunks(path: Path, length: int) -> Iterator[bytes]:
+    """Yield the first `length` bytes of a file in chunks of `CHUNK_SIZE`"""
+    with path.open("rb") as content:
+        while length > 0:
+            chunk = content.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def ed25519_sign_file(path: Path, length: int, seckey: bytes) -> bytes:
+    """Return the Ed25519 signature of the first `length` bytes of a file
+
+    The result is the same as of `nacl.signing.SigningKey.sign`, which needs
+    the whole message in memory. Instead the file is hashed twice in chunks,
+    once for the nonce and once for the challenge, see RFC 8032 5.1.6.
+
+    Args:
+        path (Path): file to sign
+        length (int): number of bytes to sign
+        seckey (bytes): seed and public key, as stored in usign keys
+
+    Returns:
+        bytes: the 64 byte signature
+    """
+    digest: bytes = hashlib.sha512(seckey[:32]).digest()
+    scalar = bytearray(digest[:32])
+    scalar[0] &= 248
+    scalar[31] &= 127
+    scalar[31] |= 64
+    scalar = nacl.bindings.crypto_core_ed25519_scalar_reduce(bytes(scalar) + bytes(32))
+
+    nonce_hash = hashlib.sha512(digest[32:])
+    for chunk in _read_chunks(path, length):
+        nonce_hash.update(chunk)
+    nonce: bytes = nacl.bindings.crypto_core_ed25519_scalar_reduce(nonce_hash.digest())
+    point: bytes = nacl.bindings.crypto_scalarmult_ed25519_base_noclamp(nonce)
+
+    challenge_hash = hashlib.sha512(point + seckey[32:])
+    for chunk in _read_chunks(path, length):
+        challenge_hash.update(chunk)
+    challenge: bytes = nacl.bindings.crypto_core_ed25519_scalar_reduce(
+        challenge_hash.digest()
+    )
+
+    return point + nacl.bindings.crypto_core_ed25519_scalar_add(
+        nonce, nacl.bindings.crypto_core_ed25519_scalar_mul(challenge, scalar)
+    )
+
+
+def _blob(blob_id: int, data: bytes) -> bytes:
+    """Return a libubox blob attribute with padding"""
+    header = struct.pack("!I", (blob_id << 24) | (len(data) + 4))
+    return header + data + b"\0" * (-len(data) % 4)
+
+
+def ucert_append(certificate: bytes, signature: str) -> bytes:
+    """Append a signature to a certificate chain, same as `ucert -A`
+
+    Args:
+        certificate (bytes): content of the certificate file
+        signature (str): content of the usign signature file
+
+    Returns:
+        bytes: content of the extended certificate file
+    """
+    return certificate + _blob(0, _blob(CERT_ATTR_SIGNATURE, signature.encode()))
+
+
+def _file_crc32(path: Path, length: int) -> int:
+    crc32: int = 0
+    for chunk in _read_chunks(path, length):
+        crc32 = zlib.crc32(chunk, crc32)
+    return crc32
+
+
+def fwtool_strip_signature(image: Path) -> int:
+    """Remove a trailing signature block, same as `fwtool -t -s /dev/null`
+
+    The image is truncated in place.
+
+    Args:
+        image (Path): firmware image
+
+    Returns:
+        int: size of the image without signature, unmodified if it has none
+    """
+    length: int = image.stat().st_size
+    if length < FWIMAGE_TRAILER.size:
+        return length
+
+    with image.open("rb") as content:
+        content.seek(length - FWIMAGE_TRAILER.size)
+        magic, crc32, data_type, size = FWIMAGE_TRAILER.unpack(content.read())
+    if (
+        magic != FWIMAGE_MAGIC
+        or data_type != FWIMAGE_SIGNATURE
+        or not FWIMAGE_TRAILER.size <= size <= length
+        or _file_crc32(image, length - FWIMAGE_TRAILER.size) ^ 0xFFFFFFFF != crc32
+    ):
+        return length
+
+    with image.open("r+b") as content:
+        content.truncate(length - size)
+    return length - size
+
+
+def fwtool_append_signature(image: Path, signature: bytes) -> None:
+    """Append a signature block to an image, same as `fwtool -S`
+
+    Args:
+        image (Path): firmware image
+        signature (bytes): content of the signature file, usually a ucert
+    """
+    if len(signature) > FWIMAGE_SIGNATURE_MAXLEN:
+        raise ValueError("Signature exceeds maximum length")
+
+    crc32 = zlib.crc32(signature, _file_crc32(image, image.stat().st_size))
+    with image.open("ab") as content:
+        content.write(
+            signature
+            + FWIMAGE_TRAILER.pack(
+                FWIMAGE_MAGIC,
+                crc32 ^ 0xFFFFFFFF,
+                FWIMAGE_SIGNATURE,
+                FWIMAGE_TRAILER.size + len(signature),
+            )
+        )
+
+
+def sign_image(image: Path, secret_key: str, certificate: bytes) -> str:
+    """Sign a firmware image in place
+
+    This replaces running `fwtool`, `usign` and `ucert` within a container.
+    Next to the image the `.sig` and `.ucert` files are created. The image is
+    read in chunks and modified in place, so it must not be a link into the
+    store.
+
+    Args:
+        image (Path): firmware image to sign
+        secret_key (str): content of an unencrypted usign secret key file
+        certificate (bytes): content of the ucert certificate of the key
+
+    Returns:
+        str: hash of the signed image
+    """
+    length: int = fwtool_strip_signature(image)
+
+    fingerprint, seckey = _parse_secret_key(secret_key)
+    signature: str = _format_signature(
+        fingerprint, ed25519_sign_file(image, length, seckey)
+    )
+    write_file_atomic(image.with_name(image.name + ".sig"), signature.encode())
+
+    certificate = ucert_append(certificate, signature)
+    write_file_atomic(image.with_name(image.name + ".ucert"), certificate)
+
+    fwtool_append_signature(image, certificate)
+    log.debug(f"Signed {image.name}")
+    with image.open("rb") as content:
+        return hashlib.file_digest(content, "sha256").hexdigest()
@@ -0,0 +1,508 @@
+import argparse
+import json
+import logging
+import shutil
+from os import link, replace, symlink
+from os.path import relpath
+from pathlib import Path
+from time import sleep, time
+from typing import Optional
+
+from rq.job import Job, JobStatus
+from rq.results import Result
+from rq.utils import now, parse_timeout
+
+from asu.build_request import BuildRequest
+from asu.config import settings
+from asu.signing import write_file_atomic
+from asu.util import (
+    get_build_dir,
+    get_build_path,
+    get_file_hash,
+    get_jobs,
+    get_redis_client,
+    increment_metric,
+    is_snapshot_build,
+    resolve_build_dir,
+)
+
+log = logging.getLogger("rq.worker")
+
+
+def get_blob_path(sha256: str) -> Path:
+    """Return the path of a blob within the store
+
+    Blobs are keyed by their sha256sum and sharded by the first two
+    characters to keep directories small.
+
+    Args:
+        sha256 (str): sha256sum of the blob
+
+    Returns:
+        Path: Location of the blob
+    """
+    return settings.public_path / "store" / "blobs" / sha256[:2] / sha256
+
+
+def _link_blob(blob: Path, path: Path) -> None:
+    """Replace `path` with a link to `blob`
+
+    Hardlinks are preferred, symlinks are used if hardlinking is not
+    possible, e.g. if the blob is owned by the container user.
+    """
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.unlink(missing_ok=True)
+    try:
+        link(blob, tmp_path)
+    except OSError:
+        symlink(relpath(blob, path.parent), tmp_path)
+    replace(tmp_path, path)
+
+
+def store_blob(path: Path, sha256: str) -> bool:
+    """Move a file into the blob store and link it back to its location
+
+    If a blob with the same content already exists, the file is replaced by
+    a link to the existing blob.
+
+    Args:
+        path (Path): File within a request directory
+        sha256 (str): sha256sum of the file
+
+    Returns:
+        bool: If the blob existed already
+    """
+    blob = get_blob_path(sha256)
+    existed = blob.is_file()
+    if existed:
+        if blob.samefile(path):
+            return True
+    else:
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        replace(path, blob)
+
+    _link_blob(blob, path)
+    return existed
+
+
+def store_artifacts(bin_dir: Path, request_hash: str, checksums: dict[str, str]) -> int:
+    """Deduplicate the artifacts of a request via the blob store
+
+    Every blob is recorded in the store index `store:blobs` (sha256sum to
+    size) and the requests referencing it in `store:refs:<sha256sum>`.
+
+    Args:
+        bin_dir (Path): The store directory of the request
+        request_hash (str): Hash of the request
+        checksums (dict): sha256sum of every artifact
+
+    Returns:
+        int: Number of bytes saved by deduplication
+    """
+    redis = get_redis_client()
+    saved: int = 0
+
+    for name, sha256 in checksums.items():
+        path = bin_dir / name
+        if not path.is_file():
+            continue
+
+        size: int = path.stat().st_size
+        if store_blob(path, sha256):
+            saved += size
+
+        if redis.hsetnx("store:blobs", sha256, size):
+            redis.hincrby("store:usage", "blobs", 1)
+            redis.hincrby("store:usage", "size", size)
+        redis.sadd(f"store:refs:{sha256}", request_hash)
+
+    if saved:
+        log.info(f"Deduplicated {saved} bytes of {request_hash}")
+
+    return saved
+
+
+def get_store_usage() -> dict[str, int]:
+    """Return the size of the store based on its index
+
+    The totals are maintained while blobs are added, so this doesn't scan
+    the index.
+
+    Returns:
+        dict: Number and total size of unique blobs
+    """
+    usage = get_redis_client().hgetall("store:usage")
+    return {"blobs": int(usage.get("blobs", 0)), "size": int(usage.get("size", 0))}
+
+
+def link_artifacts(bin_dir: Path, source: Path, checksums: dict[str, str]) -> bool:
+    """Link the artifacts of another build into the store directory of a request
+
+    Artifacts with checksum are linked from the blob store, other files of
+    `source` like signatures are linked as well. The build log and the result
+    of `source` belong to the other request and are skipped.
+
+    Args:
+        bin_dir (Path): The store directory of the request
+        source (Path): The store directory of the other build
+        checksums (dict): sha256sum of every artifact of the other build
+
+    Returns:
+        bool: If all blobs were available
+    """
+    blobs = {name: get_blob_path(sha256) for name, sha256 in checksums.items()}
+    if not all(blob.is_file() for blob in blobs.values()):
+        return False
+
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for name, blob in blobs.items():
+        _link_blob(blob, bin_dir / name)
+
+    for path in source.iterdir() if source.is_dir() else []:
+        if (
+            path.is_file()
+            and path.name not in blobs
+            and path.name not in ("build.log", "result.json")
+            and not path.name.startswith(".")
+        ):
+            _link_blob(path, bin_dir / path.name)
+
+    return True
+
+
+def touch_build(request_hash: str) -> None:
+    """Record an access of the store directory of a request
+
+    Args:
+        request_hash (str): Hash of the request
+    """
+    get_redis_client().zadd("store:access", {request_hash: time()})
+
+
+def restore_build(
+    request_hash: str, build_request: BuildRequest, result_ttl: str
+) -> Optional[Job]:
+    """Register a finished job for a build still present in the store
+
+    Once the job of a request expired its images usually remain in the store,
+    so the job is recreated from `result.json` instead of building again.
+    Snapshot builds are not restored as their request hash doesn't cover the
+    upstream revision the images were built from.
+
+    Args:
+        request_hash (str): Hash of the request as posted, the ID of its job
+            and its store directory
+        build_request (BuildRequest): The request
+        result_ttl (str): Time to keep the recreated job
+
+    Returns:
+        Job: The finished job or None if the build is unavailable
+    """
+    if is_snapshot_build(build_request.version):
+        return None
+
+    bin_dir: Path = resolve_build_dir(request_hash)
+    result_file: Path = bin_dir / "result.json"
+    if not result_file.is_file():
+        return None
+
+    try:
+        result: dict = json.loads(result_file.read_text())
+    except ValueError:
+        log.warning(f"Invalid result of {request_hash} in store")
+        return None
+
+    checksums: dict[str, str] = result.get("checksums", {})
+    if not checksums or not all((bin_dir / name).is_file() for name in checksums):
+        return None
+
+    ttl: int = parse_timeout(result_ttl)
+    job = Job.create(
+        "asu.build.build",
+        args=(build_request,),
+        connection=get_redis_client(False),
+        id=request_hash,
+        result_ttl=ttl,
+        status=JobStatus.FINISHED,
+    )
+    job.ended_at = now()
+    with job.connection.pipeline() as pipeline:
+        job.save(pipeline=pipeline)
+        Result.create(
+            job,
+            Result.Type.SUCCESSFUL,
+            ttl=ttl,
+            return_value={
+                key: value for key, value in result.items() if key != "manifest"
+            },
+            pipeline=pipeline,
+        )
+        job.finished_job_registry.add(job, ttl, pipeline)
+        job.cleanup(ttl, pipeline)
+        pipeline.execute()
+
+    log.info(f"Restored {request_hash} from store")
+    touch_build(request_hash)
+    return job
+
+
+def get_artifact_checksum(path: Path) -> str:
+    """Return the sha256sum of a file of the store without hashing it
+
+    Blobs are named after their sha256sum, other artifacts are looked up in
+    the `result.json` of their build.
+
+    Args:
+        path (Path): File within the store, as requested
+
+    Returns:
+        str: The sha256sum or an empty string if unknown
+    """
+    blob: Path = path.resolve()
+    if blob.parent.parent.name == "blobs":
+        return blob.name
+
+    result_file: Path = path.parent / "result.json"
+    if result_file.is_file():
+        try:
+            checksums = json.loads(result_file.read_text()).get("checksums", {})
+            return checksums.get(path.name, "")
+        except ValueError:
+            pass
+    return ""
+
+
+def get_disk_usage(path: Path) -> int:
+    """Return the size of all files below `path`, counting hardlinks once"""
+    inodes: dict[tuple[int, int], int] = {}
+    for file in path.rglob("*"):
+        if file.is_file() and not file.is_symlink():
+            stat = file.stat()
+            inodes[(stat.st_dev, stat.st_ino)] = stat.st_size
+    return sum(inodes.values())
+
+
+def get_build_checksums(bin_dir: Path) -> dict[str, str]:
+    """Return the sha256sums of the artifacts of a store directory
+
+    Artifacts are read from `result.json`, for older builds the files linked
+    into the blob store are hashed instead.
+    """
+    result_file: Path = bin_dir / "result.json"
+    if result_file.is_file():
+        return json.loads(result_file.read_text()).get("checksums", {})
+
+    return {
+        file.name: get_file_hash(file)
+        for file in bin_dir.iterdir()
+        if file.is_file() and (file.is_symlink() or file.stat().st_nlink > 1)
+    }
+
+
+def is_legacy_build_dir(path: Path) -> bool:
+    """Return if `path` is a store directory of the flat store layout"""
+    return (
+        path.is_dir()
+        and len(path.name) > 2
+        and path.name != "blobs"
+        and not path.name.startswith(".")
+    )
+
+
+def get_build_dirs() -> list[Path]:
+    """Return the store directories of all requests
+
+    Returns:
+        list: Directories of the sharded layout and legacy directories
+    """
+    bin_dirs: list[Path] = []
+    for path in (settings.public_path / "store").iterdir():
+        if is_legacy_build_dir(path):
+            bin_dirs.append(path)
+        elif path.is_dir() and len(path.name) == 2:
+            bin_dirs.extend(
+                bin_dir
+                for shard in path.iterdir()
+                if shard.is_dir()
+                for bin_dir in shard.iterdir()
+                if bin_dir.is_dir()
+            )
+    return bin_dirs
+
+
+def migrate_store() -> int:
+    """Move the store directories of the flat layout into the sharded layout
+
+    Links into the blob store are recreated, as symlinks are relative, and
+    the `bin_dir` of `result.json` is updated.
+
+    Returns:
+        int: Number of moved directories
+    """
+    moved: int = 0
+    for legacy_dir in sorted((settings.public_path / "store").iterdir()):
+        if not is_legacy_build_dir(legacy_dir):
+            continue
+
+        bin_dir: Path = get_build_dir(legacy_dir.name)
+        if bin_dir.exists():
+            log.warning(f"Skipping {legacy_dir.name}, exists in sharded layout")
+            continue
+
+        blobs: dict[str, Path] = {
+            path.name: path.resolve()
+            for path in legacy_dir.iterdir()
+            if path.is_symlink()
+        }
+        bin_dir.parent.mkdir(parents=True, exist_ok=True)
+        legacy_dir.rename(bin_dir)
+        for name, blob in blobs.items():
+            _link_blob(blob, bin_dir / name)
+
+        result_file: Path = bin_dir / "result.json"
+        if result_file.is_file():
+            result: dict = json.loads(result_file.read_text())
+            result["bin_dir"] = get_build_path(bin_dir.name)
+            write_file_atomic(result_file, json.dumps(result).encode())
+
+        moved += 1
+
+    log.info(f"Moved {moved} builds into the sharded store layout")
+    return moved
+
+
+def remove_build(bin_dir: Path) -> int:
+    """Remove the store directory of a request and blobs only it referenced
+
+    Args:
+        bin_dir (Path): The store directory of the request
+
+    Returns:
+        int: Number of bytes freed
+    """
+    redis = get_redis_client()
+    request_hash: str = bin_dir.name
+    checksums: dict[str, str] = get_build_checksums(bin_dir)
+
+    freed: int = sum(
+        file.lstat().st_size
+        for file in bin_dir.rglob("*")
+        if file.is_symlink() or (file.is_file() and file.stat().st_nlink == 1)
+    )
+    shutil.rmtree(bin_dir, ignore_errors=True)
+    redis.zrem("store:access", request_hash)
+
+    for sha256 in set(checksums.values()):
+        redis.srem(f"store:refs:{sha256}", request_hash)
+        blob: Path = get_blob_path(sha256)
+        if redis.scard(f"store:refs:{sha256}") or not blob.is_file():
+            continue
+        # Blobs may still be linked by directories missing from the index.
+        if blob.stat().st_nlink > 1:
+            continue
+
+        size: int = blob.stat().st_size
+        blob.unlink()
+        freed += size
+        if redis.hdel("store:blobs", sha256):
+            redis.hincrby("store:usage", "blobs", -1)
+            redis.hincrby("store:usage", "size", -size)
+
+    return freed
+
+
+def collect_garbage(budget: int) -> dict[str, int]:
+    """Remove the least recently used store directories until `budget` fits
+
+    Directories of builds whose job is still in Redis are never removed.
+    Accesses are recorded by `touch_build`, directories without record use
+    their mtime.
+
+    Args:
+        budget (int): Maximum size of the store in bytes
+
+    Returns:
+        dict: Size of the store, number of removed directories and bytes
+    """
+    store_path: Path = settings.public_path / "store"
+    size: int = get_disk_usage(store_path)
+    stats: dict[str, int] = {"size": size, "removed": 0, "reclaimed": 0}
+    if size <= budget:
+        return stats
+
+    bin_dirs: list[Path] = get_build_dirs()
+    redis = get_redis_client()
+    access: list = redis.zmscore("store:access", [path.name for path in bin_dirs])
+    last_access: dict[Path, float] = {
+        path: score if score is not None else path.stat().st_mtime
+        for path, score in zip(bin_dirs, access)
+    }
+    # The results of finished jobs and their coalescing claims point to the
+    # directory until they expire, so only builds without job are removed.
+    live: set[str] = {
+        job.id for job in get_jobs([path.name for path in bin_dirs]) if job
+    }
+
+    for bin_dir in sorted(bin_dirs, key=lambda path: last_access[path]):
+        if size <= budget:
+            break
+        if bin_dir.name in live:
+            continue
+
+        freed: int = remove_build(bin_dir)
+        log.info(f"Removed {bin_dir.name} from store ({freed} bytes)")
+        size -= freed
+        stats["removed"] += 1
+        stats["reclaimed"] += freed
+
+    stats["size"] = size
+    increment_metric("store_gc_removed_total", value=stats["removed"])
+    increment_metric("store_gc_reclaimed_bytes_total", value=stats["reclaimed"])
+    redis.hset("store:gc", mapping={**stats, "time": int(time())})
+    log.info(
+        f"Removed {stats['removed']} builds from store, "
+        f"reclaimed {stats['reclaimed']} bytes"
+    )
+    return stats
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m asu.store", description="Maintain the build store"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    gc = commands.add_parser("gc", help="remove least recently used builds")
+    gc.add_argument(
+        "--size-mb",
+        type=int,
+        default=settings.store_size_mb,
+        help="size budget of the store (default: STORE_SIZE_MB)",
+    )
+    gc.add_argument(
+        "--interval",
+        help="keep running and collect garbage every interval, e.g. 1h",
+    )
+    commands.add_parser("migrate", help="move builds into the sharded layout")
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        print(f"moved {migrate_store()} builds")
+        return
+
+    if args.size_mb <= 0:
+        parser.error("no size budget configured")
+
+    while True:
+        stats = collect_garbage(args.size_mb * 1024 * 1024)
+        print(
+            f"removed {stats['removed']} builds, reclaimed {stats['reclaimed']} "
+            f"bytes, store size {stats['size']} bytes"
+        )
+        if not args.interval:
+            break
+        sleep(parse_timeout(args.interval))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=settings.log_level)
+    main()
@@ -4,23 +4,34 @@ import hashlib
 import json
 import logging
 import struct
-from os import getgid, getuid
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
-from re import match
-from tarfile import TarFile
-from io import BytesIO
-from typing import Optional
+from re import MULTILINE, findall, match, search, sub
+import tarfile
+from io import RawIOBase
+from collections import Counter, defaultdict, deque
+from time import perf_counter, sleep, time
+from types import SimpleNamespace
+from typing import AsyncIterator, BinaryIO, Iterable, Iterator, Optional, Union
+from uuid import uuid4
 
 import nacl.signing
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 import httpx
 from httpx import Response
-from podman import PodmanClient
+from podman import PodmanClient, errors
+from podman.api import stream_frames
 from podman.domain.containers import Container
+from podman.domain.images import Image
+from rq.utils import parse_timeout
 from rq import Queue
-from rq.job import Job
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+from rq.results import Result
 
 import redis
+import redis.asyncio
 from asu.build_request import BuildRequest
 from asu.config import settings
 
@@ -30,20 +41,228 @@ log.propagate = False  # Suppress duplicate log messages.
 # Create a shared HTTP client
 _http_client = httpx.Client()
 
+# Upper bounds of the histogram buckets in seconds
+PHASE_BUCKETS: tuple[float, ...] = (1, 5, 10, 30, 60, 120, 300, 600)
+UPSTREAM_BUCKETS: tuple[float, ...] = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Lines of the output of a failed command kept in the job meta
+LOG_TAIL_LINES: int = 50
+
+# Milliseconds to wait for new lines of a live build log
+LOG_STREAM_BLOCK_MS: int = 5000
+
+# Seconds between checks of a job while waiting for status changes
+STATUS_CHECK_INTERVAL: float = 5
+
+FINAL_STATUSES: tuple[JobStatus, ...] = (
+    JobStatus.FINISHED,
+    JobStatus.FAILED,
+    JobStatus.STOPPED,
+    JobStatus.CANCELED,
+)
+
+
+def get_build_path(request_hash: str) -> str:
+    """Return the store directory of a request relative to the store
+
+    Builds are sharded by the first four characters of their hash, e.g.
+    `ab/cd/abcd...`, to keep directories small.
+
+    Args:
+        request_hash (str): Hash of the request
+
+    Returns:
+        str: The directory, also used as `bin_dir` in URLs
+    """
+    return f"{request_hash[:2]}/{request_hash[2:4]}/{request_hash}"
+
+
+def get_build_dir(request_hash: str) -> Path:
+    """Return the store directory of a request"""
+    return settings.public_path / "store" / get_build_path(request_hash)
+
+
+def resolve_build_dir(request_hash: str) -> Path:
+    """Return the existing store directory of a request
+
+    Builds stored before the store was sharded are found directly below the
+    store until migrated via `python -m asu.store migrate`.
+
+    Args:
+        request_hash (str): Hash of the request
+
+    Returns:
+        Path: The legacy directory if only it exists, else `get_build_dir`
+    """
+    bin_dir: Path = get_build_dir(request_hash)
+    legacy_dir: Path = settings.public_path / "store" / request_hash
+    if not bin_dir.is_dir() and legacy_dir.is_dir():
+        return legacy_dir
+    return bin_dir
+
+
+def get_log_path(request_hash: str) -> Path:
+    """Return the location of the build log of a request"""
+    return resolve_build_dir(request_hash) / "build.log"
+
+
+def get_log_stream_key(request_hash: str) -> str:
+    """Return the Redis stream containing the live build log of a request"""
+    return f"build:log:{request_hash}"
+
+
+async def read_log_stream(
+    request_hash: str, last_id: str = "0"
+) -> AsyncIterator[tuple[str, dict[str, str]]]:
+    """Yield the lines of the live build log of a request until it's done
+
+    Blocking reads use the async Redis client, so waiting viewers don't hold
+    a thread of the server.
+
+    Args:
+        request_hash (str): Hash of the request
+        last_id (str): ID of the last entry already received
+
+    Yields:
+        (str, dict): ID and fields of every entry, empty while waiting
+    """
+    redis = get_redis_async_client()
+    key: str = get_log_stream_key(request_hash)
+    try:
+        while True:
+            entries = await redis.xread(
+                {key: last_id}, count=100, block=LOG_STREAM_BLOCK_MS
+            )
+            if entries:
+                for last_id, fields in entries[0][1]:
+                    yield last_id, fields
+                continue
+
+            job: Optional[Job] = await run_in_threadpool(get_job, request_hash)
+            if job is None or job.get_status(refresh=False) in FINAL_STATUSES:
+                return
+            yield "", {}
+    finally:
+        await redis.aclose()
+
+
+def get_build_result(result: dict) -> dict:
+    """Return the complete result of a build, including its manifest
+
+    Builds keep their manifest only in `result.json` of the store, see
+    `save_result`.
+
+    Args:
+        result (dict): Result of the build job
+
+    Returns:
+        dict: The result read from the store if available
+    """
+    if "manifest" not in result and "bin_dir" in result:
+        result_file: Path = (
+            resolve_build_dir(Path(result["bin_dir"]).name) / "result.json"
+        )
+        if result_file.is_file():
+            return json.loads(result_file.read_text())
+    return result
+
 
 def get_redis_client(unicode: bool = True) -> redis.client.Redis:
     return redis.from_url(settings.redis_url, decode_responses=unicode)
 
 
+def get_redis_async_client() -> redis.asyncio.Redis:
+    return redis.asyncio.from_url(settings.redis_url, decode_responses=True)
+
+
 def get_redis_ts():
     return get_redis_client().ts()
 
 
 def client_get(url: str) -> Response:
-    return _http_client.get(url)
+    start: float = perf_counter()
+    try:
+        return _http_client.get(url)
+    finally:
+        observe_metric(
+            "upstream_request_duration_seconds",
+            perf_counter() - start,
+            UPSTREAM_BUCKETS,
+        )
+
 
+def get_metric_field(name: str, labels: dict[str, str] = {}) -> str:
+    """Return a metric in the Prometheus text format, e.g. `name{key="value"}`
 
-def add_timestamp(key: str, labels: dict[str, str] = {}, value: int = 1) -> None:
+    Args:
+        name (str): Name of the metric
+        labels (dict): Labels of the metric
+
+    Returns:
+        str: Metric name with labels
+    """
+    if not labels:
+        return name
+
+    def escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return name + "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def increment_metric(name: str, labels: dict[str, str] = {}, value: float = 1) -> None:
+    """Increment a counter exposed via `/metrics`
+
+    Counters are aggregated in the Redis hash `metrics:counters`, so a scrape
+    only reads a single key.
+
+    Args:
+        name (str): Name of the metric
+        labels (dict): Labels of the metric
+        value (float): Value to add
+    """
+    try:
+        get_redis_client().hincrbyfloat(
+            "metrics:counters", get_metric_field(name, labels), value
+        )
+    except redis.RedisError as exc:
+        log.debug(f"Could not update metric {name}: {exc}")
+
+
+def observe_metric(
+    name: str, value: float, buckets: tuple[float, ...], labels: dict[str, str] = {}
+) -> None:
+    """Add an observation to a histogram exposed via `/metrics`
+
+    The buckets are stored cumulatively in the Redis hash
+    `metrics:histograms` next to the sum and count of all observations. All
+    buckets are created on the first observation, as Prometheus expects
+    every bucket up to `+Inf`.
+
+    Args:
+        name (str): Name of the metric
+        value (float): Observed value
+        buckets (tuple): Upper bounds of the buckets
+        labels (dict): Labels of the metric
+    """
+    pipeline = get_redis_client().pipeline(transaction=False)
+    for bound in [*buckets, "+Inf"]:
+        pipeline.hincrby(
+            "metrics:histograms",
+            get_metric_field(f"{name}_bucket", {**labels, "le": str(bound)}),
+            int(bound == "+Inf" or value <= bound),
+        )
+    pipeline.hincrbyfloat(
+        "metrics:histograms", get_metric_field(f"{name}_sum", labels), value
+    )
+    pipeline.hincrby("metrics:histograms", get_metric_field(f"{name}_count", labels), 1)
+    try:
+        pipeline.execute()
+    except redis.RedisError as exc:
+        log.debug(f"Could not update metric {name}: {exc}")
+
+
+def add_timestamp(key: str, labels: dict[str, str] = {}, value: float = 1) -> None:
     if not settings.server_stats:
         return
     log.debug(f"Adding timestamp to {key}: {labels}")
@@ -56,6 +275,44 @@ def add_timestamp(key: str, labels: dict[str, str] = {}, value: int = 1) -> None
     )
 
 
+@contextmanager
+def build_phase(job: Job, phase: str, build_request: BuildRequest) -> Iterator[None]:
+    """Measure the duration of a build phase
+
+    The duration in seconds is stored in `job.meta["timings"]` and added to
+    the time series `stats:phase:<phase>:<version>:<target>`. Failed phases
+    are measured as well.
+
+    Args:
+        job (Job): The build job
+        phase (str): Name of the phase, e.g. `make_image`
+        build_request (BuildRequest): The build request
+    """
+    start: float = perf_counter()
+    try:
+        yield
+    finally:
+        duration: float = round(perf_counter() - start, 3)
+        job.meta.setdefault("timings", {})[phase] = duration
+        log.debug(f"Phase {phase} took {duration}s")
+        observe_metric(
+            "build_phase_duration_seconds",
+            duration,
+            PHASE_BUCKETS,
+            {"phase": phase, "target": build_request.target},
+        )
+        add_timestamp(
+            f"stats:phase:{phase}:{build_request.version}:{build_request.target}",
+            {
+                "stats": "phase",
+                "phase": phase,
+                "version": build_request.version,
+                "target": build_request.target,
+            },
+            duration,
+        )
+
+
 def add_build_event(event: str) -> None:
     """
     Logs summary statistics for build events:
@@ -77,15 +334,493 @@ def add_build_event(event: str) -> None:
 
     key: str = f"stats:build:{event}"
     add_timestamp(key, {"stats": "summary"})
+    increment_metric("build_events_total", {"event": event})
 
 
-def get_queue() -> Queue:
+def get_queue(name: str = "default") -> Queue:
     """Return the current queue
 
+    Args:
+        name (str): Name of the queue
+
     Returns:
         Queue: The current RQ work queue
     """
-    return Queue(connection=get_redis_client(False), is_async=settings.async_queue)
+    return Queue(
+        name, connection=get_redis_client(False), is_async=settings.async_queue
+    )
+
+
+def get_queue_name(
+    build_request: BuildRequest, client: str = "", batch: bool = False
+) -> str:
+    """Return the queue of a build request based on `queue_rules`
+
+    Every rule contains a `queue` and conditions, the first rule matching all
+    its conditions is used. Possible conditions are `client` (prefix of the
+    client, e.g. `luci/`), `version` (`snapshot` or `release`), `defaults` and
+    `batch` (both bool). Requests not matching any rule use `default`.
+
+    Args:
+        build_request (BuildRequest): The build request
+        client (str): Client sending the request, e.g. `owut/2024.07.01`
+        batch (bool): If the request is part of a batch
+
+    Returns:
+        str: Name of the queue
+    """
+    request: dict[str, Union[str, bool]] = {
+        "client": client,
+        "version": "snapshot"
+        if is_snapshot_build(build_request.version)
+        else "release",
+        "defaults": bool(build_request.defaults),
+        "batch": batch,
+    }
+
+    for rule in settings.queue_rules:
+        if all(
+            str(request.get(key)).startswith(value)
+            if key == "client"
+            else request.get(key) == value
+            for key, value in rule.items()
+            if key != "queue"
+        ):
+            return rule["queue"]
+
+    return "default"
+
+
+def get_affinity_queues(name: str) -> list[Queue]:
+    """Return the image affinity queues of a queue
+
+    Affinity queues are tracked in `affinity:queues:<name>` when jobs are
+    routed to them. Queues unused for `image_affinity_ttl` are forgotten once
+    drained, including their entry in the RQ queue registry.
+
+    Args:
+        name (str): Name of the queue, e.g. `default`
+
+    Returns:
+        list: Queues named `<name>@<image tag>`
+    """
+    connection = get_redis_client(False)
+    key: str = f"affinity:queues:{name}"
+    stale_before: float = time() - parse_timeout(settings.image_affinity_ttl)
+
+    queues: list[Queue] = []
+    for queue_name, last_used in connection.zrange(key, 0, -1, withscores=True):
+        queue = Queue(queue_name.decode(), connection=connection)
+        if last_used < stale_before and remove_empty_queue(queue, key):
+            continue
+        queues.append(queue)
+    return queues
+
+
+def remove_empty_queue(queue: Queue, key: str) -> bool:
+    """Remove a queue without queued or started jobs from the RQ queue registry
+    and `key`
+
+    The queue is watched, so a job enqueued meanwhile keeps it.
+
+    Args:
+        queue (Queue): The affinity queue
+        key (str): Set tracking the queue
+
+    Returns:
+        bool: True if the queue was removed
+    """
+    with queue.connection.pipeline() as pipeline:
+        try:
+            started: str = queue.started_job_registry.key
+            pipeline.watch(queue.key, started)
+            # Jobs of dead workers are found via the queue, see
+            # `WeightedWorker.clean_registries`.
+            if pipeline.llen(queue.key) or pipeline.zcard(started):
+                return False
+            pipeline.multi()
+            pipeline.srem(Queue.redis_queues_keys, queue.key)
+            pipeline.zrem(key, queue.name)
+            pipeline.execute()
+        except redis.WatchError:
+            return False
+    return True
+
+
+def get_queue_length(name: str) -> int:
+    """Return the number of queued jobs of a queue and its affinity queues"""
+    return len(get_queue(name)) + sum(len(queue) for queue in get_affinity_queues(name))
+
+
+def get_queue_lengths() -> dict[str, int]:
+    """Return the number of queued jobs of every configured queue
+
+    Returns:
+        dict: Queue names and their length
+    """
+    return {name: get_queue_length(name) for name in settings.queues}
+
+
+def advertise_image(worker_name: str, build_request: BuildRequest) -> None:
+    """Record that a worker holds the ImageBuilder image of a request
+
+    Args:
+        worker_name (str): Name of the worker
+        build_request (BuildRequest): The build request
+    """
+    redis = get_redis_client()
+    tag: str = get_imagebuilder_image(build_request).rsplit(":", 1)[1]
+    ttl: int = parse_timeout(settings.image_affinity_ttl)
+
+    redis.zadd(f"affinity:workers:{tag}", {worker_name: time()})
+    redis.expire(f"affinity:workers:{tag}", ttl)
+    redis.zadd(f"affinity:images:{worker_name}", {tag: time()})
+    redis.expire(f"affinity:images:{worker_name}", ttl)
+
+
+def get_worker_images(worker_name: str) -> list[str]:
+    """Return the tags of the ImageBuilder images a worker holds
+
+    Args:
+        worker_name (str): Name of the worker
+
+    Returns:
+        list: Image tags used within `image_affinity_ttl`
+    """
+    return get_redis_client().zrangebyscore(
+        f"affinity:images:{worker_name}",
+        time() - parse_timeout(settings.image_affinity_ttl),
+        "+inf",
+    )
+
+
+def get_affinity_queue_name(queue_name: str, build_request: BuildRequest) -> str:
+    """Return the queue of a request preferred by workers holding its image
+
+    Jobs are only routed to an affinity queue if a worker recently used the
+    ImageBuilder image of the request, other workers pick them up after
+    `image_affinity_wait`.
+
+    Args:
+        queue_name (str): Queue of the request
+        build_request (BuildRequest): The build request
+
+    Returns:
+        str: Name of the affinity queue or `queue_name`
+    """
+    if not settings.image_affinity:
+        return queue_name
+
+    redis = get_redis_client()
+    tag: str = get_imagebuilder_image(build_request).rsplit(":", 1)[1]
+    if not redis.zcount(
+        f"affinity:workers:{tag}",
+        time() - parse_timeout(settings.image_affinity_ttl),
+        "+inf",
+    ):
+        return queue_name
+
+    affinity_queue_name: str = f"{queue_name}@{tag}"
+    key: str = f"affinity:queues:{queue_name}"
+    redis.zadd(key, {affinity_queue_name: time()})
+    # Outlive the queues, `get_affinity_queues` unregisters them once stale
+    redis.expire(key, 2 * parse_timeout(settings.image_affinity_ttl))
+    return affinity_queue_name
+
+
+def get_job(request_hash: str) -> Optional[Job]:
+    """Return the build job of a request, independent of its queue
+
+    Args:
+        request_hash (str): Hash of the request
+
+    Returns:
+        Job: The build job or None
+    """
+    try:
+        return Job.fetch(request_hash, connection=get_redis_client(False))
+    except NoSuchJobError:
+        return None
+
+
+def get_jobs(request_hashes: list[str]) -> list[Optional[Job]]:
+    """Return the build jobs of many requests with a single Redis round trip
+
+    Args:
+        request_hashes (list): Hashes of the requests
+
+    Returns:
+        list: The build jobs, None for unknown requests
+    """
+    return Job.fetch_many(request_hashes, connection=get_redis_client(False))
+
+
+def get_job_details(jobs: list[Job]) -> list[tuple[Optional[Result], int]]:
+    """Return the latest result and queue position of many jobs
+
+    Only the results of finished or failed jobs and the positions of queued
+    jobs are read, all within a single Redis round trip. The status of the
+    jobs is taken as fetched.
+
+    Args:
+        jobs (list): The build jobs
+
+    Returns:
+        list: The latest result, None if unavailable, and the queue position
+            of every job
+    """
+    if not jobs:
+        return []
+
+    pipeline = jobs[0].connection.pipeline()
+    for job in jobs:
+        status: JobStatus = job.get_status(refresh=False)
+        if status in (JobStatus.FINISHED, JobStatus.FAILED):
+            pipeline.xrevrange(Result.get_key(job.id), "+", "-", count=1)
+        elif status == JobStatus.QUEUED:
+            pipeline.lpos(Queue(job.origin, connection=job.connection).key, job.id)
+    responses: Iterator = iter(pipeline.execute())
+
+    details: list[tuple[Optional[Result], int]] = []
+    for job in jobs:
+        status = job.get_status(refresh=False)
+        if status in (JobStatus.FINISHED, JobStatus.FAILED):
+            entries: list = next(responses)
+            result: Optional[Result] = None
+            if entries:
+                result_id, payload = entries[0]
+                result = Result.restore(
+                    job.id,
+                    result_id.decode(),
+                    payload,
+                    connection=job.connection,
+                    serializer=job.serializer,
+                )
+            details.append((result, 0))
+        elif status == JobStatus.QUEUED:
+            details.append((None, next(responses) or 0))
+        else:
+            details.append((None, 0))
+    return details
+
+
+def promote_job(job: Job, name: str = "default") -> None:
+    """Move a queued prebuild job to the queue of an actual request
+
+    Args:
+        job (Job): A queued job of the prebuild queue
+        name (str): Name of the new queue
+    """
+    log.info(f"Promoting prebuild {job.id} to {name}")
+    get_queue(job.origin).remove(job)
+    get_queue(name).enqueue_job(job)
+
+
+def get_status_channel(request_hash: str) -> str:
+    """Return the Redis channel announcing status changes of a build"""
+    return f"build:status:{request_hash}"
+
+
+def notify_status(request_hash: str, status: str) -> None:
+    """Wake up clients waiting for a status change of a build
+
+    Args:
+        request_hash (str): Hash of the request
+        status (str): The new status
+    """
+    get_redis_client().publish(get_status_channel(request_hash), status)
+
+
+def set_imagebuilder_status(job: Job, status: str) -> None:
+    """Update and announce the `imagebuilder_status` of a build job
+
+    Args:
+        job (Job): The build job
+        status (str): The new status
+    """
+    job.meta["imagebuilder_status"] = status
+    job.save_meta()
+    notify_status(job.id, status)
+
+
+async def wait_for_status(request_hash: str, timeout: float) -> None:
+    """Wait until a build announces a status change or `timeout` expires
+
+    Status changes are announced by the worker via Redis pub/sub. Every
+    `STATUS_CHECK_INTERVAL` seconds the job is checked as well, in case the
+    worker doesn't announce the completion of jobs.
+
+    Args:
+        request_hash (str): Hash of the request
+        timeout (float): Seconds to wait at most
+    """
+    deadline: float = time() + timeout
+    async with get_redis_async_client().pubsub(
+        ignore_subscribe_messages=True
+    ) as pubsub:
+        # Subscribe first to not miss changes made while reading the job
+        await pubsub.subscribe(get_status_channel(request_hash))
+        job: Optional[Job] = await run_in_threadpool(get_job, request_hash)
+        if job is None:
+            return
+
+        state: tuple[str, str] = await run_in_threadpool(get_job_state, job)
+        if state[0] in FINAL_STATUSES:
+            return
+
+        while (remaining := deadline - time()) > 0:
+            if await pubsub.get_message(timeout=min(remaining, STATUS_CHECK_INTERVAL)):
+                return
+            if await run_in_threadpool(get_job_state, job) != state:
+                return
+
+
+def get_job_state(job: Job) -> tuple[str, str]:
+    """Return the RQ status and the `imagebuilder_status` of a job"""
+    return job.get_status(), job.get_meta().get("imagebuilder_status", "")
+
+
+def get_popular_profiles(count: int) -> list[tuple[str, str]]:
+    """Return the most built profiles of the last 30 days
+
+    Based on the `stats:builds:*` time series, so `server_stats` must be
+    enabled.
+
+    Args:
+        count (int): Number of profiles to return
+
+    Returns:
+        list: Tuples of target and profile, the most popular first
+    """
+    window: int = 30 * 24 * 60 * 60 * 1000
+    now: int = int(time() * 1000)
+    popularity: Counter = Counter()
+
+    result = get_redis_ts().mrange(
+        from_time=now - window,
+        to_time=now,
+        filters=["stats=builds"],
+        with_labels=True,
+        aggregation_type="sum",
+        bucket_size_msec=window,
+    )
+    for row in result:
+        for labels, data in row.values():
+            popularity[(labels["target"], labels["profile"])] += sum(
+                value for _, value in data
+            )
+
+    return [profile for profile, _ in popularity.most_common(count)]
+
+
+def schedule_prebuilds(versions: list[str]) -> list[str]:
+    """Schedule builds of popular profiles for new releases
+
+    Versions seen for the first time are only recorded, so a fresh server
+    doesn't prebuild every release. For new releases a single
+    `enqueue_prebuilds` job is added to the `prebuild` queue, this runs while
+    reloading versions for client requests, which shouldn't wait for the
+    validation of every prebuild.
+
+    Args:
+        versions (list): Currently available versions
+
+    Returns:
+        list: New releases to prebuild
+    """
+    if not settings.prebuild_profiles:
+        return []
+
+    redis = get_redis_client()
+    releases: list[str] = [v for v in versions if not is_snapshot_build(v)]
+    if not releases:
+        return []
+
+    if not redis.exists("prebuild:versions"):
+        redis.sadd("prebuild:versions", *releases)
+        return []
+
+    new_versions: list[str] = [
+        v for v in releases if redis.sadd("prebuild:versions", v)
+    ]
+    if new_versions:
+        get_queue("prebuild").enqueue(
+            "asu.util.enqueue_prebuilds",
+            new_versions,
+            result_ttl=settings.build_failure_ttl,
+            failure_ttl=settings.build_failure_ttl,
+            job_timeout=settings.job_timeout,
+        )
+    return new_versions
+
+
+def enqueue_prebuilds(versions: list[str]) -> int:
+    """Enqueue builds of popular profiles for new releases
+
+    Builds with default packages of the `prebuild_profiles` most popular
+    profiles are added to the `prebuild` queue, which workers only process
+    while the other queues are empty. Prebuilds are validated like requests
+    of clients, profiles missing in the new release are skipped. Enqueueing
+    stops once the other queues together hold more than half of
+    `max_pending_jobs`, so prebuilds never take the room of clients.
+
+    Clients send their installed packages, so their request hashes differ
+    from the prebuilds. They reuse the prebuilt images via build coalescing
+    once their package selection resolves to the same manifest, see
+    `get_coalesce_key`, which still requires a container start and `make
+    manifest` but saves building the images.
+
+    Args:
+        versions (list): New releases, see `schedule_prebuilds`
+
+    Returns:
+        int: Number of enqueued builds
+    """
+    # The API imports this module, so import the validation on demand.
+    from asu.routers.api import validate_request
+
+    # Workers don't run the app, validate against upstream data directly.
+    app = SimpleNamespace(
+        versions=versions,
+        targets=defaultdict(list),
+        profiles=defaultdict(lambda: defaultdict(dict)),
+    )
+    profiles = get_popular_profiles(settings.prebuild_profiles)
+    queue: Queue = get_queue("prebuild")
+    enqueued: int = 0
+
+    for version in versions:
+        for target, profile in profiles:
+            lengths: dict[str, int] = get_queue_lengths()
+            lengths.pop("prebuild", None)
+            if sum(lengths.values()) > settings.max_pending_jobs // 2:
+                log.info("Skipping prebuilds due to high load")
+                return enqueued
+
+            build_request = BuildRequest(
+                version=version, target=target, profile=profile
+            )
+            content, _ = validate_request(app, build_request)
+            if content:
+                log.info(f"Skipping prebuild of {target} {profile}: {content}")
+                continue
+
+            request_hash: str = get_request_hash(build_request)
+            if get_job(request_hash):
+                continue
+
+            queue.enqueue(
+                "asu.build.build",
+                build_request,
+                job_id=request_hash,
+                result_ttl=settings.build_ttl,
+                failure_ttl=settings.build_failure_ttl,
+                job_timeout=settings.job_timeout,
+            )
+            enqueued += 1
+
+    log.info(f"Enqueued {enqueued} prebuilds for {', '.join(versions)}")
+    return enqueued
 
 
 def get_branch(version_or_branch: str) -> dict[str, str]:
@@ -123,14 +858,29 @@ def get_file_hash(path: str) -> str:
     Returns:
         str: hash of file
     """
+    with open(path, "rb") as f:
+        return get_stream_hash(f)
+
+
+def get_stream_hash(stream: BinaryIO, copy: Optional[BinaryIO] = None) -> str:
+    """Return sha256sum of a stream, optionally copying it while reading
+
+    Args:
+        stream (BinaryIO): stream to hash
+        copy (BinaryIO): file to write the content of the stream to
+
+    Returns:
+        str: hash of stream
+    """
     BLOCK_SIZE: int = 65536
 
     h = hashlib.sha256()
-    with open(path, "rb") as f:
-        fb: bytes = f.read(BLOCK_SIZE)
-        while len(fb) > 0:
-            h.update(fb)
-            fb = f.read(BLOCK_SIZE)
+    fb: bytes = stream.read(BLOCK_SIZE)
+    while len(fb) > 0:
+        h.update(fb)
+        if copy:
+            copy.write(fb)
+        fb = stream.read(BLOCK_SIZE)
 
     return h.hexdigest()
 
@@ -264,6 +1014,345 @@ def get_container_version_tag(input_version: str) -> str:
     return version
 
 
+def get_imagebuilder_image(build_request: BuildRequest) -> str:
+    """Return the ImageBuilder container image used for a request
+
+    Args:
+        build_request (BuildRequest): The image request
+
+    Returns:
+        str: Name and tag of the container image
+    """
+    return "{}:{}-{}".format(
+        settings.base_container,
+        build_request.target.replace("/", "-"),
+        get_container_version_tag(build_request.version),
+    )
+
+
+def get_image_digest(image: Image) -> str:
+    """Return the digest of a local container image, falling back to its ID"""
+    return image.attrs.get("Digest") or image.id
+
+
+def parse_imagebuilder_info(info: str) -> dict:
+    """Parse the output of `make info` of an ImageBuilder
+
+    Args:
+        info (str): Output of `make info`
+
+    Returns:
+        dict: Revision, default packages and packages of every profile
+    """
+    revision = search(r'Current Revision: "(r.+)"', info)
+    default_packages = search(r"^Default Packages: (.*)$", info, MULTILINE)
+
+    profiles: dict[str, dict[str, list[str]]] = {}
+    profile: str = ""
+    for line in info.partition("Available Profiles:")[2].splitlines():
+        if line.endswith(":") and not line[0].isspace():
+            profile = line.removesuffix(":")
+            profiles[profile] = {"packages": []}
+        elif profile and line.strip().startswith("Packages:"):
+            profiles[profile]["packages"] = line.partition(":")[2].split()
+
+    return {
+        "revision": revision.group(1) if revision else "",
+        "default_packages": default_packages.group(1).split()
+        if default_packages
+        else [],
+        "profiles": profiles,
+    }
+
+
+def set_imagebuilder_info(image: str, digest: str, info: Optional[dict]) -> None:
+    """Store the digest of `image` and the parsed `make info` of that digest
+
+    Args:
+        image (str): Name and tag of the container image
+        digest (str): Digest of the container image
+        info (dict): Parsed `make info`, only the digest is stored if None
+    """
+    redis_client = get_redis_client()
+    redis_client.set(f"imagebuilder:digest:{image}", digest)
+    if info:
+        redis_client.set(
+            f"imagebuilder:info:{digest}",
+            json.dumps(info),
+            ex=parse_timeout(settings.imagebuilder_info_ttl),
+        )
+
+
+def get_manifest(key: str) -> Optional[dict]:
+    """Return a manifest cached by a manifest-only build
+
+    Args:
+        key (str): Redis key of the manifest, see `get_manifest_key`
+
+    Returns:
+        dict: The manifest and the packages of the build, None if not cached
+    """
+    manifest = get_redis_client().get(key)
+    return json.loads(manifest) if manifest else None
+
+
+def parse_package_errors(stderr: str) -> list[str]:
+    """Return the packages causing an impossible package selection
+
+    Args:
+        stderr (str): Output of `make manifest` of opkg or apk
+
+    Returns:
+        list: Names of missing or conflicting packages, in order of output
+    """
+    names: list[str] = [
+        next(filter(None, groups))
+        for groups in findall(
+            r"Cannot install package (\S+?)\.$"
+            r"|Cannot satisfy the following dependencies for (\S+?):"
+            r"|[Uu]nknown package '([^']+)'"
+            r"|^  (\S+?)(?: \(no such package\))?:$",
+            stderr,
+            MULTILINE,
+        )
+    ]
+    # apk prints conflicting packages with their version, e.g. `foo-1.0-r1`
+    return list(dict.fromkeys(sub(r"-\d[^-]*-r\d+$", "", name) for name in names))
+
+
+def set_manifest_failure(key: str, msg: str, stderr: str) -> bool:
+    """Cache an impossible package selection
+
+    Other failures of `make manifest`, like failed downloads of the package
+    index, may be gone on the next try and are not cached.
+
+    Args:
+        key (str): Redis key of the failure, see `get_manifest_failure_key`
+        msg (str): Error message of the failed build
+        stderr (str): Output of `make manifest`
+
+    Returns:
+        bool: True if `stderr` shows conflicting packages and was cached
+    """
+    packages: list[str] = parse_package_errors(stderr)
+    if not packages:
+        return False
+
+    get_redis_client().set(
+        key,
+        json.dumps(
+            {
+                "detail": msg,
+                "packages": packages,
+                "stderr": "\n".join(stderr.splitlines()[-LOG_TAIL_LINES:]),
+            }
+        ),
+        ex=parse_timeout(settings.manifest_failure_ttl),
+    )
+    return True
+
+
+def get_manifest_failure(key: str) -> Optional[dict]:
+    """Return a cached impossible package selection
+
+    Args:
+        key (str): Redis key of the failure, see `get_manifest_failure_key`
+
+    Returns:
+        dict: Error message, conflicting packages and end of `stderr`, None
+            if not cached
+    """
+    failure = get_redis_client().get(key)
+    return json.loads(failure) if failure else None
+
+
+def get_imagebuilder_info(
+    image: str = "", digest: str = ""
+) -> tuple[str, Optional[dict]]:
+    """Return the digest and cached `make info` of an ImageBuilder image
+
+    Either the `image` or its `digest` must be given, the image is resolved
+    to the digest it had on the last build.
+
+    Args:
+        image (str): Name and tag of the container image
+        digest (str): Digest of the container image
+
+    Returns:
+        (str, dict): The digest and parsed `make info`, None if not cached
+    """
+    redis_client = get_redis_client()
+    if not digest:
+        digest = redis_client.get(f"imagebuilder:digest:{image}") or ""
+    if not digest:
+        return "", None
+
+    info = redis_client.get(f"imagebuilder:info:{digest}")
+    return digest, json.loads(info) if info else None
+
+
+@contextmanager
+def redis_lock(name: str, timeout: str) -> Iterator[None]:
+    """Hold a lock shared by all workers, waiting while someone else holds it
+
+    Args:
+        name (str): Redis key of the lock
+        timeout (str): Time after which a lock of a crashed holder expires
+    """
+    redis_client = get_redis_client()
+    token: str = uuid4().hex
+    while not redis_client.set(name, token, nx=True, ex=parse_timeout(timeout)):
+        sleep(0.5)
+    try:
+        yield
+    finally:
+        if redis_client.get(name) == token:
+            redis_client.delete(name)
+
+
+def get_upstream_revision(version: str, target: str) -> str:
+    """Return the revision of the latest upstream build of a target
+
+    The `version_code` of the upstream `profiles.json` is cached for
+    `image_pull_ttl`.
+
+    Args:
+        version (str): Version, e.g. `SNAPSHOT`
+        target (str): Target, e.g. `x86/64`
+
+    Returns:
+        str: Revision or an empty string if unavailable
+    """
+    redis_client = get_redis_client()
+    key: str = f"revision:upstream:{version}:{target}"
+    if revision := redis_client.get(key):
+        return revision
+
+    version_path: str = get_branch(version)["path"].format(version=version)
+    response: Response = client_get(
+        f"{settings.upstream_url}/{version_path}/targets/{target}/profiles.json"
+    )
+    if response.status_code != 200:
+        log.warning(f"Could not get revision of {version} {target}")
+        return ""
+
+    revision = response.json().get("version_code", "")
+    if revision:
+        redis_client.set(key, revision, ex=parse_timeout(settings.image_pull_ttl))
+    return revision
+
+
+def get_registry_digest(image: str) -> str:
+    """Return the digest of a container image tag in its registry
+
+    Anonymous pull tokens are requested as announced by the registry.
+
+    Args:
+        image (str): Name and tag of the container image
+
+    Returns:
+        str: Manifest digest of the tag, empty if the registry can't tell
+    """
+    name, _, tag = image.rpartition(":")
+    registry, _, repository = name.partition("/")
+    url = f"https://{registry}/v2/{repository}/manifests/{tag}"
+    headers = {
+        "Accept": ", ".join(
+            [
+                "application/vnd.oci.image.index.v1+json",
+                "application/vnd.oci.image.manifest.v1+json",
+                "application/vnd.docker.distribution.manifest.list.v2+json",
+                "application/vnd.docker.distribution.manifest.v2+json",
+            ]
+        )
+    }
+
+    try:
+        response = _http_client.head(url, headers=headers)
+        if response.status_code == 401:
+            challenge = dict(
+                findall(r'(\w+)="([^"]*)"', response.headers["www-authenticate"])
+            )
+            realm = challenge.pop("realm")
+            token = _http_client.get(realm, params=challenge).json()["token"]
+            headers["Authorization"] = f"Bearer {token}"
+            response = _http_client.head(url, headers=headers)
+    except (httpx.HTTPError, KeyError, ValueError) as exc:
+        log.warning(f"Could not check registry digest of {image}: {exc}")
+        return ""
+
+    if response.status_code != 200:
+        log.warning(f"Registry digest of {image}: HTTP {response.status_code}")
+        return ""
+
+    return response.headers.get("docker-content-digest", "")
+
+
+def image_has_digest(image: Image, digest: str) -> bool:
+    """Check if a local container image was pulled from `digest`"""
+    return digest == get_image_digest(image) or any(
+        repo_digest.endswith(f"@{digest}")
+        for repo_digest in image.attrs.get("RepoDigests") or []
+    )
+
+
+def pull_image(podman: PodmanClient, image: str) -> str:
+    """Make sure a current version of `image` is available locally
+
+    The tag is resolved to a digest which is reused by all workers for
+    `image_pull_ttl`. Afterwards the registry digest is checked and the image
+    is only pulled if the tag was changed upstream.
+
+    Args:
+        podman (PodmanClient): Podman client
+        image (str): Name and tag of the container image
+
+    Returns:
+        str: Digest of the local container image
+    """
+    redis_client = get_redis_client()
+
+    def local_image() -> Optional[Image]:
+        try:
+            return podman.images.get(image)
+        except errors.ImageNotFound:
+            return None
+
+    def current_digest() -> str:
+        digest, _ = get_imagebuilder_info(image)
+        if digest and redis_client.exists(f"imagebuilder:fresh:{image}"):
+            local = local_image()
+            if local and image_has_digest(local, digest):
+                return digest
+        return ""
+
+    if digest := current_digest():
+        return digest
+
+    with redis_lock(f"imagebuilder:pull-lock:{image}", settings.job_timeout):
+        # Another worker may have checked the tag while waiting for the lock.
+        if digest := current_digest():
+            return digest
+
+        local = local_image()
+        registry_digest = get_registry_digest(image)
+        if local and registry_digest and image_has_digest(local, registry_digest):
+            log.debug(f"Local image {image} is up to date")
+        else:
+            log.debug(f"Pulling {image} (registry digest {registry_digest})")
+            local = podman.images.pull(image)
+
+        digest = get_image_digest(local)
+        set_imagebuilder_info(image, digest, None)
+        redis_client.set(
+            f"imagebuilder:fresh:{image}",
+            digest,
+            ex=parse_timeout(settings.image_pull_ttl),
+        )
+
+    return digest
+
+
 def get_podman() -> PodmanClient:
     return PodmanClient(
         base_url=f"unix://{settings.container_socket_path}",
@@ -289,12 +1378,113 @@ def diff_packages(
     )
 
 
+def stream_cmd(
+    container: Container,
+    command: list[str],
+    log_file: Optional[Path],
+    log_stream: str,
+) -> tuple[int, str, str]:
+    """Run a command and publish its output line by line while it runs
+
+    Lines are added to the Redis stream `log_stream`, which keeps only the
+    latest `log_stream_length` lines. Only the last `LOG_TAIL_LINES` lines
+    of stdout and stderr are kept in memory and returned.
+
+    Args:
+        container (Container): Container to run the command in
+        command (list): The command
+        log_file (Path): File to append the output to
+        log_stream (str): Key of the Redis stream
+
+    Returns:
+        (int, str, str): Return code and the end of stdout and stderr
+    """
+    response = container.client.post(
+        f"/containers/{container.name}/exec",
+        data=json.dumps(
+            {
+                "AttachStdout": True,
+                "AttachStderr": True,
+                "Cmd": command,
+                "User": "buildbot",
+            }
+        ),
+    )
+    response.raise_for_status()
+    exec_id: str = response.json()["Id"]
+
+    output = container.client.post(
+        f"/exec/{exec_id}/start",
+        data=json.dumps({"Detach": False, "Tty": False}),
+        stream=True,
+    )
+    output.raise_for_status()
+
+    redis = get_redis_client()
+    ttl: int = parse_timeout(settings.build_failure_ttl)
+    tails: dict[str, deque[str]] = {
+        "stdout": deque(maxlen=LOG_TAIL_LINES),
+        "stderr": deque(maxlen=LOG_TAIL_LINES),
+    }
+    partial: dict[str, str] = {"stdout": "", "stderr": ""}
+
+    def publish(name: str, lines: list[str]) -> None:
+        pipeline = redis.pipeline()
+        for line in lines:
+            tails[name].append(line)
+            pipeline.xadd(
+                log_stream,
+                {"stream": name, "line": line},
+                maxlen=settings.log_stream_length,
+                approximate=True,
+            )
+        pipeline.expire(log_stream, ttl)
+        pipeline.execute()
+
+    with log_file.open("a") if log_file else nullcontext() as log_content:
+        if log_content:
+            log_content.write(f"$ {' '.join(command)}\n")
+
+        for frame in stream_frames(output, demux=True):
+            for name, data in zip(("stdout", "stderr"), frame):
+                if not data:
+                    continue
+                text: str = data.decode("utf-8", errors="replace")
+                if log_content:
+                    log_content.write(text)
+                lines: list[str] = (partial[name] + text).split("\n")
+                partial[name] = lines.pop()
+                # Don't buffer endless lines, e.g. progress bars
+                if len(partial[name]) > 4096:
+                    lines.append(partial[name])
+                    partial[name] = ""
+                publish(name, lines)
+
+        for name, line in partial.items():
+            if line:
+                publish(name, [line])
+
+        response = container.client.get(f"/exec/{exec_id}/json")
+        response.raise_for_status()
+        returncode: int = response.json().get("ExitCode")
+
+        log.debug(f"returncode: {returncode}")
+        if log_content:
+            log_content.write(f"# exit code {returncode}\n\n")
+
+    return returncode, "\n".join(tails["stdout"]), "\n".join(tails["stderr"])
+
+
 def run_cmd(
     container: Container,
     command: list[str],
-    copy: list[str] = [],
     environment: dict[str, str] = {},
+    log_file: Optional[Path] = None,
+    log_stream: str = "",
 ) -> tuple[int, str, str]:
+    if log_stream:
+        return stream_cmd(container, command, log_file, log_stream)
+
     returncode, output = container.exec_run(command, demux=True, user="buildbot")
 
     stdout: str = output[0].decode("utf-8") if output[0] else ""
@@ -304,28 +1494,82 @@ def run_cmd(
     log.debug(f"stdout: {stdout}")
     log.debug(f"stderr: {stderr}")
 
-    if copy:
-        log.debug(f"Copying {copy[0]} from container to {copy[1]}")
-        container_tar, _ = container.get_archive(copy[0])
+    if log_file:
+        with log_file.open("a") as log_content:
+            log_content.write(f"$ {' '.join(command)}\n{stdout}{stderr}")
+            log_content.write(f"# exit code {returncode}\n\n")
 
-        with TarFile(fileobj=BytesIO(b"".join(container_tar))) as tar_file:
-            uuid: int = getuid()
-            ugid: int = getgid()
+    return returncode, stdout, stderr
+
+
+class ChunkReader(RawIOBase):
+    """Readable file object on top of an iterator of byte chunks"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks: Iterator[bytes] = iter(chunks)
+        self._buffer: memoryview = memoryview(b"")
+        self._offset: int = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        # Consumed bytes are skipped via the offset, slicing the remaining
+        # chunk on every read would copy it over and over.
+        while self._offset >= len(self._buffer):
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+            self._offset = 0
+        size: int = min(len(buffer), len(self._buffer) - self._offset)
+        buffer[:size] = self._buffer[self._offset : self._offset + size]
+        self._offset += size
+        return size
+
+
+def copy_files(
+    container: Container, source: str, names: list[str], destination: Path
+) -> dict[str, str]:
+    """Copy single files out of a container and hash them on the way
+
+    Files missing in the container are skipped.
+
+    Args:
+        container (Container): Container to copy from
+        source (str): Directory within the container
+        names (list): Names of the files within `source`
+        destination (Path): Directory to copy the files to
+
+    Returns:
+        dict: sha256sum of every copied file
+    """
+    checksums: dict[str, str] = {}
+    for name in names:
+        try:
+            container_tar, _ = container.get_archive(f"{source}/{name}")
+        except errors.NotFound:
+            log.debug(f"File {name} not found in {source}")
+            continue
+
+        with tarfile.open(fileobj=ChunkReader(container_tar), mode="r|") as tar_file:
             for member in tar_file:
-                # Fix the owner of the copied files, change to "us".
-                member.uid = uuid
-                member.gid = ugid
-                member.mode = 0o755 if member.isdir() else 0o644
-            tar_file.extractall(copy[1])
+                if member.isfile():
+                    with (destination / name).open("wb") as copy:
+                        checksums[name] = get_stream_hash(
+                            tar_file.extractfile(member), copy
+                        )
 
-    return returncode, stdout, stderr
+    return checksums
 
 
-def report_error(job: Job, msg: str) -> None:
+def report_error(job: Job, msg: str, stderr: str = "") -> None:
     log.warning(f"Error: {msg}")
     job.meta["detail"] = f"Error: {msg}"
-    job.meta["imagebuilder_status"] = "failed"
-    job.save_meta()
+    if stderr:
+        # Only the end is kept in Redis, the store contains the full log.
+        job.meta["stderr"] = "\n".join(stderr.splitlines()[-LOG_TAIL_LINES:])
+    set_imagebuilder_status(job, "failed")
     raise RuntimeError(msg)
 
 
@@ -529,6 +1773,8 @@ def reload_versions(app: FastAPI) -> bool:
     # Create a key that puts -rcN between -SNAPSHOT and releases.
     app.versions.sort(reverse=True, key=lambda v: v.replace(".0-rc", "-rc"))
 
+    schedule_prebuilds(app.versions)
+
     return True
 
 
@@ -0,0 +1,155 @@
+from random import random
+
+from rq import Queue, Worker
+from rq.registry import clean_registries
+from rq.utils import now, parse_timeout
+from rq.worker_registration import clean_worker_registry
+
+from asu.config import settings
+from asu.container_pool import prewarm_pools, prewarm_requested
+from asu.util import (
+    get_affinity_queues,
+    get_podman,
+    get_worker_images,
+    notify_status,
+)
+
+
+def get_weighted_order(names: list[str], weights: dict[str, int]) -> list[int]:
+    """Return a random order of queues, weighted by their priority
+
+    A queue with twice the weight of another is twice as likely to be
+    drained first. Queues with weight 0 are only drained once all others are
+    empty and keep their given order. Unknown queues have weight 1.
+
+    Args:
+        names (list): Names of the queues
+        weights (dict): Weights of the queues
+
+    Returns:
+        list: Indexes of `names` in drain order
+    """
+    keys: list[tuple[int, float]] = []
+    for index, name in enumerate(names):
+        weight: int = weights.get(name, 1)
+        if weight > 0:
+            keys.append((0, -(random() ** (1 / weight))))
+        else:
+            keys.append((1, index))
+    return sorted(range(len(names)), key=lambda index: keys[index])
+
+
+def is_waiting(queue: Queue, wait: int) -> bool:
+    """Return if the oldest job of a queue is queued for longer than `wait`"""
+    jobs = queue.get_jobs(0, 1)
+    return bool(jobs) and (now() - jobs[0].enqueued_at).total_seconds() > wait
+
+
+class WeightedWorker(Worker):
+    """Worker draining its queues in a weighted random order
+
+    The order is drawn again after every job based on the weights of
+    `settings.queues`, so background queues get a share of the workers
+    without interactive jobs waiting behind them for long. Start it via
+    `rq worker -w asu.worker.WeightedWorker interactive default batch prebuild`.
+
+    With `image_affinity` every queue is preceded by its affinity queues, see
+    `get_affinity_queue_name`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reorder_queues(None)
+
+    def bootstrap(self, *args, **kwargs):
+        super().bootstrap(*args, **kwargs)
+        # Warm the container pools of the images recently built on this host
+        if settings.container_pool_size:
+            prewarm_pools(get_podman())
+
+    def execute_job(self, job, queue):
+        super().execute_job(job, queue)
+        # Fill pools only once the job ended, so its client doesn't wait
+        if settings.container_pool_size:
+            prewarm_requested(get_podman())
+
+    @property
+    def dequeue_timeout(self) -> int:
+        # Stop waiting regularly to pick up waiting jobs of new affinity queues
+        if settings.image_affinity:
+            return max(
+                1,
+                min(
+                    super().dequeue_timeout,
+                    parse_timeout(settings.image_affinity_wait),
+                ),
+            )
+        return super().dequeue_timeout
+
+    def heartbeat(self, timeout=None, pipeline=None):
+        super().heartbeat(timeout, pipeline)
+        # The heartbeat precedes every dequeue, refresh the affinity queues
+        if settings.image_affinity and pipeline is None:
+            self.reorder_queues(None)
+
+    def get_queues(self, queue: Queue, images: list[str]) -> list[Queue]:
+        """Return the queues to drain instead of `queue` with image affinity
+
+        Jobs for images this worker holds come first, followed by jobs of
+        other affinity queues waiting longer than `image_affinity_wait`.
+        """
+        wait: int = parse_timeout(settings.image_affinity_wait)
+        own: list[Queue] = [
+            self.queue_class(
+                f"{queue.name}@{tag}",
+                connection=self.connection,
+                serializer=self.serializer,
+            )
+            for tag in images
+        ]
+        waiting: list[Queue] = [
+            affinity_queue
+            for affinity_queue in get_affinity_queues(queue.name)
+            if affinity_queue.name not in {own_queue.name for own_queue in own}
+            and is_waiting(affinity_queue, wait)
+        ]
+        return own + waiting + [queue]
+
+    def reorder_queues(self, reference_queue):
+        queues: list[Queue] = [
+            self.queues[index]
+            for index in get_weighted_order(
+                [queue.name for queue in self.queues], settings.queues
+            )
+        ]
+
+        if settings.image_affinity:
+            images: list[str] = get_worker_images(self.name)
+            queues = [
+                affinity_queue
+                for queue in queues
+                for affinity_queue in self.get_queues(queue, images)
+            ]
+
+        self._ordered_queues = queues
+
+    def clean_registries(self):
+        super().clean_registries()
+        # RQ only cleans the queues the worker was started with. Jobs of dead
+        # workers would stay started forever on affinity queues otherwise.
+        for queue in self.queues:
+            for affinity_queue in get_affinity_queues(queue.name):
+                if affinity_queue.acquire_maintenance_lock():
+                    clean_registries(affinity_queue, self._exc_handlers)
+                    clean_worker_registry(affinity_queue)
+                    affinity_queue.intermediate_queue.cleanup(self, affinity_queue)
+                    affinity_queue.release_maintenance_lock()
+
+    def handle_job_success(self, job, queue, started_job_registry):
+        super().handle_job_success(job, queue, started_job_registry)
+        # Announced only now, as clients would still see a running job before.
+        notify_status(job.id, "finished")
+
+    def handle_job_failure(self, job, queue, started_job_registry=None, exc_string=""):
+        super().handle_job_failure(job, queue, started_job_registry, exc_string)
+        notify_status(job.id, "failed")
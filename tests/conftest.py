@@ -3,7 +3,7 @@ import tempfile
 from pathlib import Path
 
 import pytest
-from fakeredis import FakeStrictRedis
+from fakeredis import FakeAsyncRedis, FakeServer, FakeStrictRedis
 from rq import Queue
 from fastapi.testclient import TestClient
 
@@ -55,8 +55,13 @@ def redis_load_mock_data(redis):
 
 
 @pytest.fixture
-def redis_server():
-    r = FakeStrictRedis()
+def fake_server():
+    yield FakeServer()
+
+
+@pytest.fixture
+def redis_server(fake_server):
+    r = FakeStrictRedis(server=fake_server)
     redis_load_mock_data(r)
     yield r
     r.flushall()
@@ -90,12 +95,12 @@ def test_path():
 
 
 @pytest.fixture
-def app(redis_server, test_path, monkeypatch, upstream):
-    def mocked_redis_client(*args, **kwargs):
-        return redis_server
+def app(redis_server, fake_server, test_path, monkeypatch, upstream):
+    def mocked_redis_client(unicode: bool = True):
+        return FakeStrictRedis(server=fake_server, decode_responses=unicode)
 
-    def mocked_redis_queue():
-        return Queue(connection=redis_server, is_async=settings.async_queue)
+    def mocked_redis_queue(name: str = "default"):
+        return Queue(name, connection=redis_server, is_async=settings.async_queue)
 
     settings.public_path = Path(test_path) / "public"
     settings.async_queue = False
@@ -111,6 +116,13 @@ def app(redis_server, test_path, monkeypatch, upstream):
     monkeypatch.setattr("asu.util.get_queue", mocked_redis_queue)
     monkeypatch.setattr("asu.routers.api.get_queue", mocked_redis_queue)
     monkeypatch.setattr("asu.util.get_redis_client", mocked_redis_client)
+    monkeypatch.setattr(
+        "asu.util.get_redis_async_client",
+        lambda: FakeAsyncRedis(server=fake_server, decode_responses=True),
+    )
+    monkeypatch.setattr("asu.store.get_redis_client", mocked_redis_client)
+    monkeypatch.setattr("asu.build.get_redis_client", mocked_redis_client)
+    monkeypatch.setattr("asu.routers.metrics.get_redis_client", mocked_redis_client)
 
     from asu.main import app as real_app
 
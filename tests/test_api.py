@@ -1,6 +1,11 @@
+import json
+from threading import Timer
+from time import time
+
 import pytest
 from fastapi.testclient import TestClient
 
+from asu.build_request import BuildRequest
 from asu.config import settings
 
 
@@ -149,6 +154,7 @@ def test_build_missing_container():
     )
 
     class fake_job:
+        id = "test"
         meta = {}
 
         def save_meta(self):
@@ -758,3 +764,446 @@ def test_api_stats(client):
     assert response.status_code == 200
     data = response.json()
     assert data["queue_length"] == 0
+
+
+def test_api_build_version_code_cached_info(client):
+    from asu.util import set_imagebuilder_info
+
+    set_imagebuilder_info(
+        "ghcr.io/openwrt/imagebuilder:testtarget-testsubtarget-v1.2.3",
+        "sha256:123",
+        {"revision": "r12647-cb44ab4f5d", "default_packages": [], "profiles": {}},
+    )
+
+    response = client.post(
+        "/api/v1/build",
+        json=dict(
+            version="1.2.3",
+            version_code="r1-bad",
+            target="testtarget/testsubtarget",
+            profile="testprofile",
+        ),
+    )
+    assert response.status_code == 400
+    data = response.json()
+    assert (
+        data["detail"]
+        == "Received incorrect version r12647-cb44ab4f5d (requested r1-bad)"
+    )
+
+
+def test_api_build_promote_prebuild(client, monkeypatch):
+    from asu.build_request import BuildRequest
+    from asu.util import get_job, get_queue, get_request_hash
+
+    monkeypatch.setattr(settings, "async_queue", True)
+
+    build_request = BuildRequest(
+        version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+    )
+    request_hash = get_request_hash(build_request)
+    get_queue("prebuild").enqueue("asu.build.build", build_request, job_id=request_hash)
+
+    response = client.post(
+        "/api/v1/build",
+        json=dict(
+            version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+        ),
+    )
+    assert response.status_code == 202
+    assert response.json()["request_hash"] == request_hash
+
+    job = get_job(request_hash)
+    assert job.origin == "default"
+    assert len(get_queue("prebuild")) == 0
+    assert len(get_queue()) == 1
+
+
+def test_api_build_restore_from_store(client, monkeypatch):
+    from asu.util import get_job, get_queue, get_request_hash
+
+    monkeypatch.setattr(settings, "async_queue", True)
+
+    build_request = dict(
+        version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+    )
+    request_hash = get_request_hash(BuildRequest(**build_request))
+    bin_dir = settings.public_path / "store" / request_hash
+    bin_dir.mkdir(parents=True)
+    (bin_dir / "sysupgrade.bin").write_bytes(b"image")
+    (bin_dir / "result.json").write_text(
+        json.dumps(
+            {
+                "bin_dir": request_hash,
+                "checksums": {"sysupgrade.bin": "abc"},
+                "images": [{"name": "sysupgrade.bin", "sha256": "abc"}],
+                "manifest": {"test1": "1.0"},
+            }
+        )
+    )
+
+    response = client.post("/api/v1/build", json=build_request)
+    assert response.status_code == 200
+    assert response.json()["images"] == [{"name": "sysupgrade.bin", "sha256": "abc"}]
+    assert response.json()["manifest"] == {"test1": "1.0"}
+    assert len(get_queue()) == 0
+
+    response = client.get(f"/api/v1/build/{request_hash}")
+    assert response.status_code == 200
+
+    # Incomplete builds are built again
+    get_job(request_hash).delete()
+    (bin_dir / "sysupgrade.bin").unlink()
+    response = client.post("/api/v1/build", json=build_request)
+    assert response.status_code == 202
+    assert len(get_queue()) == 1
+
+
+def test_api_build_restore_aliased_profile(client, redis_server, monkeypatch):
+    from asu.main import app
+    from asu.util import get_build_dir, get_build_path, get_job, get_request_hash
+
+    monkeypatch.setattr(settings, "async_queue", True)
+    monkeypatch.setitem(
+        app.profiles["1.2.3"],
+        "testtarget/testsubtarget",
+        {"testprofile": "testprofile", "vendor_alias": "testprofile"},
+    )
+    build_request = dict(
+        version="1.2.3", target="testtarget/testsubtarget", profile="vendor_alias"
+    )
+    response = client.post("/api/v1/build", json=build_request)
+    assert response.status_code == 202
+    request_hash = response.json()["request_hash"]
+    assert request_hash == get_request_hash(BuildRequest(**build_request))
+
+    # The worker stores the build by the job ID
+    bin_dir = get_build_dir(request_hash)
+    bin_dir.mkdir(parents=True)
+    (bin_dir / "sysupgrade.bin").write_bytes(b"image")
+    (bin_dir / "result.json").write_text(
+        json.dumps(
+            {
+                "bin_dir": get_build_path(request_hash),
+                "checksums": {"sysupgrade.bin": "abc"},
+                "images": [{"name": "sysupgrade.bin", "sha256": "abc"}],
+                "manifest": {"test1": "1.0"},
+            }
+        )
+    )
+
+    get_job(request_hash).delete()
+    response = client.post("/api/v1/build", json=build_request)
+    assert response.status_code == 200
+    assert response.json()["request_hash"] == request_hash
+    assert response.json()["manifest"] == {"test1": "1.0"}
+    assert redis_server.zscore("store:access", request_hash)
+
+
+def test_api_build_queue_rules(client, monkeypatch):
+    from asu.util import get_job, get_queue
+
+    monkeypatch.setattr(settings, "async_queue", True)
+    monkeypatch.setattr(
+        settings, "queue_rules", [{"client": "luci/", "queue": "interactive"}]
+    )
+
+    response = client.post(
+        "/api/v1/build",
+        json=dict(
+            version="1.2.3",
+            target="testtarget/testsubtarget",
+            profile="testprofile",
+            client="luci/git-24.10",
+        ),
+    )
+    assert response.status_code == 202
+    assert get_job(response.json()["request_hash"]).origin == "interactive"
+    assert len(get_queue("interactive")) == 1
+
+    response = client.get("/api/v1/stats")
+    assert response.json()["queue_length"] == 1
+    assert response.json()["queues"]["interactive"] == 1
+
+
+def test_api_build_image_affinity(client, monkeypatch):
+    from asu.util import advertise_image, get_job
+
+    monkeypatch.setattr(settings, "async_queue", True)
+    monkeypatch.setattr(settings, "image_affinity", True)
+
+    build_request = dict(
+        version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+    )
+    advertise_image("worker-a", BuildRequest(**build_request))
+
+    response = client.post("/api/v1/build", json=build_request)
+    assert response.status_code == 202
+    assert (
+        get_job(response.json()["request_hash"]).origin
+        == "default@testtarget-testsubtarget-v1.2.3"
+    )
+    assert client.get("/api/v1/stats").json()["queues"]["default"] == 1
+
+
+def test_api_build_batch(client, monkeypatch):
+    monkeypatch.setattr(settings, "async_queue", True)
+
+    build_request = dict(
+        version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+    )
+    response = client.post(
+        "/api/v1/build/batch",
+        json=[
+            build_request,
+            dict(build_request, packages=["test1"]),
+            build_request,
+            dict(build_request, profile="unknown"),
+        ],
+    )
+    assert response.status_code == 200
+    builds = response.json()
+    assert len(builds) == 4
+    assert builds[0] == builds[2]
+    assert builds[0]["status"] == 202
+    assert builds[1]["status"] == 202
+    assert builds[0]["request_hash"] != builds[1]["request_hash"]
+    assert builds[3]["status"] == 400
+    assert builds[3]["detail"].startswith("Unsupported profile")
+
+    stats = client.get("/api/v1/stats").json()
+    assert stats["queues"]["batch"] == 2
+
+    response = client.post(
+        "/api/v1/build/status",
+        json=[builds[1]["request_hash"], builds[0]["request_hash"], "unknown"],
+    )
+    assert response.status_code == 200
+    assert [build["status"] for build in response.json()] == [202, 202, 404]
+    assert response.json()[0]["request_hash"] == builds[1]["request_hash"]
+    assert response.json()[2]["request_hash"] == "unknown"
+
+    # Existing jobs are fetched at once, not one by one
+    def get_job(request_hash):
+        raise AssertionError(f"fetched {request_hash} on its own")
+
+    monkeypatch.setattr("asu.routers.api.get_job", get_job)
+    response = client.post(
+        "/api/v1/build/batch", json=[build_request, dict(build_request, profile="x")]
+    )
+    assert response.json()[0] == builds[0]
+    assert response.json()[1]["status"] == 400
+
+
+def test_api_build_batch_too_large(client, monkeypatch):
+    monkeypatch.setattr(settings, "max_batch_requests", 1)
+
+    response = client.post("/api/v1/build/status", json=["a", "b"])
+    assert response.status_code == 413
+
+
+def test_api_manifest(client, monkeypatch):
+    monkeypatch.setattr(settings, "async_queue", True)
+
+    build_request = dict(
+        version="1.2.3",
+        target="testtarget/testsubtarget",
+        profile="testprofile",
+        packages=["test1"],
+    )
+    response = client.post("/api/v1/manifest", json=build_request)
+    assert response.status_code == 202
+    request_hash = response.json()["request_hash"]
+    assert request_hash.startswith("manifest-")
+
+    response = client.get(f"/api/v1/build/{request_hash}")
+    assert response.status_code == 202
+
+
+def test_api_manifest_cached(client, redis_server):
+    from asu.build import get_manifest_key
+    from asu.util import get_imagebuilder_image, set_imagebuilder_info
+
+    build_request = BuildRequest(
+        version="1.2.3",
+        target="testtarget/testsubtarget",
+        profile="testprofile",
+        packages=["test1"],
+    )
+    set_imagebuilder_info(get_imagebuilder_image(build_request), "sha256:abc", None)
+    redis_server.set(
+        get_manifest_key(build_request, "sha256:abc"),
+        json.dumps({"manifest": {"test1": "1.0"}, "detail": "done"}),
+    )
+
+    response = client.post("/api/v1/manifest", json=build_request.model_dump())
+    assert response.status_code == 200
+    assert response.json()["manifest"] == {"test1": "1.0"}
+
+
+def test_api_build_manifest_failure_cached(client, monkeypatch):
+    from asu.build import get_manifest_failure_key
+    from asu.util import (
+        get_imagebuilder_image,
+        get_queue,
+        set_imagebuilder_info,
+        set_manifest_failure,
+    )
+
+    monkeypatch.setattr(settings, "async_queue", True)
+
+    build_request = BuildRequest(
+        version="1.2.3",
+        target="testtarget/testsubtarget",
+        profile="testprofile",
+        packages=["test1", "test2"],
+    )
+    set_imagebuilder_info(get_imagebuilder_image(build_request), "sha256:abc", None)
+    set_manifest_failure(
+        get_manifest_failure_key(build_request, "sha256:abc"),
+        "Impossible package selection",
+        " * opkg_install_cmd: Cannot install package test2.",
+    )
+
+    # The order of packages doesn't matter
+    response = client.post(
+        "/api/v1/build",
+        json=dict(build_request.model_dump(), packages=["test2", "test1"]),
+    )
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Error: Impossible package selection"
+    assert response.json()["packages"] == ["test2"]
+    assert "Cannot install package test2" in response.json()["stderr"]
+    assert len(get_queue()) == 0
+
+    response = client.post(
+        "/api/v1/build", json=dict(build_request.model_dump(), packages=["test1"])
+    )
+    assert response.status_code == 202
+
+
+def test_api_build_log(client):
+    log_path = settings.public_path / "store" / "abc" / "build.log"
+    log_path.parent.mkdir(parents=True)
+    log_path.write_text("$ make info\nline 1\nline 2\n")
+
+    response = client.get("/api/v1/build/abc/log")
+    assert response.status_code == 200
+    assert response.text == "$ make info\nline 1\nline 2\n"
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+
+    response = client.get("/api/v1/build/abc/log?tail=1")
+    assert response.text == "line 2\n"
+
+    response = client.get(
+        "/api/v1/build/abc/log", headers={"Accept-Encoding": "identity"}
+    )
+    assert "Content-Encoding" not in response.headers
+    assert "Accept-Encoding" in response.headers["Vary"]
+
+    response = client.get("/api/v1/build/def/log")
+    assert response.status_code == 404
+
+
+def test_api_build_log_aliased_profile(client, monkeypatch):
+    from asu.main import app
+    from asu.util import get_build_dir, get_job, get_log_path, get_request_hash
+
+    monkeypatch.setitem(
+        app.profiles["1.2.3"],
+        "testtarget/testsubtarget",
+        {"testprofile": "testprofile", "vendor_alias": "testprofile"},
+    )
+    build_request = dict(
+        version="1.2.3", target="testtarget/testsubtarget", profile="vendor_alias"
+    )
+    response = client.post("/api/v1/build", json=build_request)
+    request_hash = response.json()["request_hash"]
+    assert request_hash == get_request_hash(BuildRequest(**build_request))
+
+    # The build is stored by the job ID, not the hash of the mapped request
+    mapped_request = get_job(request_hash).args[0]
+    assert mapped_request.profile == "testprofile"
+    mapped_hash = get_request_hash(mapped_request)
+    assert get_log_path(request_hash).parent == get_build_dir(request_hash)
+    assert get_build_dir(request_hash).is_dir()
+    assert not get_build_dir(mapped_hash).exists()
+
+
+def test_api_build_log_stream(client, redis_server, monkeypatch):
+    monkeypatch.setattr("asu.util.LOG_STREAM_BLOCK_MS", 100)
+    redis_server.xadd("build:log:abc", {"stream": "stdout", "line": "line 1"})
+    redis_server.xadd("build:log:abc", {"stream": "stderr", "line": "error"})
+    redis_server.xadd("build:log:abc", {"stream": "stdout", "line": "10%\r20%"})
+
+    response = client.get(
+        "/api/v1/build/abc/log", headers={"Accept": "text/event-stream"}
+    )
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/event-stream")
+
+    events = response.text.split("\n\n")
+    assert events[0].startswith("id: ")
+    assert events[0].endswith("\nevent: stdout\ndata: line 1")
+    assert events[1].endswith("\nevent: stderr\ndata: error")
+    assert events[2].endswith("\nevent: stdout\ndata: 10%\ndata: 20%")
+    assert events[3] == "event: end\ndata: unknown"
+
+
+def test_api_build_log_stream_stopped(client, redis_server, monkeypatch):
+    from rq import Queue
+    from rq.job import JobStatus
+
+    monkeypatch.setattr("asu.util.LOG_STREAM_BLOCK_MS", 100)
+    job = Queue(connection=redis_server).enqueue("math.floor", 1.5, job_id="abc")
+    job.set_status(JobStatus.STOPPED)
+    redis_server.xadd("build:log:abc", {"stream": "stdout", "line": "line 1"})
+
+    response = client.get(
+        "/api/v1/build/abc/log", headers={"Accept": "text/event-stream"}
+    )
+    events = response.text.split("\n\n")
+    assert events[0].endswith("\nevent: stdout\ndata: line 1")
+    assert events[1].startswith("event: end")
+
+
+def test_api_build_get_wait(client, monkeypatch):
+    from asu.util import get_job, set_imagebuilder_status
+
+    monkeypatch.setattr(settings, "async_queue", True)
+
+    response = client.post(
+        "/api/v1/build",
+        json=dict(
+            version="1.2.3",
+            target="testtarget/testsubtarget",
+            profile="testprofile",
+        ),
+    )
+    request_hash = response.json()["request_hash"]
+
+    start = time()
+    response = client.get(f"/api/v1/build/{request_hash}?wait=0.3")
+    assert response.status_code == 202
+    assert time() - start >= 0.3
+
+    job = get_job(request_hash)
+    Timer(0.2, set_imagebuilder_status, (job, "container_setup")).start()
+    start = time()
+    response = client.get(f"/api/v1/build/{request_hash}?wait=10")
+    assert time() - start < 2
+    assert response.json()["imagebuilder_status"] == "container_setup"
+
+    start = time()
+    response = client.get("/api/v1/build/unknown?wait=10")
+    assert response.status_code == 404
+    assert time() - start < 5
+
+
+def test_api_build_events(client):
+    response = client.get("/api/v1/build/unknown/events")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/event-stream")
+    assert response.text.startswith("event: status\ndata: {")
+    assert '"status": 404' in response.text
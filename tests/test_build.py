@@ -0,0 +1,274 @@
+import hashlib
+import json
+from threading import Timer
+from time import time
+from types import SimpleNamespace
+
+import pytest
+from rq import Queue
+
+from asu.build import (
+    SNAPSHOT_REPOSITORY,
+    claim_build,
+    count_build,
+    get_coalesce_key,
+    get_manifest_key,
+    get_snapshot_image,
+    log_contains,
+    save_result,
+    wait_for_build,
+)
+from asu.build_request import BuildRequest
+from asu.util import get_request_hash
+
+build_request = BuildRequest(
+    version="1.2.3",
+    target="testtarget/testsubtarget",
+    profile="testprofile",
+    packages=["test1", "test2"],
+)
+
+
+def test_get_coalesce_key():
+    manifest = {"test1": "1.0", "test2": "2.0"}
+    key = get_coalesce_key(build_request, "sha256:abc", "r1", manifest)
+
+    other_request = build_request.model_copy(
+        update={"packages": ["test2", "test1"], "client": "luci/1.0"}
+    )
+    assert key == get_coalesce_key(other_request, "sha256:abc", "r1", manifest)
+
+    assert key != get_coalesce_key(
+        build_request, "sha256:abc", "r1", {"test1": "1.1", "test2": "2.0"}
+    )
+    assert key != get_coalesce_key(build_request, "sha256:def", "r1", manifest)
+    assert key != get_coalesce_key(build_request, "sha256:abc", "r2", manifest)
+    assert key != get_coalesce_key(
+        build_request.model_copy(update={"rootfs_size_mb": 256}),
+        "sha256:abc",
+        "r1",
+        manifest,
+    )
+
+
+def test_get_coalesce_key_prebuild():
+    # Prebuilds only name the profile, clients list their installed packages.
+    prebuild_request = BuildRequest(
+        version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+    )
+    client_request = build_request.model_copy(
+        update={"packages": ["test1", "test2", "test1"], "client": "luci/1.0"}
+    )
+    assert get_request_hash(prebuild_request) != get_request_hash(client_request)
+
+    manifest = {"test1": "1.0", "test2": "2.0"}
+    assert get_coalesce_key(
+        prebuild_request, "sha256:abc", "r1", manifest
+    ) == get_coalesce_key(client_request, "sha256:abc", "r1", manifest)
+
+
+def test_count_build(app, redis_server):
+    count_build(SimpleNamespace(origin="prebuild"), build_request)
+    assert not redis_server.hgetall("metrics:counters")
+
+    count_build(SimpleNamespace(origin="default"), build_request)
+    count_build(SimpleNamespace(origin="default"), build_request, origin="coalesced")
+    assert redis_server.hgetall("metrics:counters") == {
+        b'builds_total{version="1.2.3",target="testtarget/testsubtarget",profile="testprofile",origin="build"}': b"1",
+        b'builds_total{version="1.2.3",target="testtarget/testsubtarget",profile="testprofile",origin="coalesced"}': b"1",
+    }
+    assert len(redis_server.keys("stats:builds:1.2.3:*")) == 1
+
+
+def test_get_manifest_key():
+    key = get_manifest_key(build_request, "sha256:abc")
+
+    assert key.startswith("manifest:")
+    assert key == get_manifest_key(
+        build_request.model_copy(
+            update={"packages": ["test2", "test1"], "rootfs_size_mb": 256}
+        ),
+        "sha256:abc",
+    )
+    assert key != get_manifest_key(build_request, "sha256:def")
+    assert key != get_manifest_key(
+        build_request.model_copy(update={"packages": ["test1"]}), "sha256:abc"
+    )
+
+
+def test_claim_build(app):
+    assert claim_build("key", "request1") == "request1"
+    assert claim_build("key", "request2") == "request1"
+    assert claim_build("key", "request2", force=True) == "request2"
+
+
+def test_wait_for_build(app, redis_server):
+    queue = Queue(connection=redis_server, is_async=False)
+    queue.enqueue("asu.util.get_str_hash", "test", job_id="request1")
+
+    assert wait_for_build("request1", 10) == (
+        "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08"
+    )
+    assert wait_for_build("missing", 10) is None
+
+
+def test_wait_for_build_timeout(app, redis_server):
+    Queue(connection=redis_server).enqueue("math.floor", 1.5, job_id="request1")
+
+    start = time()
+    assert wait_for_build("request1", 0.2) is None
+    assert time() - start < 2
+
+
+def test_wait_for_build_status_channel(app, redis_server):
+    from asu.util import notify_status
+
+    Queue(connection=redis_server).enqueue("math.floor", 1.5, job_id="request1")
+
+    def fail():
+        redis_server.delete("rq:job:request1")
+        notify_status("request1", "failed")
+
+    Timer(0.2, fail).start()
+    start = time()
+    assert wait_for_build("request1", 10) is None
+    assert time() - start < 2
+
+
+def test_build_removes_previous_artifacts(app, monkeypatch):
+    from asu.build import build
+    from asu.store import get_blob_path, store_artifacts
+    from asu.util import get_build_dir
+
+    def get_podman():
+        raise RuntimeError("no podman")
+
+    monkeypatch.setattr("asu.build.get_podman", get_podman)
+
+    shared = hashlib.sha256(b"image").hexdigest()
+    for request_hash in "request1", "request2":
+        bin_dir = get_build_dir(request_hash)
+        bin_dir.mkdir(parents=True)
+        (bin_dir / "sysupgrade.bin").write_bytes(b"image")
+        store_artifacts(bin_dir, request_hash, {"sysupgrade.bin": shared})
+
+    job = SimpleNamespace(id="request1", meta={}, save_meta=lambda: None)
+    with pytest.raises(RuntimeError):
+        build(build_request, job)
+
+    # The ImageBuilder must not write into links to the blob store
+    assert list(get_build_dir("request1").iterdir()) == []
+    assert get_blob_path(shared).read_bytes() == b"image"
+    assert (get_build_dir("request2") / "sysupgrade.bin").samefile(
+        get_blob_path(shared)
+    )
+
+
+def test_build_resets_log_stream(app, redis_server, monkeypatch):
+    from asu.build import build
+
+    def get_podman():
+        raise RuntimeError("no podman")
+
+    monkeypatch.setattr("asu.build.get_podman", get_podman)
+    redis_server.xadd("build:log:request1", {"stream": "stdout", "line": "old"})
+
+    job = SimpleNamespace(id="request1", meta={}, save_meta=lambda: None)
+    with pytest.raises(RuntimeError):
+        build(build_request, job)
+
+    assert not redis_server.exists("build:log:request1")
+
+
+class FakeContainer:
+    def __init__(self, images):
+        self.images = images
+        self.killed = False
+
+    def commit(self, repository, tag):
+        self.images.tags.append(f"{repository}:{tag}")
+
+    def kill(self):
+        self.killed = True
+
+
+class FakeImages:
+    def __init__(self):
+        self.tags = []
+
+    def exists(self, tag):
+        return tag in self.tags
+
+    def list(self, filters):
+        return [SimpleNamespace(tags=list(self.tags))]
+
+    def remove(self, tag):
+        self.tags.remove(tag)
+
+
+def test_get_snapshot_image(app, monkeypatch):
+    images = FakeImages()
+    podman = SimpleNamespace(images=images)
+    containers = []
+    commands = []
+    revision = {"upstream": "r2-bbb"}
+
+    def create_container(podman, image, **kwargs):
+        containers.append(FakeContainer(images))
+        return containers[-1]
+
+    def run_cmd(container, command):
+        commands.append(command)
+        return 0, f'Current Revision: "{revision["upstream"]}"', ""
+
+    monkeypatch.setattr("asu.build.create_container", create_container)
+    monkeypatch.setattr("asu.build.run_cmd", run_cmd)
+    monkeypatch.setattr(
+        "asu.build.get_upstream_revision", lambda version, target: "r2-bbb"
+    )
+
+    snapshot_request = build_request.model_copy(update={"version": "SNAPSHOT"})
+    images.tags.append(
+        f"{SNAPSHOT_REPOSITORY}:SNAPSHOT-testtarget-testsubtarget-r1-aaa"
+    )
+
+    snapshot_image = get_snapshot_image(podman, "base", {}, snapshot_request)
+    assert snapshot_image == (
+        f"{SNAPSHOT_REPOSITORY}:SNAPSHOT-testtarget-testsubtarget-r2-bbb"
+    )
+    assert commands == [["sh", "setup.sh"], ["make", "info"]]
+    assert containers[0].killed
+    assert images.tags == [snapshot_image]
+
+    # The revision is unpacked already
+    assert get_snapshot_image(podman, "base", {}, snapshot_request) == snapshot_image
+    assert len(containers) == 1
+
+
+def test_get_snapshot_image_no_revision(app, monkeypatch):
+    monkeypatch.setattr("asu.build.get_upstream_revision", lambda version, target: "")
+
+    assert get_snapshot_image(None, "base", {}, build_request) == "base"
+
+
+def test_log_contains(tmp_path):
+    log_file = tmp_path / "build.log"
+    assert not log_contains(log_file, 0, ["is too big"])
+
+    log_file.write_text("$ make manifest\nimage is too big\n")
+    offset = log_file.stat().st_size
+    with log_file.open("a") as log_content:
+        log_content.write("$ make image\nWARNING: sysupgrade.bin is too big\n")
+        log_content.writelines(f"line {i}\n" for i in range(100))
+
+    assert log_contains(log_file, offset, ["is too big", "out of space?"])
+    assert not log_contains(log_file, offset, ["out of space?"])
+    assert not log_contains(log_file, log_file.stat().st_size, ["is too big"])
+
+
+def test_save_result(app, redis_server, tmp_path):
+    result = {"bin_dir": "abc", "manifest": {"test1": "1.0"}}
+
+    assert save_result(tmp_path, result) == {"bin_dir": "abc"}
+    assert json.loads((tmp_path / "result.json").read_text()) == result
+    assert redis_server.zscore("store:access", tmp_path.name)
@@ -0,0 +1,237 @@
+from types import SimpleNamespace
+
+import pytest
+from fakeredis import FakeStrictRedis
+from podman import errors
+
+from asu.config import settings
+from asu.container_pool import (
+    acquire_container,
+    create_container,
+    evict_idle_containers,
+    prewarm_containers,
+    prewarm_pools,
+    prewarm_requested,
+    release_container,
+    request_prewarm,
+)
+
+image = "ghcr.io/openwrt/imagebuilder:testtarget-testsubtarget-v1.2.3"
+digest = "sha256:abc"
+
+
+class FakeContainer:
+    def __init__(self, container_id):
+        self.id = container_id
+        self.short_id = container_id[:12]
+        self.status = "created"
+        self.killed = False
+
+    def start(self):
+        self.status = "running"
+
+    def kill(self):
+        self.killed = True
+        self.status = "exited"
+
+
+class FakeContainers:
+    def __init__(self):
+        self.created = {}
+
+    def create(self, image, **kwargs):
+        container = FakeContainer(f"container{len(self.created)}")
+        container.command = kwargs["command"]
+        self.created[container.id] = container
+        return container
+
+    def get(self, container_id):
+        if container_id not in self.created:
+            raise errors.NotFound("not found")
+        return self.created[container_id]
+
+
+class FakeImages:
+    def __init__(self):
+        self.digests = {image: digest}
+
+    def get(self, name):
+        if name not in self.digests:
+            raise errors.ImageNotFound("not found")
+        return SimpleNamespace(id="id", attrs={"Digest": self.digests[name]})
+
+
+class FakePodman:
+    def __init__(self):
+        self.containers = FakeContainers()
+        self.images = FakeImages()
+
+
+@pytest.fixture
+def podman(fake_server, monkeypatch):
+    redis = FakeStrictRedis(server=fake_server, decode_responses=True)
+    monkeypatch.setattr("asu.container_pool.get_redis_client", lambda: redis)
+    monkeypatch.setattr(settings, "container_pool_size", 1)
+    monkeypatch.setattr(settings, "container_pool_max_uses", 2)
+    yield FakePodman()
+
+
+def test_acquire_fresh_container(podman):
+    container, fresh = acquire_container(podman, image, digest)
+
+    assert fresh
+    assert container.status == "running"
+
+
+def test_release_and_reuse(podman):
+    container, _ = acquire_container(podman, image, digest)
+    release_container(podman, container, image, digest)
+
+    reused, fresh = acquire_container(podman, image, digest)
+    assert not fresh
+    assert reused is container
+    assert not container.killed
+
+
+def test_release_without_reuse(podman):
+    container, _ = acquire_container(podman, image, digest)
+    release_container(podman, container, image, digest, reuse=False)
+
+    assert container.killed
+
+    other, fresh = acquire_container(podman, image, digest)
+    assert fresh
+    assert other is not container
+
+
+def test_release_max_uses(podman):
+    container, _ = acquire_container(podman, image, digest)
+    release_container(podman, container, image, digest)
+    container, _ = acquire_container(podman, image, digest)
+    release_container(podman, container, image, digest)
+
+    assert container.killed
+
+
+def test_release_pool_full(podman):
+    first, _ = acquire_container(podman, image, digest)
+    second, _ = acquire_container(podman, image, digest)
+    release_container(podman, first, image, digest)
+    release_container(podman, second, image, digest)
+
+    assert not first.killed
+    assert second.killed
+
+
+def test_evict_idle_containers(podman, monkeypatch):
+    container, _ = acquire_container(podman, image, digest)
+    release_container(podman, container, image, digest)
+
+    assert evict_idle_containers(podman) == 0
+
+    monkeypatch.setattr(settings, "container_pool_idle_ttl", "-1m")
+    assert evict_idle_containers(podman) == 1
+    assert container.killed
+
+    _, fresh = acquire_container(podman, image, digest)
+    assert fresh
+
+
+def test_acquire_skips_stopped_container(podman):
+    container, _ = acquire_container(podman, image, digest)
+    release_container(podman, container, image, digest)
+    container.status = "exited"
+
+    other, fresh = acquire_container(podman, image, digest)
+    assert fresh
+    assert other is not container
+
+
+def test_acquire_new_digest(podman):
+    container, _ = acquire_container(podman, image, digest)
+    release_container(podman, container, image, digest)
+
+    # The tag moved to another image, its containers are outdated
+    other, fresh = acquire_container(podman, image, "sha256:def")
+    assert fresh
+    assert other is not container
+
+    reused, fresh = acquire_container(podman, image, digest)
+    assert not fresh
+    assert reused is container
+
+
+def test_prewarm_containers(podman, monkeypatch):
+    monkeypatch.setattr(settings, "container_pool_size", 2)
+
+    assert prewarm_containers(podman, image, digest) == 2
+    assert prewarm_containers(podman, image, digest) == 0
+
+    first, fresh = acquire_container(podman, image, digest)
+    assert not fresh
+    second, fresh = acquire_container(podman, image, digest)
+    assert not fresh
+    assert first is not second
+    assert len(podman.containers.created) == 2
+
+
+def test_prewarm_requested(podman):
+    assert prewarm_requested(podman) == 0
+
+    # Builds only record the pool, the worker fills it after the job
+    request_prewarm(image, digest, {"TARGET": "x86/64"})
+    assert len(podman.containers.created) == 0
+    assert prewarm_requested(podman) == 1
+    assert prewarm_requested(podman) == 0
+    assert acquire_container(podman, image, digest)[1] is False
+
+
+def test_prewarm_pools(podman):
+    assert prewarm_pools(podman) == 0
+
+    request_prewarm(image, digest, {"TARGET": "x86/64"})
+
+    # A restarted worker fills the pools used recently
+    assert prewarm_pools(podman) == 1
+    assert acquire_container(podman, image, digest)[1] is False
+
+    # Pools of outdated digests are forgotten
+    podman.images.digests[image] = "sha256:def"
+    assert prewarm_pools(podman) == 0
+    assert prewarm_requested(podman) == 0
+    assert len(podman.containers.created) == 1
+
+
+def test_pooled_container_lifetime(podman, monkeypatch):
+    monkeypatch.setattr(settings, "container_pool_idle_ttl", "30m")
+    monkeypatch.setattr(settings, "job_timeout", "10m")
+
+    container, _ = acquire_container(podman, image, digest)
+    prewarm_containers(podman, image, "sha256:def")
+
+    # Containers lost by the pool stop after serving all their builds
+    lifetime = str(2 * (30 * 60 + 10 * 60 + 60))
+    assert container.command == ["sleep", lifetime]
+    assert podman.containers.get("container1").command == ["sleep", lifetime]
+
+
+def test_create_container_keep_id(monkeypatch):
+    created = []
+
+    class Containers(FakeContainers):
+        def create(self, image, **kwargs):
+            created.append(kwargs)
+            return super().create(image, **kwargs)
+
+    podman = FakePodman()
+    podman.containers = Containers()
+    monkeypatch.setattr(settings, "container_uid", 1001)
+
+    create_container(podman, image)
+    create_container(podman, image, keep_id=True)
+
+    assert "userns_mode" not in created[0]
+    assert created[1]["userns_mode"] == {
+        "nsmode": "keep-id",
+        "value": "uid=1001,gid=1000",
+    }
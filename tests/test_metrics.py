@@ -0,0 +1,56 @@
+from asu.util import (
+    PHASE_BUCKETS,
+    add_build_event,
+    get_metric_field,
+    increment_metric,
+    observe_metric,
+)
+
+
+def test_get_metric_field():
+    assert get_metric_field("builds_total") == "builds_total"
+    assert (
+        get_metric_field("builds_total", {"version": "1.2.3", "profile": 'a"b'})
+        == 'builds_total{version="1.2.3",profile="a\\"b"}'
+    )
+
+
+def test_metrics(client, redis_server):
+    redis_server.sadd("rq:workers", "rq:worker:worker1", "rq:worker:worker2")
+    redis_server.sadd("rq:workers", "rq:worker:dead")
+    redis_server.hset("rq:worker:worker1", "state", "busy")
+    redis_server.hset("rq:worker:worker2", "state", "idle")
+    add_build_event("cache-hits")
+    add_build_event("cache-hits")
+    increment_metric("builds_total", {"version": "1.2.3", "profile": "testprofile"})
+    observe_metric("build_phase_duration_seconds", 42, PHASE_BUCKETS, {"phase": "x"})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+
+    lines = response.text.splitlines()
+    assert "# TYPE builds_total counter" in lines
+    assert 'builds_total{version="1.2.3",profile="testprofile"} 1' in lines
+    assert 'build_events_total{event="cache-hits"} 2' in lines
+    assert "cache_hits 2" in lines
+    assert "cache_misses 0" in lines
+    assert 'queue_length{queue="default"} 0' in lines
+    assert "store_size_bytes 0" in lines
+    assert 'worker_busy{worker="worker1"} 1' in lines
+    assert 'worker_busy{worker="worker2"} 0' in lines
+    assert 'worker_busy{worker="dead"}' not in response.text
+
+    assert "# TYPE build_phase_duration_seconds histogram" in lines
+    buckets = [line for line in lines if line.startswith("build_phase_duration_")]
+    assert buckets[:3] == [
+        'build_phase_duration_seconds_bucket{phase="x",le="1"} 0',
+        'build_phase_duration_seconds_bucket{phase="x",le="5"} 0',
+        'build_phase_duration_seconds_bucket{phase="x",le="10"} 0',
+    ]
+    assert 'build_phase_duration_seconds_bucket{phase="x",le="30"} 0' in lines
+    assert 'build_phase_duration_seconds_bucket{phase="x",le="60"} 1' in lines
+    assert buckets[len(PHASE_BUCKETS)] == (
+        'build_phase_duration_seconds_bucket{phase="x",le="+Inf"} 1'
+    )
+    assert 'build_phase_duration_seconds_sum{phase="x"} 42' in lines
+    assert 'build_phase_duration_seconds_count{phase="x"} 1' in lines
@@ -0,0 +1,176 @@
+import hashlib
+from types import SimpleNamespace
+
+import pytest
+from fakeredis import FakeStrictRedis
+
+import asu.package_cache
+from asu.config import settings
+from asu.package_cache import (
+    evict_packages,
+    get_blob_path,
+    get_cache_path,
+    get_feed_urls,
+    get_package_files,
+    populate_download_dir,
+    store_downloads,
+)
+
+base_url = "https://downloads.openwrt.org/releases/23.05.5/packages/x86_64/base"
+
+packages = {
+    "busybox_1.36.1-r2_x86_64.ipk": b"busybox",
+    "libubox20240329_2024.03.29-r1_x86_64.ipk": b"libubox",
+}
+
+index = f"""Package: busybox
+Version: 1.36.1-r2
+Filename: busybox_1.36.1-r2_x86_64.ipk
+SHA256sum: {hashlib.sha256(b"busybox").hexdigest()}
+
+Package: libubox20240329
+Version: 2024.03.29-r1
+ABIVersion: 20240329
+Filename: libubox20240329_2024.03.29-r1_x86_64.ipk
+SHA256sum: {hashlib.sha256(b"libubox").hexdigest()}
+"""
+
+manifest = {"busybox": "1.36.1-r2", "libubox": "2024.03.29-r1", "local": "1.0"}
+
+
+@pytest.fixture
+def package_cache(fake_server, monkeypatch, tmp_path):
+    redis = FakeStrictRedis(server=fake_server, decode_responses=True)
+    requests = []
+
+    def client_get(url):
+        requests.append(url)
+        if url == f"{base_url}/Packages":
+            return SimpleNamespace(status_code=200, text=index)
+        return SimpleNamespace(status_code=404, text="")
+
+    monkeypatch.setattr("asu.package_cache.get_redis_client", lambda: redis)
+    monkeypatch.setattr("asu.package_cache.client_get", client_get)
+    monkeypatch.setattr(settings, "package_cache_path", tmp_path / "cache")
+    monkeypatch.setattr(settings, "package_cache_size_mb", 1)
+    yield requests
+
+
+def test_get_feed_urls():
+    repositories_conf = f"""src/gz openwrt_base {base_url}
+src/gz openwrt_core https://downloads.openwrt.org/releases/23.05.5/targets/x86/64/packages
+src imagebuilder file:packages
+option check_signature
+"""
+    assert get_feed_urls(repositories_conf) == [
+        base_url,
+        "https://downloads.openwrt.org/releases/23.05.5/targets/x86/64/packages",
+    ]
+
+
+def test_get_package_files(package_cache):
+    files = get_package_files(manifest, [base_url, "https://example.org/apk"], "1h")
+
+    assert files == {
+        name: hashlib.sha256(content).hexdigest() for name, content in packages.items()
+    }
+
+    # Indexes are cached, including missing ones
+    get_package_files(manifest, [base_url, "https://example.org/apk"], "1h")
+    assert len(package_cache) == 2
+
+
+def test_download_cache(package_cache, tmp_path):
+    files = get_package_files(manifest, [base_url], "1h")
+
+    first_build = tmp_path / "first"
+    first_build.mkdir()
+    assert populate_download_dir(first_build, files) == []
+
+    for name, content in packages.items():
+        (first_build / name).write_bytes(content)
+    (first_build / "busybox_1.36.1-r2_x86_64.ipk").write_bytes(b"corrupt")
+
+    assert store_downloads(first_build, files) == 1
+
+    second_build = tmp_path / "second"
+    second_build.mkdir()
+    assert populate_download_dir(second_build, files) == [
+        "libubox20240329_2024.03.29-r1_x86_64.ipk"
+    ]
+    assert (second_build / "libubox20240329_2024.03.29-r1_x86_64.ipk").read_bytes() == (
+        b"libubox"
+    )
+
+
+def test_evict_packages(package_cache, tmp_path, monkeypatch):
+    files = get_package_files(manifest, [base_url], "1h")
+    for name, content in packages.items():
+        (tmp_path / name).write_bytes(content)
+    assert store_downloads(tmp_path, files) == 2
+
+    assert evict_packages() == 0
+
+    monkeypatch.setattr(settings, "package_cache_size_mb", 0)
+    assert evict_packages() == 2
+    assert not any(get_blob_path(sha256).exists() for sha256 in files.values())
+
+
+def test_evict_packages_shared_path(package_cache, tmp_path, monkeypatch):
+    files = get_package_files(manifest, [base_url], "1h")
+    for name, content in packages.items():
+        (tmp_path / name).write_bytes(content)
+    assert store_downloads(tmp_path, files) == 2
+
+    # Other cache paths keep their own accounting and never remove these blobs
+    monkeypatch.setattr(settings, "package_cache_size_mb", 0)
+    monkeypatch.setattr(settings, "package_cache_path", tmp_path / "other")
+    assert evict_packages() == 0
+    assert all(
+        (tmp_path / "cache" / "blobs" / sha256[:2] / sha256).is_file()
+        for sha256 in files.values()
+    )
+
+    monkeypatch.setattr(settings, "package_cache_path", tmp_path / "cache")
+    assert evict_packages() == 2
+
+
+def test_package_cache_path_default(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "public_path", tmp_path)
+    monkeypatch.setattr(settings, "package_cache_path", None)
+
+    assert get_blob_path("abcd") == tmp_path / "package-cache" / "blobs/ab/abcd"
+
+
+def test_populate_download_dir_evicted(package_cache, tmp_path, monkeypatch):
+    files = get_package_files(manifest, [base_url], "1h")
+    for name, content in packages.items():
+        (tmp_path / name).write_bytes(content)
+    assert store_downloads(tmp_path, files) == 2
+
+    def link(source, target):
+        raise FileNotFoundError(source)
+
+    # Blobs evicted by another build after the existence check are missed.
+    monkeypatch.setattr("asu.package_cache.link", link)
+    build = tmp_path / "build"
+    build.mkdir()
+    assert populate_download_dir(build, files) == []
+
+
+def test_store_downloads_counted_once(package_cache, tmp_path):
+    files = get_package_files(manifest, [base_url], "1h")
+    for name, content in packages.items():
+        (tmp_path / name).write_bytes(content)
+    assert store_downloads(tmp_path, files) == 2
+
+    # Blobs stored concurrently by another build are only counted once.
+    for sha256 in files.values():
+        get_blob_path(sha256).unlink()
+    assert store_downloads(tmp_path, files) == 0
+    assert all(get_blob_path(sha256).is_file() for sha256 in files.values())
+
+    redis = asu.package_cache.get_redis_client()
+    assert int(redis.get(f"package-cache:{get_cache_path()}:size")) == sum(
+        len(content) for content in packages.values()
+    )
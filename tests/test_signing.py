@@ -0,0 +1,166 @@
+import base64
+import hashlib
+import struct
+from pathlib import Path
+
+import nacl.signing
+import pytest
+
+import asu.signing
+from asu.signing import (
+    FWIMAGE_TRAILER,
+    ed25519_sign_file,
+    fwtool_append_signature,
+    fwtool_strip_signature,
+    sign_image,
+    ucert_append,
+    usign_sign,
+)
+from asu.util import fingerprint_pubkey_usign, get_podman, verify_usign
+
+
+@pytest.fixture
+def build_key():
+    signing_key = nacl.signing.SigningKey(b"\x01" * 32)
+    fingerprint = b"\x02" * 8
+    seckey = bytes(signing_key) + bytes(signing_key.verify_key)
+    secret_key = "untrusted comment: test key\n{}\n".format(
+        base64.b64encode(
+            struct.pack(
+                "!2s2sI16s8s8s64s",
+                b"Ed",
+                b"BK",
+                0,
+                b"\0" * 16,
+                hashlib.sha512(seckey).digest()[:8],
+                fingerprint,
+                seckey,
+            )
+        ).decode()
+    )
+    public_key = base64.b64encode(
+        b"Ed" + fingerprint + bytes(signing_key.verify_key)
+    ).decode()
+    yield secret_key, public_key
+
+
+def test_usign_sign(build_key, tmp_path):
+    secret_key, public_key = build_key
+    message = tmp_path / "message"
+    message.write_bytes(b"firmware")
+    signature = tmp_path / "message.sig"
+    signature.write_text(usign_sign(message.read_bytes(), secret_key))
+
+    assert signature.read_text().startswith(
+        f"untrusted comment: signed by key {fingerprint_pubkey_usign(public_key)}\n"
+    )
+    assert verify_usign(signature, message, public_key)
+
+    message.write_bytes(b"modified")
+    assert not verify_usign(signature, message, public_key)
+
+
+def test_ucert_append():
+    certificate = ucert_append(b"cert", "sig")
+
+    assert certificate == (
+        b"cert" + b"\x00\x00\x00\x0c" + b"\x00\x00\x00\x07" + b"sig" + b"\x00"
+    )
+
+
+def test_ed25519_sign_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(asu.signing, "CHUNK_SIZE", 7)
+    signing_key = nacl.signing.SigningKey(b"\x01" * 32)
+    seckey = bytes(signing_key) + bytes(signing_key.verify_key)
+    message = tmp_path / "message"
+    message.write_bytes(b"firmware" * 100 + b"trailer")
+
+    assert ed25519_sign_file(message, 800, seckey) == (
+        signing_key.sign(b"firmware" * 100).signature
+    )
+    assert ed25519_sign_file(message, 0, seckey) == signing_key.sign(b"").signature
+
+
+def test_fwtool_signature(tmp_path):
+    image = tmp_path / "image.bin"
+    image.write_bytes(b"firmware")
+    fwtool_append_signature(image, b"signature")
+    signed = image.read_bytes()
+
+    assert len(signed) == len(b"firmware") + len(b"signature") + FWIMAGE_TRAILER.size
+    assert signed[-FWIMAGE_TRAILER.size :][:4] == b"FWx0"
+    assert fwtool_strip_signature(image) == len(b"firmware")
+    assert image.read_bytes() == b"firmware"
+    assert fwtool_strip_signature(image) == len(b"firmware")
+    assert image.read_bytes() == b"firmware"
+
+    # Corrupted trailers are kept, as done by fwtool
+    image.write_bytes(b"X" + signed[1:])
+    assert fwtool_strip_signature(image) == len(signed)
+    assert image.read_bytes() == b"X" + signed[1:]
+
+    with pytest.raises(ValueError):
+        fwtool_append_signature(image, b"x" * 1025)
+
+
+def test_sign_image(build_key, tmp_path, monkeypatch):
+    monkeypatch.setattr(asu.signing, "CHUNK_SIZE", 3)
+    secret_key, public_key = build_key
+    image = tmp_path / "sysupgrade.bin"
+    image.write_bytes(b"firmware")
+
+    checksum = sign_image(image, secret_key, b"cert")
+    signed = image.read_bytes()
+
+    assert checksum == hashlib.sha256(signed).hexdigest()
+    assert Path(f"{image}.ucert").read_bytes().startswith(b"cert")
+
+    unsigned = tmp_path / "unsigned.bin"
+    unsigned.write_bytes(signed)
+    fwtool_strip_signature(unsigned)
+    assert unsigned.read_bytes() == b"firmware"
+    assert verify_usign(Path(f"{image}.sig"), unsigned, public_key)
+    assert Path(f"{image}.sig").read_text() == usign_sign(b"firmware", secret_key)
+
+    # Signing again replaces the existing signature
+    assert sign_image(image, secret_key, b"cert") == checksum
+    assert image.read_bytes() == signed
+
+
+@pytest.mark.slow
+def test_sign_image_container(build_key, tmp_path):
+    """Compare native signing with the tools shipped in the ImageBuilder"""
+    secret_key, _ = build_key
+    (tmp_path / "key-build").write_text(secret_key)
+    (tmp_path / "key-build.ucert").write_bytes(b"cert")
+    (tmp_path / "native.bin").write_bytes(b"firmware" * 1000)
+    (tmp_path / "container.bin").write_bytes(b"firmware" * 1000)
+    tmp_path.chmod(0o777)
+
+    sign_image(tmp_path / "native.bin", secret_key, b"cert")
+
+    podman = get_podman()
+    image = "ghcr.io/openwrt/imagebuilder:x86-64-v23.05.5"
+    podman.images.pull(image)
+    podman.containers.run(
+        image,
+        command=[
+            "bash",
+            "-c",
+            "export PATH=$PATH:/builder/staging_dir/host/bin;"
+            "cd /signing; IMAGE=container.bin;"
+            'fwtool -t -s /dev/null "$IMAGE";'
+            'cp key-build.ucert "$IMAGE.ucert";'
+            'usign -S -m "$IMAGE" -s key-build -x "$IMAGE.sig";'
+            'ucert -A -c "$IMAGE.ucert" -x "$IMAGE.sig";'
+            'fwtool -S "$IMAGE.ucert" "$IMAGE"',
+        ],
+        mounts=[{"type": "bind", "source": str(tmp_path), "target": "/signing"}],
+        user="root",
+        remove=True,
+    )
+
+    for suffix in ["", ".sig", ".ucert"]:
+        assert (tmp_path / f"native.bin{suffix}").read_bytes() == (
+            tmp_path / f"container.bin{suffix}"
+        ).read_bytes()
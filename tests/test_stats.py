@@ -172,3 +172,25 @@ def test_stats_builds_by_version(client, redis_server: FakeStrictRedis):
     data = response.json()
     assert len(data["labels"]) == 26
     assert len(data["datasets"][0]["data"]) == 26
+
+
+def test_stats_build_phases(client):
+    from types import SimpleNamespace
+
+    from asu.build_request import BuildRequest
+    from asu.util import build_phase
+
+    build_request = BuildRequest(**build_config_1)
+    job = SimpleNamespace(meta={})
+    for _ in range(2):
+        with build_phase(job, "make_image", build_request):
+            pass
+
+    assert "make_image" in job.meta["timings"]
+
+    response = client.get("/api/v1/build-phases")
+    assert response.status_code == 200
+    assert list(response.json()["testtarget/testsubtarget"]) == ["make_image"]
+
+    response = client.get("/api/v1/build-phases?target=other/target")
+    assert response.json() == {}
@@ -1,3 +1,8 @@
+import hashlib
+import json
+
+from rq import Queue
+
 from asu.config import settings
 
 # store_path = settings.public_path / "store"
@@ -34,3 +39,293 @@ def test_store_file_missing(client):
 
     headers = response.headers
     assert headers["Content-Type"] != "application/octet-stream"
+
+
+def test_store_artifacts_deduplicate(app, redis_server):
+    from asu.store import get_blob_path, get_store_usage, store_artifacts
+
+    sha256 = hashlib.sha256(b"firmware").hexdigest()
+    for request_hash in "request1", "request2":
+        bin_dir = settings.public_path / "store" / request_hash
+        bin_dir.mkdir(parents=True, exist_ok=True)
+        (bin_dir / "sysupgrade.bin").write_bytes(b"firmware")
+
+    store = settings.public_path / "store"
+    assert (
+        store_artifacts(store / "request1", "request1", {"sysupgrade.bin": sha256}) == 0
+    )
+    assert (
+        store_artifacts(store / "request2", "request2", {"sysupgrade.bin": sha256}) == 8
+    )
+
+    blob = get_blob_path(sha256)
+    assert blob.read_bytes() == b"firmware"
+    assert blob.samefile(store / "request1" / "sysupgrade.bin")
+    assert blob.samefile(store / "request2" / "sysupgrade.bin")
+    assert redis_server.smembers(f"store:refs:{sha256}") == {b"request1", b"request2"}
+    assert get_store_usage() == {"blobs": 1, "size": 8}
+
+
+def test_store_linked_artifact_filename(client):
+    from asu.store import store_blob
+
+    bin_dir = settings.public_path / "store" / "request3"
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    (bin_dir / "factory.img").write_bytes(b"factory")
+    store_blob(bin_dir / "factory.img", hashlib.sha256(b"factory").hexdigest())
+
+    response = client.get("/store/request3/factory.img")
+
+    assert response.status_code == 200
+    assert response.content == b"factory"
+    assert 'filename="factory.img"' in response.headers["Content-Disposition"]
+
+
+def test_store_link_artifacts(app):
+    from asu.store import link_artifacts, store_blob
+
+    sha256 = hashlib.sha256(b"sdcard").hexdigest()
+    bin_dir = settings.public_path / "store" / "request4"
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    (bin_dir / "sdcard.img").write_bytes(b"sdcard")
+    store_blob(bin_dir / "sdcard.img", sha256)
+
+    (bin_dir / "sdcard.img.sig").write_bytes(b"signature")
+    (bin_dir / "profiles.json").write_text("{}")
+    (bin_dir / "build.log").write_text("log")
+
+    other_dir = settings.public_path / "store" / "request5"
+    assert link_artifacts(other_dir, bin_dir, {"sdcard.img": sha256})
+    assert (other_dir / "sdcard.img").read_bytes() == b"sdcard"
+    assert (other_dir / "sdcard.img.sig").read_bytes() == b"signature"
+    assert (other_dir / "profiles.json").is_file()
+    assert not (other_dir / "build.log").exists()
+
+    assert not link_artifacts(other_dir, bin_dir, {"missing.img": "0" * 64})
+
+
+def test_store_collect_garbage(app, redis_server):
+    from asu.store import (
+        collect_garbage,
+        get_blob_path,
+        get_store_usage,
+        store_artifacts,
+        touch_build,
+    )
+
+    store = settings.public_path / "store"
+    shared = hashlib.sha256(b"shared").hexdigest()
+    for request_hash in "request1", "request2", "request3", "request4":
+        unique = hashlib.sha256(request_hash.encode()).hexdigest()
+        bin_dir = store / request_hash
+        bin_dir.mkdir(parents=True, exist_ok=True)
+        (bin_dir / "shared.bin").write_bytes(b"shared")
+        (bin_dir / "unique.bin").write_bytes(request_hash.encode())
+        (bin_dir / "build.log").write_bytes(b"log")
+        store_artifacts(
+            bin_dir, request_hash, {"shared.bin": shared, "unique.bin": unique}
+        )
+        touch_build(request_hash)
+    touch_build("request1")
+
+    # A queued job keeps its directory
+    Queue(connection=redis_server).enqueue("math.floor", 1.5, job_id="request2")
+
+    # 6 (shared) + 4 * 8 (unique) + 4 * 3 (logs) bytes
+    assert collect_garbage(49) == {"size": 39, "removed": 1, "reclaimed": 11}
+    assert not (store / "request3").exists()
+    assert (store / "request2").is_dir()
+    assert get_store_usage() == {"blobs": 4, "size": 30}
+    assert redis_server.hget("store:gc", "reclaimed") == b"11"
+
+    assert collect_garbage(0)["removed"] == 2
+    assert (store / "request2").is_dir()
+    assert get_blob_path(shared).is_file()
+    assert redis_server.smembers(f"store:refs:{shared}") == {b"request2"}
+
+    assert collect_garbage(1000) == {"size": 17, "removed": 0, "reclaimed": 0}
+
+
+def test_store_collect_garbage_live_job(client, redis_server, monkeypatch):
+    from asu.build_request import BuildRequest
+    from asu.store import collect_garbage
+    from asu.util import get_build_dir, get_job, get_queue, get_request_hash
+
+    monkeypatch.setattr(settings, "async_queue", True)
+
+    build_request = dict(
+        version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+    )
+    request_hash = get_request_hash(BuildRequest(**build_request))
+    bin_dir = get_build_dir(request_hash)
+    bin_dir.mkdir(parents=True)
+    (bin_dir / "sysupgrade.bin").write_bytes(b"image")
+    (bin_dir / "result.json").write_text(
+        json.dumps(
+            {
+                "bin_dir": request_hash,
+                "checksums": {"sysupgrade.bin": "abc"},
+                "images": [{"name": "sysupgrade.bin", "sha256": "abc"}],
+                "manifest": {"test1": "1.0"},
+            }
+        )
+    )
+
+    response = client.post("/api/v1/build", json=build_request)
+    assert response.status_code == 200
+
+    # The finished job still points to the directory
+    assert collect_garbage(0)["removed"] == 0
+    response = client.post("/api/v1/build", json=build_request)
+    assert response.status_code == 200
+    assert response.json()["manifest"] == {"test1": "1.0"}
+    assert client.get(f"/store/{request_hash}/sysupgrade.bin").status_code == 200
+
+    # Once the job expired the build is removed and built again
+    get_job(request_hash).delete()
+    assert collect_garbage(0)["removed"] == 1
+    assert not bin_dir.exists()
+    response = client.post("/api/v1/build", json=build_request)
+    assert response.status_code == 202
+    assert len(get_queue()) == 1
+    assert redis_server.zscore("store:access", request_hash) is None
+
+
+def test_store_collect_garbage_aliased_profile(client, monkeypatch):
+    from asu.main import app
+    from asu.store import collect_garbage
+    from asu.util import get_build_dir, get_job
+
+    monkeypatch.setitem(
+        app.profiles["1.2.3"],
+        "testtarget/testsubtarget",
+        {"testprofile": "testprofile", "vendor_alias": "testprofile"},
+    )
+    response = client.post(
+        "/api/v1/build",
+        json=dict(
+            version="1.2.3", target="testtarget/testsubtarget", profile="vendor_alias"
+        ),
+    )
+    request_hash = response.json()["request_hash"]
+    bin_dir = get_build_dir(request_hash)
+    (bin_dir / "build.log").write_text("log")
+
+    # The directory is named by the job, so it's kept while the job lives
+    assert collect_garbage(0)["removed"] == 0
+    assert bin_dir.is_dir()
+
+    get_job(request_hash).delete()
+    assert collect_garbage(0)["removed"] == 1
+    assert not bin_dir.exists()
+
+
+def test_store_download_touches_build(client, redis_server):
+    bin_dir = settings.public_path / "store" / "request5"
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    (bin_dir / "sysupgrade.bin").write_bytes(b"firmware")
+
+    assert client.get("/store/request5/sysupgrade.bin").status_code == 200
+    assert redis_server.zscore("store:access", "request5")
+
+
+def test_store_download_caching(client):
+    from asu.store import get_blob_path, store_blob
+
+    sha256 = hashlib.sha256(b"firmware").hexdigest()
+    bin_dir = settings.public_path / "store" / "request6"
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    (bin_dir / "sysupgrade.bin").write_bytes(b"firmware")
+    (bin_dir / "result.json").write_text(
+        json.dumps({"checksums": {"sysupgrade.bin": sha256}})
+    )
+    store_blob(bin_dir / "sysupgrade.bin", sha256)
+
+    response = client.get("/store/request6/sysupgrade.bin")
+    assert response.headers["ETag"] == f'"{sha256}"'
+    assert response.headers["Cache-Control"] == "no-cache"
+
+    response = client.get(
+        "/store/request6/sysupgrade.bin", headers={"If-None-Match": f'"{sha256}"'}
+    )
+    assert response.status_code == 304
+    assert response.content == b""
+
+    response = client.get(
+        "/store/request6/sysupgrade.bin", headers={"Range": "bytes=4-"}
+    )
+    assert response.status_code == 206
+    assert response.content == b"ware"
+
+    blob_path = get_blob_path(sha256).relative_to(settings.public_path / "store")
+    response = client.get(f"/store/{blob_path}")
+    assert response.content == b"firmware"
+    assert response.headers["ETag"] == f'"{sha256}"'
+    assert "immutable" in response.headers["Cache-Control"]
+
+    # A rebuild of the same request changes the content behind the build path
+    rebuilt = hashlib.sha256(b"rebuilt").hexdigest()
+    (bin_dir / "sysupgrade.bin").unlink()
+    (bin_dir / "sysupgrade.bin").write_bytes(b"rebuilt")
+    (bin_dir / "result.json").write_text(
+        json.dumps({"checksums": {"sysupgrade.bin": rebuilt}})
+    )
+    response = client.get(
+        "/store/request6/sysupgrade.bin", headers={"If-None-Match": f'"{sha256}"'}
+    )
+    assert response.status_code == 200
+    assert response.content == b"rebuilt"
+    assert response.headers["ETag"] == f'"{rebuilt}"'
+
+
+def test_store_download_offload(client, monkeypatch):
+    bin_dir = settings.public_path / "store" / "request7"
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    (bin_dir / "sysupgrade.bin").write_bytes(b"firmware")
+
+    monkeypatch.setattr(settings, "store_offload", "x-accel-redirect")
+    response = client.get("/store/request7/sysupgrade.bin")
+    assert response.status_code == 200
+    assert response.content == b""
+    assert (
+        response.headers["X-Accel-Redirect"]
+        == "/internal/store/request7/sysupgrade.bin"
+    )
+    assert 'filename="sysupgrade.bin"' in response.headers["Content-Disposition"]
+
+    monkeypatch.setattr(settings, "store_offload", "x-sendfile")
+    response = client.get("/store/request7/sysupgrade.bin")
+    assert response.headers["X-Sendfile"] == str((bin_dir / "sysupgrade.bin").resolve())
+
+
+def test_store_migrate(client, redis_server):
+    from asu.store import get_blob_path, get_build_dirs, main, store_blob
+    from asu.util import get_build_dir
+
+    sha256 = hashlib.sha256(b"sdcard").hexdigest()
+    legacy_dir = settings.public_path / "store" / "abcdef"
+    legacy_dir.mkdir(parents=True, exist_ok=True)
+    (legacy_dir / "sdcard.img").write_bytes(b"sdcard")
+    store_blob(legacy_dir / "sdcard.img", sha256)
+    # Blobs owned by another user are symlinked
+    (legacy_dir / "sdcard.img").unlink()
+    (legacy_dir / "sdcard.img").symlink_to(f"../blobs/{sha256[:2]}/{sha256}")
+    (legacy_dir / "result.json").write_text(json.dumps({"bin_dir": "abcdef"}))
+
+    assert client.get("/store/abcdef/sdcard.img").content == b"sdcard"
+
+    main(["migrate"])
+
+    bin_dir = get_build_dir("abcdef")
+    assert not legacy_dir.exists()
+    assert get_build_dirs() == [bin_dir]
+    assert (bin_dir / "sdcard.img").read_bytes() == b"sdcard"
+    assert (bin_dir / "sdcard.img").samefile(get_blob_path(sha256))
+    assert json.loads((bin_dir / "result.json").read_text()) == {
+        "bin_dir": "ab/cd/abcdef"
+    }
+
+    # Links of the flat layout keep working
+    assert client.get("/store/abcdef/sdcard.img").content == b"sdcard"
+    assert client.get("/store/ab/cd/abcdef/sdcard.img").content == b"sdcard"
+    assert redis_server.zscore("store:access", "abcdef")
@@ -1,28 +1,56 @@
 import os
+import struct
+import tarfile
 import tempfile
+from io import BytesIO
 from pathlib import Path
+from types import SimpleNamespace
 
-from podman import PodmanClient
+from fakeredis import FakeStrictRedis
+from podman import PodmanClient, errors
 
 import asu.util
 from asu.build_request import BuildRequest
+from asu.config import settings
 from asu.util import (
+    add_timestamp,
     check_manifest,
+    copy_files,
     diff_packages,
+    enqueue_prebuilds,
     fingerprint_pubkey_usign,
+    get_build_dir,
+    get_build_path,
+    get_build_result,
     get_container_version_tag,
     get_file_hash,
+    get_imagebuilder_image,
+    get_imagebuilder_info,
+    get_job,
+    get_job_details,
+    get_jobs,
+    get_manifest_failure,
+    get_queue_name,
     get_packages_hash,
     get_podman,
     get_request_hash,
     get_str_hash,
+    get_stream_hash,
     is_post_kmod_split_build,
     is_snapshot_build,
     parse_feeds_conf,
+    parse_imagebuilder_info,
     parse_kernel_version,
     parse_manifest,
+    parse_package_errors,
     parse_packages_file,
+    pull_image,
+    report_error,
+    resolve_build_dir,
     run_cmd,
+    schedule_prebuilds,
+    set_imagebuilder_info,
+    set_manifest_failure,
     verify_usign,
 )
 
@@ -336,6 +364,43 @@ def test_run_cmd():
     assert "testtarget/testsubtarget" in stdout
 
 
+def test_parse_package_errors():
+    opkg_stderr = """Collected errors:
+ * satisfy_dependencies_for: Cannot satisfy the following dependencies for luci-app-foo:
+ * \tkmod-bar
+ * opkg_install_cmd: Cannot install package luci-app-foo.
+ * opkg_install_cmd: Cannot install package nonexist.
+ * Unknown package 'nonexist'.
+"""
+    assert parse_package_errors(opkg_stderr) == ["luci-app-foo", "nonexist"]
+
+    apk_stderr = """ERROR: unable to select packages:
+  nonexist (no such package):
+    required by: world[nonexist]
+  dnsmasq-full-2.90-r3:
+    conflicts: dnsmasq-2.90-r3[dnsmasq=2.90-r3]
+    satisfies: world[dnsmasq-full]
+"""
+    assert parse_package_errors(apk_stderr) == ["nonexist", "dnsmasq-full"]
+
+
+def test_set_manifest_failure(app):
+    apk_stderr = """ERROR: unable to select packages:
+  nonexist (no such package):
+    required by: world[nonexist]
+"""
+    assert set_manifest_failure("manifest-failure:a", "Impossible", apk_stderr)
+    assert get_manifest_failure("manifest-failure:a")["packages"] == ["nonexist"]
+
+    # Network errors may be gone on the next try
+    network_stderr = """Downloading https://downloads.openwrt.org/packages.adb
+ERROR: https://downloads.openwrt.org/packages.adb: network error
+wget returned 4
+"""
+    assert not set_manifest_failure("manifest-failure:b", "Impossible", network_stderr)
+    assert get_manifest_failure("manifest-failure:b") is None
+
+
 def test_parse_manifest_opkg():
     manifest = parse_manifest("test - 1.0\ntest2 - 2.0\ntest3 - 3.0\ntest4 - 3.0\n")
 
@@ -356,3 +421,378 @@ def test_parse_manifest_apk():
         "test3": "3.0",
         "test4": "3.0",
     }
+
+
+def test_parse_imagebuilder_info():
+    info = parse_imagebuilder_info(
+        (
+            Path(__file__).parent
+            / "upstream/snapshots/targets/testtarget/testsubtarget"
+            / "openwrt-imagebuilder-testtarget-testsubtarget.Linux-x86_64"
+            / "openwrt-testtarget-testsubtarget-testprofile.info"
+        ).read_text()
+    )
+
+    assert info["revision"] == "r12647-cb44ab4f5d"
+    assert info["default_packages"][:3] == ["base-files", "libc", "libgcc"]
+    assert info["default_packages"][-1] == "kmod-ipt-offload"
+    assert list(info["profiles"]) == ["Default", "8dev_carambola2", "testprofile"]
+    assert info["profiles"]["Default"]["packages"] == ["iwinfo"]
+    assert info["profiles"]["testprofile"]["packages"] == [
+        "kmod-usb2",
+        "kmod-usb-chipidea2",
+        "kmod-usb-storage",
+        "-swconfig",
+    ]
+
+
+def test_parse_imagebuilder_info_empty():
+    assert parse_imagebuilder_info("") == {
+        "revision": "",
+        "default_packages": [],
+        "profiles": {},
+    }
+
+
+def test_imagebuilder_info_cache(monkeypatch):
+    redis = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.util.get_redis_client", lambda: redis)
+
+    image = "ghcr.io/openwrt/imagebuilder:testtarget-testsubtarget-v1.2.3"
+    info = {"revision": "r1-abc", "default_packages": [], "profiles": {}}
+
+    assert get_imagebuilder_info(image) == ("", None)
+
+    set_imagebuilder_info(image, "sha256:123", None)
+    assert get_imagebuilder_info(image) == ("sha256:123", None)
+
+    set_imagebuilder_info(image, "sha256:123", info)
+    assert get_imagebuilder_info(image) == ("sha256:123", info)
+    assert get_imagebuilder_info(digest="sha256:123") == ("sha256:123", info)
+
+
+def test_get_imagebuilder_image():
+    build_request = BuildRequest(
+        version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+    )
+    assert (
+        get_imagebuilder_image(build_request)
+        == "ghcr.io/openwrt/imagebuilder:testtarget-testsubtarget-v1.2.3"
+    )
+
+
+def test_pull_image(monkeypatch):
+    redis = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.util.get_redis_client", lambda: redis)
+
+    image = "ghcr.io/openwrt/imagebuilder:testtarget-testsubtarget-v1.2.3"
+    registry = {"digest": "sha256:aaa"}
+    registry_checks = []
+
+    def get_registry_digest(name):
+        registry_checks.append(name)
+        return registry["digest"]
+
+    monkeypatch.setattr("asu.util.get_registry_digest", get_registry_digest)
+
+    class Image:
+        def __init__(self, digest):
+            self.id = "id-" + digest
+            self.attrs = {
+                "Digest": digest,
+                "RepoDigests": [f"ghcr.io/openwrt/imagebuilder@{digest}"],
+            }
+
+    class Images:
+        local = None
+        pulls = 0
+
+        def get(self, name):
+            if not self.local:
+                raise errors.ImageNotFound("not found")
+            return self.local
+
+        def pull(self, name):
+            self.pulls += 1
+            self.local = Image(registry["digest"])
+            return self.local
+
+    class Podman:
+        images = Images()
+
+    podman = Podman()
+
+    # Nothing local, pull
+    assert pull_image(podman, image) == "sha256:aaa"
+    assert podman.images.pulls == 1
+    assert get_imagebuilder_info(image) == ("sha256:aaa", None)
+
+    # Tag recently resolved, neither registry check nor pull
+    registry_checks.clear()
+    assert pull_image(podman, image) == "sha256:aaa"
+    assert podman.images.pulls == 1
+    assert registry_checks == []
+
+    # Tag expired but unchanged upstream, registry check only
+    redis.delete(f"imagebuilder:fresh:{image}")
+    assert pull_image(podman, image) == "sha256:aaa"
+    assert podman.images.pulls == 1
+    assert registry_checks == [image]
+
+    # Tag changed upstream, pull again
+    redis.delete(f"imagebuilder:fresh:{image}")
+    registry["digest"] = "sha256:bbb"
+    assert pull_image(podman, image) == "sha256:bbb"
+    assert podman.images.pulls == 2
+    assert get_imagebuilder_info(image) == ("sha256:bbb", None)
+
+
+def test_get_stream_hash():
+    copy = BytesIO()
+    assert (
+        get_stream_hash(BytesIO(b"test"), copy)
+        == "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08"
+    )
+    assert copy.getvalue() == b"test"
+
+
+def test_chunk_reader():
+    reader = asu.util.ChunkReader([b"abc", b"", b"defgh"])
+
+    assert reader.read(2) == b"ab"
+    assert reader.read(2) == b"c"
+    assert reader.read(2) == b"de"
+    assert reader.read() == b"fgh"
+    assert reader.read(2) == b""
+
+
+def test_copy_files(test_path):
+    class Container:
+        files = {"/builder/abc/image.bin": b"test"}
+
+        def get_archive(self, path):
+            if path not in self.files:
+                raise errors.NotFound("not found")
+            archive = BytesIO()
+            with tarfile.open(fileobj=archive, mode="w") as tar_file:
+                info = tarfile.TarInfo(Path(path).name)
+                info.size = len(self.files[path])
+                tar_file.addfile(info, BytesIO(self.files[path]))
+            return iter([archive.getvalue()]), {}
+
+    checksums = copy_files(
+        Container(), "/builder/abc", ["image.bin", "missing.bin"], Path(test_path)
+    )
+
+    assert checksums == {
+        "image.bin": "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08"
+    }
+    assert (Path(test_path) / "image.bin").read_bytes() == b"test"
+    assert not (Path(test_path) / "missing.bin").exists()
+
+
+def test_schedule_prebuilds(app, redis_server, monkeypatch):
+    monkeypatch.setattr(settings, "prebuild_profiles", 2)
+    monkeypatch.setattr(settings, "async_queue", True)
+
+    def reload_targets(app, version):
+        app.targets[version] = {"testtarget/testsubtarget": "testarch"}
+
+    def reload_profiles(app, version, target):
+        app.profiles[version][target] = {"testprofile": "testprofile"}
+
+    monkeypatch.setattr("asu.routers.api.reload_targets", reload_targets)
+    monkeypatch.setattr("asu.routers.api.reload_profiles", reload_profiles)
+
+    for profile, count in ("testprofile", 3), ("dropped", 2), ("rare", 1):
+        for _ in range(count):
+            add_timestamp(
+                f"stats:builds:1.2.2:testtarget/testsubtarget:{profile}",
+                {
+                    "stats": "builds",
+                    "version": "1.2.2",
+                    "target": "testtarget/testsubtarget",
+                    "profile": profile,
+                },
+            )
+
+    # Known versions are only recorded on the first run
+    assert schedule_prebuilds(["1.2.2", "SNAPSHOT"]) == []
+    assert schedule_prebuilds(["1.2.2"]) == []
+
+    # New releases are validated and built by a worker
+    assert schedule_prebuilds(["1.2.3", "1.2.2", "SNAPSHOT"]) == ["1.2.3"]
+    assert schedule_prebuilds(["1.2.3", "1.2.2", "SNAPSHOT"]) == []
+    (job,) = asu.util.get_queue("prebuild").get_jobs()
+    assert job.func_name == "asu.util.enqueue_prebuilds"
+    assert job.args == (["1.2.3"],)
+
+    # Prebuilds back off while the other queues hold half of max_pending_jobs
+    monkeypatch.setattr(settings, "max_pending_jobs", 10)
+    with monkeypatch.context() as m:
+        m.setattr(
+            asu.util, "get_queue_lengths", lambda: {"interactive": 6, "prebuild": 1}
+        )
+        assert enqueue_prebuilds(["1.2.3"]) == 0
+
+    # Profiles missing in the new release are skipped
+    assert enqueue_prebuilds(["1.2.3"]) == 1
+    assert enqueue_prebuilds(["1.2.3"]) == 0
+
+    build_request = BuildRequest(
+        version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+    )
+    job = get_job(get_request_hash(build_request))
+    assert job.origin == "prebuild"
+    assert job.is_queued
+
+
+def test_get_job_details(app, redis_server):
+    from rq import Queue
+
+    sync_queue = Queue(connection=redis_server, is_async=False)
+    sync_queue.enqueue("math.floor", 1.5, job_id="finished")
+    sync_queue.enqueue("math.floor", "x", job_id="failed")
+    queue = Queue(connection=redis_server)
+    queue.enqueue("math.floor", 1.5, job_id="queued1")
+    queue.enqueue("math.floor", 1.5, job_id="queued2")
+
+    details = get_job_details(get_jobs(["finished", "failed", "queued1", "queued2"]))
+
+    assert details[0][0].return_value == 1
+    assert "TypeError" in details[1][0].exc_string
+    assert details[2] == (None, 0)
+    assert details[3] == (None, 1)
+    assert get_job_details([]) == []
+
+
+def test_get_queue_name_default_rules():
+    build_request = BuildRequest(
+        version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+    )
+
+    assert get_queue_name(build_request, "unknown/0") == "default"
+    assert get_queue_name(build_request, "luci/git-24.10") == "interactive"
+    assert get_queue_name(build_request, "owut/2024.07.01") == "interactive"
+    assert get_queue_name(build_request, "owut/2024.07.01", batch=True) == "batch"
+
+
+def test_get_queue_name(monkeypatch):
+    monkeypatch.setattr(
+        settings,
+        "queue_rules",
+        [
+            {"batch": True, "queue": "batch"},
+            {"client": "luci/", "defaults": False, "queue": "interactive"},
+            {"version": "snapshot", "queue": "snapshot"},
+        ],
+    )
+    build_request = BuildRequest(
+        version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+    )
+    snapshot_request = build_request.model_copy(update={"version": "SNAPSHOT"})
+    defaults_request = build_request.model_copy(update={"defaults": "echo"})
+
+    assert get_queue_name(build_request) == "default"
+    assert get_queue_name(build_request, "luci/git-24.10") == "interactive"
+    assert get_queue_name(defaults_request, "luci/git-24.10") == "default"
+    assert get_queue_name(build_request, "luci/git-24.10", batch=True) == "batch"
+    assert get_queue_name(snapshot_request, "owut/2024") == "snapshot"
+
+
+def test_run_cmd_log_file(tmp_path):
+    container = SimpleNamespace(
+        exec_run=lambda command, demux, user: (2, (b"out\n", b"err\n"))
+    )
+    log_file = tmp_path / "build.log"
+
+    assert run_cmd(container, ["make", "info"], log_file=log_file) == (
+        2,
+        "out\n",
+        "err\n",
+    )
+    run_cmd(container, ["make", "manifest"], log_file=log_file)
+
+    log = log_file.read_text()
+    assert log.startswith("$ make info\nout\nerr\n# exit code 2\n")
+    assert "$ make manifest\n" in log
+
+
+def test_report_error_stderr(app):
+    job = SimpleNamespace(id="abc", meta={}, save_meta=lambda: None)
+    stderr = "\n".join(f"line {i}" for i in range(100))
+
+    try:
+        report_error(job, "Impossible package selection", stderr)
+    except RuntimeError:
+        pass
+
+    assert job.meta["detail"] == "Error: Impossible package selection"
+    assert job.meta["stderr"].startswith("line 50\n")
+    assert job.meta["stderr"].endswith("line 99")
+
+
+def test_get_build_result(app):
+    bin_dir = settings.public_path / "store" / "abc"
+    bin_dir.mkdir(parents=True)
+    (bin_dir / "result.json").write_text('{"bin_dir": "abc", "manifest": {}}')
+
+    assert get_build_result({"bin_dir": "abc"}) == {"bin_dir": "abc", "manifest": {}}
+    assert get_build_result({"bin_dir": "def"}) == {"bin_dir": "def"}
+
+
+def test_resolve_build_dir(app):
+    store = settings.public_path / "store"
+    assert get_build_path("abcdef") == "ab/cd/abcdef"
+    assert resolve_build_dir("abcdef") == store / "ab" / "cd" / "abcdef"
+
+    (store / "abcdef").mkdir(parents=True)
+    assert resolve_build_dir("abcdef") == store / "abcdef"
+
+    get_build_dir("abcdef").mkdir(parents=True)
+    assert resolve_build_dir("abcdef") == store / "ab" / "cd" / "abcdef"
+
+
+def test_stream_cmd(app, redis_server, tmp_path):
+    def frame(stream: int, data: bytes) -> bytes:
+        return struct.pack(">BxxxL", stream, len(data)) + data
+
+    class FakeResponse:
+        def __init__(self, content=None, raw=b""):
+            self.content = content
+            self.raw = BytesIO(raw)
+
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return self.content
+
+    output = frame(1, b"line 1\nli") + frame(2, b"error\n") + frame(1, b"ne 2\nend")
+    client = SimpleNamespace(
+        post=lambda url, data, stream=False: FakeResponse(
+            raw=output if stream else b"", content={"Id": "exec"}
+        ),
+        get=lambda url: FakeResponse({"ExitCode": 1}),
+    )
+    container = SimpleNamespace(name="container", client=client)
+    log_file = tmp_path / "build.log"
+
+    returncode, stdout, stderr = run_cmd(
+        container, ["make", "image"], log_file=log_file, log_stream="build:log:abc"
+    )
+    assert returncode == 1
+    assert stdout == "line 1\nline 2\nend"
+    assert stderr == "error"
+    assert log_file.read_text() == (
+        "$ make image\nline 1\nlierror\nne 2\nend# exit code 1\n\n"
+    )
+    assert [
+        (fields[b"stream"], fields[b"line"])
+        for _, fields in redis_server.xrange("build:log:abc")
+    ] == [
+        (b"stdout", b"line 1"),
+        (b"stderr", b"error"),
+        (b"stdout", b"line 2"),
+        (b"stdout", b"end"),
+    ]
@@ -0,0 +1,134 @@
+from collections import Counter
+
+from rq import Queue
+
+from asu.build_request import BuildRequest
+from asu.config import settings
+from asu.util import (
+    advertise_image,
+    get_affinity_queue_name,
+    get_affinity_queues,
+    get_queue_lengths,
+)
+from asu.worker import WeightedWorker, get_weighted_order
+
+
+def test_get_weighted_order():
+    names = ["interactive", "prebuild", "batch", "unknown"]
+    weights = {"interactive": 8, "batch": 2, "prebuild": 0}
+
+    first = Counter(get_weighted_order(names, weights)[0] for _ in range(2000))
+
+    assert first[0] > first[2] > 0
+    assert first[3] > 0
+    assert 1 not in first
+
+    for _ in range(100):
+        assert get_weighted_order(names, weights)[-1] == 1
+
+
+def test_weighted_worker(redis_server):
+    queues = [Queue(name, connection=redis_server) for name in ["batch", "prebuild"]]
+    worker = WeightedWorker(queues, connection=redis_server)
+
+    assert set(worker._ordered_queues) == set(queues)
+    assert worker._ordered_queues[-1].name == "prebuild"
+
+
+def test_weighted_worker_prewarm(redis_server, monkeypatch):
+    from rq import Worker
+
+    events = []
+    monkeypatch.setattr(settings, "container_pool_size", 1)
+    monkeypatch.setattr(Worker, "execute_job", lambda *args: events.append("job"))
+    monkeypatch.setattr("asu.worker.get_podman", lambda: None)
+    monkeypatch.setattr(
+        "asu.worker.prewarm_requested", lambda podman: events.append("prewarm")
+    )
+
+    worker = WeightedWorker([Queue(connection=redis_server)], connection=redis_server)
+    worker.execute_job(None, None)
+
+    assert events == ["job", "prewarm"]
+
+
+def test_weighted_worker_image_affinity(app, redis_server, monkeypatch):
+    monkeypatch.setattr(settings, "image_affinity", True)
+    build_request = BuildRequest(
+        version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+    )
+
+    assert get_affinity_queue_name("default", build_request) == "default"
+
+    advertise_image("worker-a", build_request)
+    queue_name = get_affinity_queue_name("default", build_request)
+    assert queue_name == "default@testtarget-testsubtarget-v1.2.3"
+    Queue(queue_name, connection=redis_server).enqueue("math.floor", 1.5)
+    assert get_queue_lengths()["default"] == 1
+
+    queues = [Queue("default", connection=redis_server)]
+    worker_a = WeightedWorker(queues, name="worker-a", connection=redis_server)
+    worker_b = WeightedWorker(queues, name="worker-b", connection=redis_server)
+    assert [queue.name for queue in worker_a._ordered_queues] == [
+        queue_name,
+        "default",
+    ]
+    assert [queue.name for queue in worker_b._ordered_queues] == ["default"]
+
+    # Other workers take over once the job waited for too long
+    monkeypatch.setattr(settings, "image_affinity_wait", "0")
+    worker_b.reorder_queues(None)
+    assert [queue.name for queue in worker_b._ordered_queues] == [
+        queue_name,
+        "default",
+    ]
+
+
+def test_weighted_worker_cleans_affinity_queues(app, redis_server, monkeypatch):
+    from rq.job import JobStatus
+
+    monkeypatch.setattr(settings, "image_affinity", True)
+    build_request = BuildRequest(
+        version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+    )
+    advertise_image("worker-a", build_request)
+    queue = Queue(
+        get_affinity_queue_name("default", build_request), connection=redis_server
+    )
+    job = queue.enqueue("math.floor", 1.5)
+
+    # The worker running the job died
+    queue.remove(job)
+    job.set_status(JobStatus.STARTED)
+    redis_server.zadd(queue.started_job_registry.key, {f"{job.id}:execution": 1})
+    redis_server.zadd("affinity:queues:default", {queue.name: 0})
+    assert [queue.name for queue in get_affinity_queues("default")] == [queue.name]
+
+    worker = WeightedWorker([Queue(connection=redis_server)], connection=redis_server)
+    worker.clean_registries()
+
+    assert job.get_status() == JobStatus.FAILED
+    assert job.id in queue.failed_job_registry
+
+
+def test_get_affinity_queues(app, redis_server, monkeypatch):
+    monkeypatch.setattr(settings, "image_affinity", True)
+    build_request = BuildRequest(
+        version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+    )
+    advertise_image("worker-a", build_request)
+    queue_name = get_affinity_queue_name("default", build_request)
+    queue = Queue(queue_name, connection=redis_server)
+    queue.enqueue("math.floor", 1.5)
+
+    assert [queue.name for queue in get_affinity_queues("default")] == [queue_name]
+    assert redis_server.ttl("affinity:queues:default") > 0
+
+    # Stale queues are kept until drained
+    redis_server.zadd("affinity:queues:default", {queue_name: 0})
+    assert [queue.name for queue in get_affinity_queues("default")] == [queue_name]
+
+    redis_server.delete(queue.key)
+    assert get_affinity_queues("default") == []
+    assert not redis_server.exists("affinity:queues:default")
+    assert queue.key.encode() not in redis_server.smembers(Queue.redis_queues_keys)